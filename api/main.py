@@ -1,28 +1,33 @@
 import io
 import asyncio
+import codecs
 import logging
 import difflib
 import csv
 import json
 import re
 import uuid as uuidlib
-from datetime import datetime, timezone, timedelta
-from collections import defaultdict
+from datetime import datetime, timezone
 from typing import List, Optional, Dict, Any
 from fastapi import FastAPI, HTTPException, Query, Body, File, UploadFile, Request, Response
 from pydantic import BaseModel
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from app import db
 from app import config
+from app import journal
 from app.matcher import matcher
 
 app = FastAPI(title="InfraCount API", version="1.0.0")
 
 _LOG_IMPORT_CACHE: Dict[str, Dict[str, Any]] = {}
 _AUTO_SYNC_TASK: Optional[asyncio.Task] = None
+_PARTITION_TASK: Optional[asyncio.Task] = None
+_RETENTION_TASK: Optional[asyncio.Task] = None
+_ARCHIVE_TASK: Optional[asyncio.Task] = None
+_SESSION_PURGE_TASK: Optional[asyncio.Task] = None
 
 async def _auto_sync_walkin_loop():
     while True:
@@ -32,21 +37,60 @@ async def _auto_sync_walkin_loop():
             else:
                 days = config.AUTO_SYNC_WALKIN_BACKFILL_DAYS
 
-            today = datetime.now().date()
-            for i in range(days):
-                d = (today - timedelta(days=i)).strftime("%Y-%m-%d")
-                await db.activity_sync_visitors(date=d)
+            await db.walkin_auto_sync(days)
         except Exception:
             logging.exception("auto sync walkin failed")
         await asyncio.sleep(max(5, int(config.AUTO_SYNC_WALKIN_INTERVAL_SEC)))
 
+async def _partition_maintenance_loop():
+    while True:
+        try:
+            res = await db.records_maintain_partitions()
+            logging.info("records partition maintenance: %s", res)
+        except Exception:
+            logging.exception("records partition maintenance failed")
+        await asyncio.sleep(max(60, int(config.RECORDS_PARTITION_INTERVAL_SEC)))
+
+async def _retention_loop():
+    while True:
+        try:
+            res = await db.records_apply_retention()
+            logging.info("records retention: %s", res)
+        except Exception:
+            logging.exception("records retention failed")
+        await asyncio.sleep(max(60, int(config.RETENTION_INTERVAL_SEC)))
+
+async def _archive_loop():
+    while True:
+        try:
+            res = await db.records_archive_due()
+            logging.info("records archive: %s", res)
+        except Exception:
+            logging.exception("records archive failed")
+        await asyncio.sleep(max(60, int(config.RECORDS_ARCHIVE_INTERVAL_SEC)))
+
+async def _session_purge_loop():
+    while True:
+        try:
+            n = await db.purge_expired_sessions()
+            if n:
+                logging.info("purged %s expired sessions", n)
+        except Exception:
+            logging.exception("session purge failed")
+        await asyncio.sleep(max(60, int(config.SESSION_PURGE_INTERVAL_SEC)))
+
 def _log_import_cleanup(now_ts: float, max_age_sec: int = 3600) -> None:
     expired = []
     for k, v in _LOG_IMPORT_CACHE.items():
         if now_ts - float(v.get("created_at_ts") or 0) > max_age_sec:
             expired.append(k)
     for k in expired:
-        _LOG_IMPORT_CACHE.pop(k, None)
+        _log_import_drop(k)
+
+def _log_import_drop(import_id: str) -> None:
+    ctx = _LOG_IMPORT_CACHE.pop(import_id, None)
+    if ctx and ctx.get("staging") is not None:
+        ctx["staging"].close()
 
 def _coerce_int(v: Any) -> Optional[int]:
     if v is None:
@@ -286,159 +330,318 @@ def _extract_record_from_line(line: str) -> Optional[Dict[str, Any]]:
         "activity_type": "",
     }
 
-def _parse_device_log_text(text: str) -> Dict[str, Any]:
-    records: List[Dict[str, Any]] = []
-    unparsed = 0
-    detected_format = "text"
-
-    s = (text or "").strip()
+# Device-log uploads can be hundreds of MB, so they are never held in memory:
+# the format is picked from a head sample, then the spooled upload is decoded
+# chunk by chunk and parsed records are yielded one at a time.
+
+_LOG_CHUNK_BYTES = 1 << 16
+_LOG_HEAD_BYTES = 1 << 16
+_LOG_SAMPLE_SIZE = 30
+# Characters buffered for a single JSON value before it is given up as corrupt.
+_LOG_JSON_VALUE_MAX = 4 << 20
+
+_CSV_RECORD_FIELDS = {
+    "uuid", "device_uuid",
+    "time", "timestamp", "record_time",
+    "in", "in_count",
+    "out", "out_count",
+    "battery", "battery_level",
+    "btx", "batterytx_level",
+    "signal_strength", "signal_status",
+    "warn_status",
+    "rec_type"
+}
+
+def _iter_text_chunks(fp, size: int = _LOG_CHUNK_BYTES):
+    fp.seek(0)
+    dec = codecs.getincrementaldecoder("utf-8-sig")(errors="ignore")
+    while True:
+        data = fp.read(size)
+        if not data:
+            break
+        s = dec.decode(data)
+        if s:
+            yield s
+    s = dec.decode(b"", final=True)
     if s:
-        if s[0] in "[{":
+        yield s
+
+def _iter_lines(chunks):
+    # Same line breaks as str.splitlines; only the unfinished tail is carried over.
+    buf = ""
+    for chunk in chunks:
+        parts = (buf + chunk).splitlines(True)
+        buf = ""
+        if parts and parts[-1].splitlines()[0] == parts[-1]:
+            buf = parts.pop()
+        for p in parts:
+            yield p.splitlines()[0]
+    if buf:
+        yield buf
+
+class _JsonStream:
+    """Reads consecutive JSON values off a stream of text chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._dec = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+
+    def _fill(self, want: int = 0) -> bool:
+        """Reads one chunk, or more until `want` characters are buffered; False at the end."""
+        parts = [self.buf[self.pos:]]
+        have = len(parts[0])
+        while len(parts) == 1 or have < want:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            have += len(chunk)
+        if len(parts) == 1:
+            return False
+        self.buf = "".join(parts)
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Next non-blank character without consuming it; "" at the end."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ""
+
+    def take(self) -> str:
+        c = self.peek()
+        self.pos += len(c)
+        return c
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
             try:
-                obj = json.loads(s)
-                detected_format = "json"
-                if isinstance(obj, list):
-                    for item in obj:
-                        rec = _extract_record_from_obj(item)
-                        if rec:
-                            records.append(rec)
-                        else:
-                            unparsed += 1
-                elif isinstance(obj, dict):
-                    data = obj.get("data") if "data" in obj else obj.get("items")
-                    if isinstance(data, list):
-                        for item in data:
-                            rec = _extract_record_from_obj(item)
-                            if rec:
-                                records.append(rec)
-                            else:
-                                unparsed += 1
-                    else:
-                        rec = _extract_record_from_obj(obj)
-                        if rec:
-                            records.append(rec)
-                        else:
-                            unparsed += 1
-                return {"records": records, "unparsed": unparsed, "detected_format": detected_format}
-            except Exception:
-                pass
-
-    lines = text.splitlines()
-    if lines:
-        head = "\n".join(lines[:80])
-        if "xml=<UP_SENSOR_DATA_" in head:
-            detected_format = "log"
-            for line in lines:
-                rec = _extract_record_from_line(line)
-                if rec:
-                    records.append(rec)
-                else:
-                    if line.strip():
-                        unparsed += 1
-            return {"records": records, "unparsed": unparsed, "detected_format": detected_format}
-
-        ndjson_like = 0
-        ndjson_try = 0
-        for ln in lines[:200]:
-            t = ln.strip()
-            if not t:
+                obj, end = self._dec.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # Incomplete or corrupt: double what is buffered before trying
+                # again, so a long value is re-scanned O(log n) times, and give
+                # up once one value outgrows _LOG_JSON_VALUE_MAX.
+                pending = len(self.buf) - self.pos
+                if pending > _LOG_JSON_VALUE_MAX or not self._fill(min(2 * pending, _LOG_JSON_VALUE_MAX + 1)):
+                    raise
                 continue
-            ndjson_try += 1
-            if t.startswith("{") and t.endswith("}"):
-                ndjson_like += 1
-        if ndjson_try >= 3 and ndjson_like / max(1, ndjson_try) >= 0.8:
-            detected_format = "jsonl"
-            for ln in lines:
-                t = ln.strip()
-                if not t:
-                    continue
-                try:
-                    obj = json.loads(t)
-                    rec = _extract_record_from_obj(obj)
-                    if rec:
-                        records.append(rec)
-                    else:
-                        unparsed += 1
-                except Exception:
-                    unparsed += 1
-            return {"records": records, "unparsed": unparsed, "detected_format": detected_format}
+            # A number at the end of the buffer may continue in the next chunk.
+            if end >= len(self.buf) and not isinstance(obj, (dict, list, str)) and self._fill():
+                continue
+            self.pos = end
+            return obj
 
+def _iter_json_array(st: _JsonStream):
+    if st.peek() == "]":
+        st.take()
+        return
+    while True:
+        yield st.value()
+        if st.take() != ",":
+            return
+
+def _iter_json_items(chunks):
+    """Items of a JSON list, of the "data"/"items" list of an object, or the object itself."""
+    st = _JsonStream(chunks)
+    if st.take() == "[":
+        yield from _iter_json_array(st)
+        return
+    obj = {}
+    if st.peek() != "}":
+        while True:
+            key = st.value()
+            st.take()
+            if key in ("data", "items") and st.peek() == "[":
+                st.take()
+                yield from _iter_json_array(st)
+                return
+            obj[key] = st.value()
+            if st.take() != ",":
+                break
+    yield obj
+
+def _csv_has_record_header(fieldnames) -> bool:
+    names = set(re.sub(r"\s+", "", str(fn)).lower() for fn in fieldnames or [] if fn)
+    hits = names & _CSV_RECORD_FIELDS
+    return bool(hits & {"uuid", "device_uuid"}) and bool(hits & {"time", "timestamp", "record_time"})
+
+def _detect_device_log_format(head: str, complete: bool):
+    """
+    (format, csv dialect) from the first _LOG_HEAD_BYTES of an upload; complete
+    says whether that is the whole file. CSV is only chosen when a head row
+    actually parses.
+    """
+    s = head.strip()
+    if s and s[0] in "[{":
         try:
-            sample = "\n".join(lines[:20])
-            dialect = csv.Sniffer().sniff(sample, delimiters=",\t;|")
-            reader = csv.DictReader(lines, dialect=dialect)
-            if reader.fieldnames:
-                names = []
-                for fn in reader.fieldnames:
-                    if not fn:
-                        continue
-                    n = re.sub(r"\s+", "", str(fn)).lower()
-                    names.append(n)
-
-                expected = {
-                    "uuid", "device_uuid",
-                    "time", "timestamp", "record_time",
-                    "in", "in_count",
-                    "out", "out_count",
-                    "battery", "battery_level",
-                    "btx", "batterytx_level",
-                    "signal_strength", "signal_status",
-                    "warn_status",
-                    "rec_type"
-                }
-                hits = set([n for n in names if n in expected])
-                looks_like_csv = (("uuid" in hits or "device_uuid" in hits) and ("time" in hits or "timestamp" in hits or "record_time" in hits))
-            else:
-                looks_like_csv = False
-
-            if looks_like_csv:
-                detected_format = "csv"
-                parsed_any = False
-                for row in reader:
-                    rec = _extract_record_from_obj(row)
-                    if rec:
-                        records.append(rec)
-                        parsed_any = True
-                    else:
-                        unparsed += 1
-                if parsed_any:
-                    return {"records": records, "unparsed": unparsed, "detected_format": detected_format}
-                records = []
-                unparsed = 0
-                detected_format = "text"
-        except Exception:
-            pass
+            _, end = json.JSONDecoder().raw_decode(s)
+            if not s[end:].strip():
+                return "json", None
+        except json.JSONDecodeError as e:
+            # An error on the last, cut-off line of the head is just the sample
+            # ending mid-document; one earlier (say a bad first JSONL line)
+            # means this is not a single JSON document.
+            if not complete and "\n" not in s[e.pos:]:
+                return "json", None
+
+    lines = head.splitlines()
+    if not complete and len(lines) > 1:
+        lines.pop()
+    if "xml=<UP_SENSOR_DATA_" in "\n".join(lines[:80]):
+        return "log", None
+
+    tried = [ln.strip() for ln in lines[:200] if ln.strip()]
+    ndjson_like = sum(1 for t in tried if t.startswith("{") and t.endswith("}"))
+    if len(tried) >= 3 and ndjson_like / max(1, len(tried)) >= 0.8:
+        return "jsonl", None
 
+    try:
+        dialect = csv.Sniffer().sniff("\n".join(lines[:20]), delimiters=",\t;|")
+    except Exception:
+        return "text", None
+    try:
+        reader = csv.DictReader(lines, dialect=dialect)
+        if _csv_has_record_header(reader.fieldnames) and any(_extract_record_from_obj(row) for row in reader):
+            return "csv_header", dialect
+    except Exception:
+        pass
+    try:
+        if any(_extract_record_from_csv_row(row) for row in csv.reader(lines, dialect=dialect)):
+            return "csv", dialect
+    except Exception:
+        pass
+    return "text", None
+
+def _iter_device_log(fp, stats: Dict[str, Any]):
+    """
+    Records parsed from a device-log upload (a binary file object), one at a
+    time. stats receives detected_format and the running unparsed count.
+    """
+    fp.seek(0)
+    raw = fp.read(_LOG_HEAD_BYTES)
+    head = raw.decode("utf-8-sig", errors="ignore")
+    fmt, dialect = _detect_device_log_format(head, len(raw) < _LOG_HEAD_BYTES)
+    stats["detected_format"] = "csv" if fmt == "csv_header" else fmt
+    stats["unparsed"] = 0
+
+    if fmt == "json":
         try:
-            sample = "\n".join(lines[:20])
-            dialect = csv.Sniffer().sniff(sample, delimiters=",\t;|")
-            csv_reader = csv.reader(lines, dialect=dialect)
-            parsed_any = False
-            for row in csv_reader:
-                rec = _extract_record_from_csv_row(row)
+            for item in _iter_json_items(_iter_text_chunks(fp)):
+                rec = _extract_record_from_obj(item)
                 if rec:
-                    records.append(rec)
-                    parsed_any = True
+                    yield rec
                 else:
-                    if any(str(c).strip() for c in row):
-                        unparsed += 1
-            if parsed_any:
-                detected_format = "csv"
-                return {"records": records, "unparsed": unparsed, "detected_format": detected_format}
-            records = []
-            unparsed = 0
-        except Exception:
-            pass
-
-    for line in lines:
-        rec = _extract_record_from_line(line)
-        if rec:
-            records.append(rec)
-        else:
-            if line.strip():
-                unparsed += 1
+                    stats["unparsed"] += 1
+        except json.JSONDecodeError:
+            # Truncated or corrupt document: keep what parsed so far.
+            stats["unparsed"] += 1
+        return
+
+    lines = _iter_lines(_iter_text_chunks(fp))
+    if fmt == "jsonl":
+        for ln in lines:
+            t = ln.strip()
+            if not t:
+                continue
+            try:
+                rec = _extract_record_from_obj(json.loads(t))
+            except Exception:
+                rec = None
+            if rec:
+                yield rec
+            else:
+                stats["unparsed"] += 1
+    elif fmt == "csv_header":
+        for row in csv.DictReader(lines, dialect=dialect):
+            rec = _extract_record_from_obj(row)
+            if rec:
+                yield rec
+            else:
+                stats["unparsed"] += 1
+    elif fmt == "csv":
+        for row in csv.reader(lines, dialect=dialect):
+            rec = _extract_record_from_csv_row(row)
+            if rec:
+                yield rec
+            elif any(str(c).strip() for c in row):
+                stats["unparsed"] += 1
+    else:
+        for line in lines:
+            rec = _extract_record_from_line(line)
+            if rec:
+                yield rec
+            elif line.strip():
+                stats["unparsed"] += 1
+
+def _stage_device_log(fp) -> Dict[str, Any]:
+    """
+    Parses an upload into a temporary JSONL staging file, one record per
+    line, collecting the per-device summary and a sample on the way.
+    Blocking; run it in a thread.
+    """
+    import tempfile
+    stats: Dict[str, Any] = {}
+    staging = tempfile.TemporaryFile()
+    per_device: Dict[str, Dict[str, Any]] = {}
+    sample: List[Dict[str, Any]] = []
+    total = 0
+    try:
+        for r in _iter_device_log(fp, stats):
+            staging.write((json.dumps(r, ensure_ascii=False) + "\n").encode("utf-8"))
+            total += 1
+            if len(sample) < _LOG_SAMPLE_SIZE:
+                sample.append(r)
+            u = r.get("uuid")
+            t = r.get("time")
+            if not u or not t:
+                continue
+            if u not in per_device:
+                per_device[u] = {"uuid": u, "count": 0, "start": t, "end": t}
+            per_device[u]["count"] += 1
+            if t < per_device[u]["start"]:
+                per_device[u]["start"] = t
+            if t > per_device[u]["end"]:
+                per_device[u]["end"] = t
+        staging.flush()
+    except BaseException:
+        staging.close()
+        raise
+    return {
+        "staging": staging,
+        "total": total,
+        "per_device": per_device,
+        "sample": sample,
+        "detected_format": stats.get("detected_format") or "text",
+        "unparsed": stats.get("unparsed") or 0,
+    }
 
-    return {"records": records, "unparsed": unparsed, "detected_format": detected_format}
+def _read_staged_records(ctx: Dict[str, Any], offset: int, limit: int) -> List[Dict[str, Any]]:
+    # Batches normally arrive in order, so reading resumes from the byte
+    # position the previous batch stopped at; any other offset rescans.
+    f = ctx["staging"]
+    if offset == ctx.get("offset", 0):
+        f.seek(ctx.get("pos", 0))
+    else:
+        f.seek(0)
+        for _ in range(offset):
+            if not f.readline():
+                break
+    out = []
+    for _ in range(limit):
+        line = f.readline()
+        if not line:
+            break
+        out.append(json.loads(line))
+    ctx["pos"] = f.tell()
+    ctx["offset"] = offset + len(out)
+    return out
 
 app.add_middleware(
     CORSMiddleware,
@@ -454,13 +657,21 @@ async def startup_event():
         await db.init_sqlite()
     else:
         await db.init_pool()
-    global _AUTO_SYNC_TASK
+    global _AUTO_SYNC_TASK, _PARTITION_TASK, _RETENTION_TASK, _ARCHIVE_TASK, _SESSION_PURGE_TASK
     if config.AUTO_SYNC_WALKIN_ENABLE and _AUTO_SYNC_TASK is None:
         _AUTO_SYNC_TASK = asyncio.create_task(_auto_sync_walkin_loop())
+    if config.RECORDS_PARTITION_ENABLE and _PARTITION_TASK is None:
+        _PARTITION_TASK = asyncio.create_task(_partition_maintenance_loop())
+    if config.RETENTION_ENABLE and _RETENTION_TASK is None:
+        _RETENTION_TASK = asyncio.create_task(_retention_loop())
+    if config.RECORDS_ARCHIVE_ENABLE and _ARCHIVE_TASK is None:
+        _ARCHIVE_TASK = asyncio.create_task(_archive_loop())
+    if config.SESSION_PURGE_INTERVAL_SEC > 0 and _SESSION_PURGE_TASK is None:
+        _SESSION_PURGE_TASK = asyncio.create_task(_session_purge_loop())
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    global _AUTO_SYNC_TASK
+    global _AUTO_SYNC_TASK, _PARTITION_TASK, _RETENTION_TASK, _ARCHIVE_TASK, _SESSION_PURGE_TASK
     if _AUTO_SYNC_TASK is not None:
         _AUTO_SYNC_TASK.cancel()
         try:
@@ -468,6 +679,34 @@ async def shutdown_event():
         except BaseException:
             pass
         _AUTO_SYNC_TASK = None
+    if _PARTITION_TASK is not None:
+        _PARTITION_TASK.cancel()
+        try:
+            await _PARTITION_TASK
+        except BaseException:
+            pass
+        _PARTITION_TASK = None
+    if _RETENTION_TASK is not None:
+        _RETENTION_TASK.cancel()
+        try:
+            await _RETENTION_TASK
+        except BaseException:
+            pass
+        _RETENTION_TASK = None
+    if _ARCHIVE_TASK is not None:
+        _ARCHIVE_TASK.cancel()
+        try:
+            await _ARCHIVE_TASK
+        except BaseException:
+            pass
+        _ARCHIVE_TASK = None
+    if _SESSION_PURGE_TASK is not None:
+        _SESSION_PURGE_TASK.cancel()
+        try:
+            await _SESSION_PURGE_TASK
+        except BaseException:
+            pass
+        _SESSION_PURGE_TASK = None
     await db.close_pool()
 
 # --- Auth ---
@@ -646,6 +885,17 @@ async def devices():
 async def alerts():
     return FileResponse("templates/alerts.html")
 
+async def _etag_response(request: Request, load):
+    """
+    Conditional GET for a payload the db layer caches per version: load()
+    returns (payload, etag), the etag changing whenever that version does.
+    """
+    data, etag = await load()
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(data, headers=headers)
+
 # --- Records ---
 
 @app.get("/api/v1/records/latest")
@@ -666,8 +916,8 @@ async def get_records_history(
 # --- Activity API ---
 
 @app.get("/api/v1/activity/options")
-async def activity_options():
-    return await db.activity_get_options()
+async def activity_options(request: Request):
+    return await _etag_response(request, db.activity_get_options_tagged)
 
 @app.get("/api/v1/activity/events")
 async def activity_events(
@@ -806,7 +1056,10 @@ async def walkin_preview(payload: Dict[str, Any] = Body(...)):
     devices = payload.get("devices", [])
     start = payload.get("start")
     end = payload.get("end")
-    items = await db.walkin_preview(devices, start, end)
+    try:
+        items = await db.walkin_preview(devices, start, end, payload.get("bucket_minutes"))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
     return {"items": items}
 
 @app.get("/api/v1/activity/walkin/dates")
@@ -825,7 +1078,10 @@ async def walkin_dates(
 async def walkin_preview_dates(payload: Dict[str, Any] = Body(...)):
     devices = payload.get("devices", [])
     dates = payload.get("dates", [])
-    items = await db.walkin_preview_by_dates(devices, dates)
+    try:
+        items = await db.walkin_preview_by_dates(devices, dates, payload.get("bucket_minutes"))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
     return {"items": items}
 
 @app.post("/api/v1/activity/walkin/sync")
@@ -871,12 +1127,12 @@ async def list_devices():
     return await db.list_devices()
 
 @app.get("/api/v1/devices/mapping")
-async def get_device_mapping():
-    return await db.get_device_mapping()
+async def get_device_mapping(request: Request):
+    return await _etag_response(request, db.get_device_mapping_tagged)
 
 @app.get("/api/v1/device/mapping")
-async def get_device_mapping_singular():
-    return await db.get_device_mapping()
+async def get_device_mapping_singular(request: Request):
+    return await _etag_response(request, db.get_device_mapping_tagged)
 
 # --- Alerts ---
 
@@ -896,23 +1152,38 @@ async def admin_list_records(
     warn: Optional[int] = None,
     rec_type: Optional[int] = None,
     btx_min: Optional[int] = None,
-    btx_max: Optional[int] = None
+    btx_max: Optional[int] = None,
+    count: bool = True,
+    estimate: bool = False
 ):
     items = await db.admin_list_records(page, size, uuid, start, end, warn, rec_type, btx_min, btx_max)
+    if not count:
+        return {"items": items, "total": None}
+    total = None
+    if estimate:
+        total = await db.admin_estimate_records(uuid, start, end, warn, rec_type, btx_min, btx_max)
+    if total is not None:
+        return {"items": items, "total": total, "estimated": True}
     total = await db.admin_count_records(uuid, start, end, warn, rec_type, btx_min, btx_max)
     return {"items": items, "total": total}
 
 @app.post("/api/v1/admin/records")
 async def admin_create_record(data: Dict[str, Any] = Body(...)):
-    await db.admin_create_record(data)
+    try:
+        await db.admin_create_record(data)
+    except db.RecordConflict as e:
+        raise HTTPException(409, str(e))
     return {"status": "ok"}
 
 @app.put("/api/v1/admin/records/{id}")
 async def admin_update_record(id: int, data: Dict[str, Any] = Body(...)):
-    await db.admin_update_record(id, data)
+    try:
+        await db.admin_update_record(id, data)
+    except db.RecordConflict as e:
+        raise HTTPException(409, str(e))
     return {"status": "ok"}
 
-@app.delete("/api/v1/admin/records/{id}")
+@app.delete("/api/v1/admin/records/{id:int}")
 async def admin_delete_record(id: int):
     await db.admin_delete_record(id)
     return {"status": "ok"}
@@ -921,20 +1192,33 @@ async def admin_delete_record(id: int):
 async def admin_batch_save_records(payload: Dict[str, Any] = Body(...)):
     creates = payload.get("creates", [])
     updates = payload.get("updates", [])
-    await db.admin_batch_save_records(creates, updates)
+    try:
+        await db.admin_batch_save_records(creates, updates)
+    except db.RecordConflict as e:
+        raise HTTPException(409, str(e))
     return {"status": "ok"}
 
 @app.post("/api/v1/admin/records/batch-update")
 async def admin_batch_update(payload: Dict[str, Any] = Body(...)):
     ids = payload.get("ids", [])
     updates = payload.get("updates", {})
-    await db.admin_batch_update(ids, updates)
+    try:
+        await db.admin_batch_update(ids, updates)
+    except db.RecordConflict as e:
+        raise HTTPException(409, str(e))
     return {"status": "ok"}
 
 @app.delete("/api/v1/admin/records/range")
 async def admin_delete_range(start: str, end: str):
-    await db.admin_delete_range(start, end)
-    return {"status": "ok"}
+    job = db.start_delete_range_job(_normalize_time(start) or start, _normalize_time(end) or end)
+    return {"status": "ok", "job": job}
+
+@app.get("/api/v1/admin/records/delete-jobs/{job_id}")
+async def admin_delete_job_status(job_id: str):
+    job = db.get_delete_job(job_id)
+    if not job:
+        raise HTTPException(404, "job not found")
+    return job
 
 @app.get("/api/v1/admin/records/ids")
 async def admin_get_record_ids(
@@ -945,20 +1229,157 @@ async def admin_get_record_ids(
     ids = await db.admin_get_record_ids(uuid, start, end)
     return {"ids": ids}
 
+_EXPORT_COLUMNS = ["id", "uuid", "time", "in_count", "out_count", "battery", "btx", "rec_type",
+                   "signal_strength", "warn_status", "activity_type", "created_at"]
+_XLSX_MAX_ROWS = 1048576
+
+async def _export_csv(chunks):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    # BOM so Excel picks UTF-8 for Chinese device names.
+    buf.write("\ufeff")
+    writer.writerow(_EXPORT_COLUMNS)
+    async for rows in chunks:
+        for r in rows:
+            writer.writerow(["" if r.get(c) is None else r.get(c) for c in _EXPORT_COLUMNS])
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+async def _export_ndjson(chunks):
+    async for rows in chunks:
+        yield "".join(
+            json.dumps({c: r.get(c) for c in _EXPORT_COLUMNS}, ensure_ascii=False, default=str) + "\n"
+            for r in rows
+        ).encode("utf-8")
+
+async def _export_xlsx(chunks, workbook_cls):
+    # Write-only sheets spill rows to temp files; the finished zip is
+    # spooled to disk and streamed, so memory stays flat.
+    import tempfile
+    wb = workbook_cls(write_only=True)
+    state = {"ws": None, "n": 0, "sheet": 0}
+
+    def append(rows):
+        for r in rows:
+            if state["ws"] is None or state["n"] >= _XLSX_MAX_ROWS:
+                state["sheet"] += 1
+                state["ws"] = wb.create_sheet(f"records{state['sheet'] if state['sheet'] > 1 else ''}")
+                state["ws"].append(_EXPORT_COLUMNS)
+                state["n"] = 1
+            state["ws"].append([r.get(c) for c in _EXPORT_COLUMNS])
+            state["n"] += 1
+
+    async for rows in chunks:
+        await asyncio.to_thread(append, rows)
+    if state["ws"] is None:
+        wb.create_sheet("records").append(_EXPORT_COLUMNS)
+    tmp = tempfile.TemporaryFile()
+    try:
+        await asyncio.to_thread(wb.save, tmp)
+        tmp.seek(0)
+        while True:
+            data = await asyncio.to_thread(tmp.read, 1 << 16)
+            if not data:
+                break
+            yield data
+    finally:
+        tmp.close()
+
+@app.get("/api/v1/admin/records/export")
+async def admin_export_records(
+    format: str = "csv",
+    uuid: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    warn: Optional[int] = None,
+    rec_type: Optional[int] = None,
+    btx_min: Optional[int] = None,
+    btx_max: Optional[int] = None
+):
+    fmt = (format or "csv").lower()
+    chunks = db.admin_iter_records(uuid, start, end, warn, rec_type, btx_min, btx_max)
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    if fmt == "csv":
+        body, media, ext = _export_csv(chunks), "text/csv; charset=utf-8", "csv"
+    elif fmt in ("ndjson", "jsonl"):
+        body, media, ext = _export_ndjson(chunks), "application/x-ndjson", "ndjson"
+    elif fmt == "xlsx":
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise HTTPException(500, "Missing libraries (openpyxl)")
+        body = _export_xlsx(chunks, Workbook)
+        media, ext = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"
+    else:
+        raise HTTPException(400, "format must be csv, ndjson or xlsx")
+    return StreamingResponse(
+        body,
+        media_type=media,
+        headers={"Content-Disposition": f'attachment; filename="records_{stamp}.{ext}"'},
+    )
+
 @app.post("/api/v1/admin/records/batch-delete")
 async def admin_batch_delete(payload: Dict[str, Any] = Body(...)):
     ids = payload.get("ids", [])
-    await db.admin_batch_delete(ids)
+    job = db.start_batch_delete_job(ids)
+    return {"status": "ok", "job": job}
+
+@app.get("/api/v1/admin/records/partitions")
+async def admin_list_record_partitions():
+    return {"partitions": await db.records_list_partitions()}
+
+@app.post("/api/v1/admin/records/partitions/maintain")
+async def admin_maintain_record_partitions():
+    return await db.records_maintain_partitions()
+
+@app.delete("/api/v1/admin/records/partitions/{month}")
+async def admin_drop_record_partition(month: str):
+    try:
+        await db.records_drop_month(month)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"status": "ok"}
+
+@app.get("/api/v1/admin/ingest/journal")
+async def admin_ingest_journal_status():
+    # Written by tcp_server; read from disk so it works across processes.
+    return await asyncio.to_thread(journal.status)
+
+@app.get("/api/v1/admin/records/archive")
+async def admin_list_record_archive():
+    return {"months": await db.records_list_archive()}
+
+@app.post("/api/v1/admin/records/archive/run")
+async def admin_run_record_archive():
+    return await db.records_archive_due()
+
+@app.post("/api/v1/admin/records/archive/{month}")
+async def admin_archive_record_month(month: str):
+    try:
+        return await db.records_archive_month(month)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+@app.get("/api/v1/admin/db/query-stats")
+async def admin_query_stats():
+    return db.query_stats()
+
+@app.post("/api/v1/admin/db/query-stats/reset")
+async def admin_reset_query_stats():
+    db.reset_query_stats()
     return {"status": "ok"}
 
+@app.post("/api/v1/admin/retention/run")
+async def admin_run_retention():
+    return await db.records_apply_retention()
+
 @app.post("/api/v1/admin/device-log/preview")
 async def admin_device_log_preview(file: UploadFile = File(...)):
-    contents = await file.read()
-    text = contents.decode("utf-8-sig", errors="ignore")
-
-    parsed = _parse_device_log_text(text)
-    records: List[Dict[str, Any]] = parsed.get("records") or []
-    detected_format = str(parsed.get("detected_format") or "")
+    staged = await asyncio.to_thread(_stage_device_log, file.file)
+    detected_format = str(staged.get("detected_format") or "")
     filename = file.filename or ""
     ext = ""
     if "." in filename:
@@ -973,19 +1394,7 @@ async def admin_device_log_preview(file: UploadFile = File(...)):
     _log_import_cleanup(now_ts)
     import_id = uuidlib.uuid4().hex
 
-    per_device: Dict[str, Dict[str, Any]] = {}
-    for r in records:
-        u = r.get("uuid")
-        t = r.get("time")
-        if not u or not t:
-            continue
-        if u not in per_device:
-            per_device[u] = {"uuid": u, "count": 0, "start": t, "end": t}
-        per_device[u]["count"] += 1
-        if t < per_device[u]["start"]:
-            per_device[u]["start"] = t
-        if t > per_device[u]["end"]:
-            per_device[u]["end"] = t
+    per_device: Dict[str, Dict[str, Any]] = staged["per_device"]
 
     mapping_res = await db.get_device_mapping()
     mapping = (mapping_res or {}).get("mapping") or {}
@@ -1005,8 +1414,8 @@ async def admin_device_log_preview(file: UploadFile = File(...)):
 
     _LOG_IMPORT_CACHE[import_id] = {
         "created_at_ts": now_ts,
-        "records": records,
-        "total": len(records),
+        "staging": staged["staging"],
+        "total": staged["total"],
         "filename": file.filename,
     }
 
@@ -1014,9 +1423,9 @@ async def admin_device_log_preview(file: UploadFile = File(...)):
         "import_id": import_id,
         "filename": file.filename,
         "detected_format": detected_format,
-        "total_records": len(records),
+        "total_records": staged["total"],
         "devices": devices,
-        "sample": records[:30],
+        "sample": staged["sample"],
     }
 
 @app.post("/api/v1/admin/device-log/import")
@@ -1039,53 +1448,23 @@ async def admin_device_log_import(payload: Dict[str, Any] = Body(...)):
     if not ctx:
         raise HTTPException(404, "Import session not found")
 
-    records: List[Dict[str, Any]] = ctx.get("records") or []
-    total = int(ctx.get("total") or len(records))
+    total = int(ctx.get("total") or 0)
 
-    chunk = records[offset: offset + limit]
+    chunk = await asyncio.to_thread(_read_staged_records, ctx, offset, limit)
     if not chunk:
-        _LOG_IMPORT_CACHE.pop(import_id, None)
+        _log_import_drop(import_id)
         return {"imported": 0, "offset": offset, "next_offset": offset, "total": total, "done": True}
 
-    by_uuid: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
-    for r in chunk:
-        u = r.get("uuid")
-        t = r.get("time")
-        if u and t:
-            by_uuid[u].append(r)
-
-    creates: List[Dict[str, Any]] = []
-    updates: List[Dict[str, Any]] = []
-
-    for u, items in by_uuid.items():
-        times = [it.get("time") for it in items if it.get("time")]
-        id_map = await db.admin_get_record_id_map_by_times(u, times)
-        for it in items:
-            t = it.get("time")
-            existing_id = id_map.get(t)
-            if existing_id:
-                updates.append({
-                    "id": existing_id,
-                    "in_count": it.get("in_count"),
-                    "out_count": it.get("out_count"),
-                    "battery": it.get("battery"),
-                    "btx": it.get("btx"),
-                    "rec_type": it.get("rec_type"),
-                    "signal_strength": it.get("signal_strength"),
-                    "warn_status": it.get("warn_status"),
-                    "activity_type": it.get("activity_type") or ""
-                })
-            else:
-                creates.append(it)
-
-    ok = await db.admin_batch_save_records(creates, updates)
-    if ok is False:
+    try:
+        await db.records_upsert(chunk)
+    except Exception as e:
+        logging.error(f"Device log import failed: {e}")
         raise HTTPException(500, "Batch save failed")
 
     next_offset = offset + len(chunk)
     done = next_offset >= total
     if done:
-        _LOG_IMPORT_CACHE.pop(import_id, None)
+        _log_import_drop(import_id)
 
     return {
         "imported": len(chunk),
@@ -1110,6 +1489,13 @@ async def admin_upsert_registry(data: Dict[str, Any] = Body(...)):
     await db.admin_upsert_registry(uuid, name, category)
     return {"status": "ok"}
 
+@app.post("/api/v1/admin/registry/batch")
+async def admin_batch_upsert_registry(data: Dict[str, Any] = Body(...)):
+    items = data.get("items") or []
+    if not isinstance(items, list): raise HTTPException(400, "items must be a list")
+    count = await db.admin_batch_upsert([i for i in items if isinstance(i, dict)])
+    return {"status": "ok", "count": count}
+
 # --- Academies ---
 
 @app.get("/api/v1/academies")
@@ -1159,10 +1545,6 @@ async def activity_list(
         start_date, end_date, loc_list, type_list, aca_list, wd_list, time_list, page, page_size
     )
 
-@app.get("/api/v1/activity/options")
-async def activity_options():
-    return await db.activity_get_options()
-
 @app.get("/api/v1/activity/stats")
 async def activity_stats(
     start_date: Optional[str] = None,
@@ -1191,6 +1573,27 @@ async def api_activity_sync_visitors(payload: Dict[str, Any] = Body(...)):
         return res
     return {"count": int(res or 0), "skipped": []}
 
+@app.post("/api/v1/activity/sync-visitors/jobs")
+async def api_start_walkin_sync_job(payload: Dict[str, Any] = Body(...)):
+    """Full-history walk-in sync in the background; poll the returned job."""
+    devices = payload.get("devices") or None
+    mode = payload.get("mode") or "overwrite"
+    return db.start_walkin_sync_job(devices, mode)
+
+@app.get("/api/v1/activity/sync-visitors/jobs/{job_id}")
+async def api_walkin_sync_job_status(job_id: str):
+    job = db.get_walkin_sync_job(job_id)
+    if not job:
+        raise HTTPException(404, "job not found")
+    return job
+
+@app.post("/api/v1/activity/sync-visitors/jobs/{job_id}/cancel")
+async def api_cancel_walkin_sync_job(job_id: str):
+    job = db.cancel_walkin_sync_job(job_id)
+    if not job:
+        raise HTTPException(404, "job not found")
+    return job
+
 @app.delete("/api/v1/activity/{id}")
 async def api_activity_delete(id: int):
     success = await db.activity_delete(id)
@@ -1386,12 +1789,12 @@ async def auto_correct_scan():
 
 @app.post("/api/v1/locations/batch-correct")
 async def batch_correct(payload: Dict[str, Any] = Body(...)):
-    corrections = payload.get("corrections", [])
-    total = 0
-    for item in corrections:
+    corrections = []
+    for item in payload.get("corrections", []):
         t = item.get("target")
         a = item.get("academy")
         s = item.get("sources", [])
         if t and a and s:
-            total += await db.correct_location_data(t, a, s)
-    return {"count": total}
+            corrections.append((t, a, s))
+    targets = await db.correct_locations_batch(corrections) if corrections else {}
+    return {"count": sum(targets.values()), "targets": targets}
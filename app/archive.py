@@ -0,0 +1,317 @@
+"""
+Columnar archive of finished months of `records`.
+
+One file per device and month: <RECORDS_ARCHIVE_DIR>/<YYYYMM>/<uuid>.parquet
+(pyarrow) or .npz (NumPy fallback). Everything here is blocking file I/O;
+app.db calls it through asyncio.to_thread.
+"""
+import os
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except Exception:
+    pa = None
+    pq = None
+
+from . import config
+from . import walkin
+
+COLUMNS = ["id", "uuid", "time", "in_count", "out_count", "battery", "btx", "rec_type",
+           "signal_strength", "warn_status", "activity_type", "created_at"]
+_TEXT = {"uuid", "activity_type", "created_at"}
+_EXTS = (".parquet", ".npz")
+
+def _root() -> str:
+    return config.RECORDS_ARCHIVE_DIR
+
+def _safe(uuid) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(uuid or "")) or "_"
+
+def _ts(v):
+    if v is None or v == "":
+        return None
+    try:
+        return np.datetime64(str(v).strip().replace(" ", "T"), "s")
+    except Exception:
+        return None
+
+def _fmt_time(v) -> Optional[str]:
+    if np.isnat(v):
+        return None
+    return str(v).replace("T", " ")
+
+def months() -> List[str]:
+    root = _root()
+    if not os.path.isdir(root):
+        return []
+    return sorted(d for d in os.listdir(root) if re.fullmatch(r"\d{6}", d) and os.path.isdir(os.path.join(root, d)))
+
+def month_files(key: str) -> Dict[str, str]:
+    """uuid-ish file stem -> path for one month."""
+    d = os.path.join(_root(), key)
+    out = {}
+    if not os.path.isdir(d):
+        return out
+    for name in os.listdir(d):
+        stem, ext = os.path.splitext(name)
+        if ext in _EXTS:
+            out[stem] = os.path.join(d, name)
+    return out
+
+def _columns_from_rows(rows: List[dict]) -> Dict[str, np.ndarray]:
+    cols = {}
+    for c in COLUMNS:
+        vals = [r.get(c) for r in rows]
+        if c == "time":
+            cols[c] = np.array([_ts(v) if v is not None else np.datetime64("NaT") for v in vals], dtype="datetime64[s]")
+        elif c in _TEXT:
+            cols[c] = np.array(["" if v is None else str(v) for v in vals], dtype=str)
+        else:
+            cols[c] = np.array([np.nan if v is None else float(v) for v in vals], dtype="float64")
+    return cols
+
+def _read(path: str) -> Dict[str, np.ndarray]:
+    if path.endswith(".npz"):
+        with np.load(path, allow_pickle=False) as z:
+            return {c: z[c] for c in COLUMNS}
+    if pq is None:
+        raise RuntimeError(f"pyarrow is required to read {path}")
+    table = pq.read_table(path)
+    cols = {}
+    for c in COLUMNS:
+        arr = table.column(c).to_numpy(zero_copy_only=False)
+        if c == "time":
+            cols[c] = arr.astype("datetime64[s]")
+        elif c in _TEXT:
+            cols[c] = np.array(["" if v is None else str(v) for v in arr], dtype=str)
+        else:
+            cols[c] = arr.astype("float64")
+    return cols
+
+def _write(path_stem: str, cols: Dict[str, np.ndarray]) -> str:
+    if pa is not None:
+        path = path_stem + ".parquet"
+        arrays = {}
+        for c in COLUMNS:
+            v = cols[c]
+            if c == "time":
+                arrays[c] = pa.array(v, type=pa.timestamp("s"), from_pandas=True)
+            elif c in _TEXT:
+                arrays[c] = pa.array([s or None for s in v.tolist()], type=pa.string())
+            else:
+                arrays[c] = pa.array([None if np.isnan(x) else int(x) for x in v.tolist()], type=pa.int64())
+        tmp = path + ".tmp"
+        pq.write_table(pa.table(arrays), tmp, compression="zstd")
+    else:
+        path = path_stem + ".npz"
+        tmp = path_stem + ".tmp.npz"
+        np.savez_compressed(tmp, **cols)
+    os.replace(tmp, path)
+    # Drop the other format if an earlier run wrote it.
+    for ext in _EXTS:
+        other = path_stem + ext
+        if other != path and os.path.exists(other):
+            os.remove(other)
+    return path
+
+def _concat(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    return {c: np.concatenate([p[c] for p in parts]) for c in COLUMNS}
+
+def write_month(key: str, rows: List[dict]) -> int:
+    """
+    Appends rows (dicts with COLUMNS) to the month's files, replacing rows
+    with the same id. Returns the number of files written.
+    """
+    by_uuid: Dict[str, List[dict]] = {}
+    for r in rows:
+        by_uuid.setdefault(_safe(r.get("uuid")), []).append(r)
+    d = os.path.join(_root(), key)
+    os.makedirs(d, exist_ok=True)
+    existing = month_files(key)
+    for stem, part in by_uuid.items():
+        cols = _columns_from_rows(part)
+        if stem in existing:
+            old = _read(existing[stem])
+            keep = ~np.isin(old["id"], cols["id"])
+            cols = _concat([{c: old[c][keep] for c in COLUMNS}, cols])
+        order = np.argsort(cols["time"], kind="stable")
+        _write(os.path.join(d, stem), {c: cols[c][order] for c in COLUMNS})
+    return len(by_uuid)
+
+def delete_month(key: str) -> int:
+    files = month_files(key)
+    for path in files.values():
+        os.remove(path)
+    d = os.path.join(_root(), key)
+    if os.path.isdir(d) and not os.listdir(d):
+        os.rmdir(d)
+    return len(files)
+
+def _month_range(key: str):
+    lo = np.datetime64(f"{key[:4]}-{key[4:]}", "M")
+    return lo.astype("datetime64[s]"), (lo + 1).astype("datetime64[s]")
+
+def months_for(start=None, end=None) -> List[str]:
+    s, e = _ts(start), _ts(end)
+    out = []
+    for key in months():
+        lo, hi = _month_range(key)
+        if s is not None and s >= hi:
+            continue
+        if e is not None and e < lo:
+            continue
+        out.append(key)
+    return out
+
+def _select(key: str, uuids=None, start=None, end=None) -> Optional[Dict[str, np.ndarray]]:
+    files = month_files(key)
+    if uuids:
+        wanted = {_safe(u) for u in uuids}
+        files = {k: v for k, v in files.items() if k in wanted}
+    if not files:
+        return None
+    cols = _concat([_read(p) for p in files.values()])
+    mask = ~np.isnat(cols["time"])
+    if uuids:
+        mask &= np.isin(cols["uuid"], [str(u) for u in uuids])
+    s, e = _ts(start), _ts(end)
+    if s is not None:
+        mask &= cols["time"] >= s
+    if e is not None:
+        mask &= cols["time"] <= e
+    if not mask.any():
+        return None
+    return {c: cols[c][mask] for c in COLUMNS}
+
+def aggregate(by: str, uuids=None, start=None, end=None) -> List[tuple]:
+    """
+    (key, in, out) sums over archived rows. by is "day", "hour" (keys formatted
+    like the SQL stats queries), "uuid" or "total".
+    """
+    acc: Dict[str, List[int]] = {}
+    for key in months_for(start, end):
+        cols = _select(key, uuids, start, end)
+        if cols is None:
+            continue
+        if by == "day":
+            labels = np.datetime_as_string(cols["time"], unit="D")
+        elif by == "uuid":
+            labels = cols["uuid"]
+        elif by == "hour":
+            labels = np.char.add(np.char.replace(np.datetime_as_string(cols["time"], unit="h"), "T", " "), ":00")
+        else:
+            labels = np.full(len(cols["time"]), "total")
+        uniq, inv = np.unique(labels, return_inverse=True)
+        ins = np.bincount(inv, weights=np.nan_to_num(cols["in_count"]), minlength=len(uniq))
+        outs = np.bincount(inv, weights=np.nan_to_num(cols["out_count"]), minlength=len(uniq))
+        for label, i, o in zip(uniq.tolist(), ins.tolist(), outs.tolist()):
+            cur = acc.setdefault(label, [0, 0])
+            cur[0] += int(i)
+            cur[1] += int(o)
+    return [(k, v[0], v[1]) for k, v in sorted(acc.items())]
+
+def walkin_buckets(uuids=None, start=None, end=None, minutes: int = None) -> Dict[tuple, int]:
+    """{(uuid, "YYYY-MM-DD", slot): in_count} over archived rows; see app.walkin."""
+    acc: Dict[tuple, int] = {}
+    for key in months_for(start, end):
+        cols = _select(key, uuids, start, end)
+        if cols is None:
+            continue
+        for k, n in walkin.bin_arrays(cols["uuid"], cols["time"], cols["in_count"], minutes).items():
+            acc[k] = acc.get(k, 0) + n
+    return acc
+
+def first_time(uuids=None, start=None) -> Optional[str]:
+    """Earliest archived time of these devices at or after start; reads months oldest first."""
+    for key in months_for(start, None):
+        cols = _select(key, uuids, start, None)
+        if cols is not None:
+            return _fmt_time(cols["time"].min())
+    return None
+
+def last_time(uuids=None) -> Optional[str]:
+    """Latest archived time of these devices; reads months newest first."""
+    for key in reversed(months()):
+        cols = _select(key, uuids)
+        if cols is not None:
+            return _fmt_time(cols["time"].max())
+    return None
+
+def _to_rows(cols: Dict[str, np.ndarray], idx, columns) -> List[dict]:
+    out = []
+    for i in idx:
+        row = {}
+        for c in columns:
+            v = cols[c][i]
+            if c == "time":
+                row[c] = _fmt_time(v)
+            elif c in _TEXT:
+                row[c] = str(v) or None
+            else:
+                row[c] = None if np.isnan(v) else int(v)
+        out.append(row)
+    return out
+
+def select_sorted(key: str, uuids=None, start=None, end=None, equals=None, ranges=None) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Columns of one month in (time, id) order, or None. equals is {column:
+    value} and ranges {column: (min, max)} with None for an open bound; a
+    missing (NaN) value never matches either.
+    """
+    cols = _select(key, uuids, start, end)
+    if cols is None:
+        return None
+    mask = np.ones(len(cols["time"]), dtype=bool)
+    for c, v in (equals or {}).items():
+        if v is not None:
+            mask &= cols[c] == v
+    for c, (lo, hi) in (ranges or {}).items():
+        if lo is not None:
+            mask &= cols[c] >= lo
+        if hi is not None:
+            mask &= cols[c] <= hi
+    if not mask.any():
+        return None
+    order = np.flatnonzero(mask)
+    order = order[np.lexsort((cols["id"][order], cols["time"][order]))]
+    return {c: cols[c][order] for c in COLUMNS}
+
+def rows_slice(cols: Dict[str, np.ndarray], lo: int, hi: int, columns=None) -> List[dict]:
+    """Rows lo..hi of select_sorted output as dicts."""
+    return _to_rows(cols, range(lo, min(hi, len(cols["time"]))), columns or COLUMNS)
+
+def fetch(uuids=None, start=None, end=None, limit=None, columns=None) -> List[dict]:
+    """Archived rows as dicts; with limit, the newest `limit` rows by time."""
+    columns = columns or COLUMNS
+    keys = months_for(start, end)
+    rows = []
+    if limit is None:
+        for key in keys:
+            cols = _select(key, uuids, start, end)
+            if cols is not None:
+                rows.extend(_to_rows(cols, range(len(cols["time"])), columns))
+        return rows
+
+    for key in reversed(keys):
+        lo, _ = _month_range(key)
+        # Older months cannot beat rows we already hold.
+        if len(rows) >= limit and _ts(rows[-1]["time"]) >= lo:
+            break
+        cols = _select(key, uuids, start, end)
+        if cols is None:
+            continue
+        order = np.argsort(cols["time"], kind="stable")[::-1][:limit]
+        rows.extend(_to_rows(cols, order, columns))
+        rows.sort(key=lambda r: r["time"] or "", reverse=True)
+        del rows[limit:]
+    return rows
+
+def newest_month_end() -> Optional[str]:
+    keys = months()
+    if not keys:
+        return None
+    return _fmt_time(_month_range(keys[-1])[1])
@@ -25,3 +25,55 @@ REC_TYPE_BACKLOG = int(os.getenv("REC_TYPE_BACKLOG", "1"))
 AUTO_SYNC_WALKIN_ENABLE = os.getenv("AUTO_SYNC_WALKIN_ENABLE", "1") == "1"
 AUTO_SYNC_WALKIN_INTERVAL_SEC = int(os.getenv("AUTO_SYNC_WALKIN_INTERVAL_SEC", "1800"))
 AUTO_SYNC_WALKIN_BACKFILL_DAYS = int(os.getenv("AUTO_SYNC_WALKIN_BACKFILL_DAYS", "1"))
+# Optional periodic full recompute of the backfill window, as a safety net
+# behind the records.id / walkin_dirty watermarks; 0 disables it.
+WALKIN_SYNC_FULL_INTERVAL_SEC = int(os.getenv("WALKIN_SYNC_FULL_INTERVAL_SEC", "0"))
+# Width of a walk-in event in minutes: 15, 30 or 60.
+WALKIN_BUCKET_MINUTES = int(os.getenv("WALKIN_BUCKET_MINUTES", "30"))
+# Full-history walk-in sync: days of records bucketed per query, events per write.
+WALKIN_SYNC_WINDOW_DAYS = int(os.getenv("WALKIN_SYNC_WINDOW_DAYS", "31"))
+WALKIN_SYNC_BATCH = int(os.getenv("WALKIN_SYNC_BATCH", "5000"))
+# Walk-in preview results kept per (devices, dates, bucket width, data version).
+WALKIN_PREVIEW_CACHE_SIZE = int(os.getenv("WALKIN_PREVIEW_CACHE_SIZE", "32"))
+WALKIN_PREVIEW_CACHE_TTL_SEC = int(os.getenv("WALKIN_PREVIEW_CACHE_TTL_SEC", "300"))
+
+RECORDS_COUNT_CACHE_TTL_SEC = int(os.getenv("RECORDS_COUNT_CACHE_TTL_SEC", "60"))
+MAPPING_CACHE_TTL_SEC = int(os.getenv("MAPPING_CACHE_TTL_SEC", "300"))
+SESSION_CACHE_TTL_SEC = int(os.getenv("SESSION_CACHE_TTL_SEC", "60"))
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "1024"))
+SESSION_PURGE_INTERVAL_SEC = int(os.getenv("SESSION_PURGE_INTERVAL_SEC", "3600"))
+SESSION_PURGE_BATCH = int(os.getenv("SESSION_PURGE_BATCH", "1000"))
+
+SLOW_QUERY_MS = int(os.getenv("SLOW_QUERY_MS", "500"))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "1") == "1"
+
+RECORDS_PARTITION_ENABLE = os.getenv("RECORDS_PARTITION_ENABLE", "0") == "1"
+RECORDS_PARTITION_HOT_MONTHS = int(os.getenv("RECORDS_PARTITION_HOT_MONTHS", "2"))
+RECORDS_PARTITION_MONTHS_AHEAD = int(os.getenv("RECORDS_PARTITION_MONTHS_AHEAD", "3"))
+RECORDS_PARTITION_INTERVAL_SEC = int(os.getenv("RECORDS_PARTITION_INTERVAL_SEC", "86400"))
+
+RETENTION_ENABLE = os.getenv("RETENTION_ENABLE", "0") == "1"
+RETENTION_RAW_DAYS = int(os.getenv("RETENTION_RAW_DAYS", "180"))
+RETENTION_HOURLY_DAYS = int(os.getenv("RETENTION_HOURLY_DAYS", "0"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "0"))
+RETENTION_INTERVAL_SEC = int(os.getenv("RETENTION_INTERVAL_SEC", "86400"))
+
+RECORDS_ARCHIVE_DIR = os.getenv("RECORDS_ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "archive"))
+RECORDS_ARCHIVE_ENABLE = os.getenv("RECORDS_ARCHIVE_ENABLE", "0") == "1"
+RECORDS_ARCHIVE_AFTER_MONTHS = int(os.getenv("RECORDS_ARCHIVE_AFTER_MONTHS", "6"))
+RECORDS_ARCHIVE_INTERVAL_SEC = int(os.getenv("RECORDS_ARCHIVE_INTERVAL_SEC", "86400"))
+
+INGEST_JOURNAL_ENABLE = os.getenv("INGEST_JOURNAL_ENABLE", "1") == "1"
+INGEST_JOURNAL_DIR = os.getenv("INGEST_JOURNAL_DIR", os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "journal"))
+INGEST_JOURNAL_FSYNC_MS = int(os.getenv("INGEST_JOURNAL_FSYNC_MS", "20"))
+INGEST_JOURNAL_SEGMENT_BYTES = int(os.getenv("INGEST_JOURNAL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+INGEST_JOURNAL_REPLAY_BATCH = int(os.getenv("INGEST_JOURNAL_REPLAY_BATCH", "500"))
+# Attempts before a record the database rejects is moved to the dead-letter file.
+INGEST_JOURNAL_MAX_ATTEMPTS = int(os.getenv("INGEST_JOURNAL_MAX_ATTEMPTS", "5"))
+
+RECORDS_DELETE_CHUNK = int(os.getenv("RECORDS_DELETE_CHUNK", "2000"))
+RECORDS_DELETE_PAUSE_MS = int(os.getenv("RECORDS_DELETE_PAUSE_MS", "10"))
+
+ACTIVITY_STATS_CACHE_SIZE = int(os.getenv("ACTIVITY_STATS_CACHE_SIZE", "128"))
+ACTIVITY_STATS_CACHE_TTL_SEC = int(os.getenv("ACTIVITY_STATS_CACHE_TTL_SEC", "600"))
+ACTIVITY_OPTIONS_REFRESH_SEC = int(os.getenv("ACTIVITY_OPTIONS_REFRESH_SEC", "3600"))
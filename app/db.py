@@ -1,20 +1,227 @@
 import os
+import sys
 import time
+import bisect
 import asyncio
 import logging
 import json
+import sqlite3
+from collections import deque
 from typing import Optional, List, Dict, Any
 
 import aiomysql
 import aiosqlite
+import pymysql
 from . import config
+from .cache import LRUCache
+from . import archive
+from . import migrations
+from . import walkin
 
 _pool = None
 _sqlite = None
 
+# Bumped by every write to `records` made through this module. Other processes
+# (tcp_server) only append, so caches keyed on it also carry a short TTL.
+_records_version = 0
+_count_cache = LRUCache(maxsize=256, ttl=config.RECORDS_COUNT_CACHE_TTL_SEC)
+
+def _bump_records_version():
+    global _records_version
+    _records_version += 1
+    _count_cache.clear()
+    _sealed_latest.clear()
+
+# Same idea for registry / location_academy. tcp_server registers new devices
+# from its own process, hence the TTL.
+_mapping_version = 0
+_mapping_cache = LRUCache(maxsize=8, ttl=config.MAPPING_CACHE_TTL_SEC)
+
+def _bump_mapping_version():
+    global _mapping_version
+    _mapping_version += 1
+    _mapping_cache.clear()
+
+# Every write to activity_facts goes through activity_bulk_insert or
+# correct_location_data in the API process; the TTL only guards manual edits.
+_activity_version = 0
+_activity_stats_cache = LRUCache(maxsize=config.ACTIVITY_STATS_CACHE_SIZE, ttl=config.ACTIVITY_STATS_CACHE_TTL_SEC)
+
+def _bump_activity_version():
+    global _activity_version
+    _activity_version += 1
+    _activity_stats_cache.clear()
+
+# token -> user. Short TTL because a logout in another worker cannot reach us;
+# user edits are rare enough to simply clear it.
+_session_cache = LRUCache(maxsize=config.SESSION_CACHE_SIZE, ttl=config.SESSION_CACHE_TTL_SEC)
+
+def _etag(data) -> str:
+    raw = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return f'W/"{hashlib.md5(raw.encode()).hexdigest()}"'
+
 def use_sqlite():
     return config.DB_DRIVER == "sqlite"
 
+class RecordConflict(Exception):
+    """A records write collided with an existing (uuid, time) row."""
+
+def _is_integrity_error(e: Exception) -> bool:
+    return isinstance(e, (sqlite3.IntegrityError, pymysql.err.IntegrityError))
+
+# MySQL reports most bad-value errors (e.g. 1292 "Incorrect datetime value"
+# under strict mode) as OperationalError, the same class as a lost connection,
+# so those are told apart by errno.
+_MYSQL_DATA_ERRNOS = {1048, 1263, 1264, 1265, 1292, 1366, 1406, 1411}
+
+def is_permanent_error(e: Exception) -> bool:
+    """True when retrying the same write cannot succeed: bad data or a constraint, not an outage."""
+    if isinstance(e, ValueError) and str(e) in ("no active connection", "Connection closed"):
+        return False  # aiosqlite's closed-connection errors
+    if isinstance(e, (ValueError, TypeError, KeyError)):
+        return True
+    if isinstance(e, (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.InterfaceError)):
+        return True
+    if isinstance(e, (pymysql.err.IntegrityError, pymysql.err.DataError)):
+        return True
+    if isinstance(e, pymysql.err.OperationalError) and e.args and e.args[0] in _MYSQL_DATA_ERRNOS:
+        return True
+    return False
+
+# --- Query execution ---
+
+_QUERY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+_query_stats: Dict[str, Dict[str, Any]] = {}
+_slow_queries = deque(maxlen=100)
+_slow_log = logging.getLogger("infrared.slowquery")
+
+def _record_query(name, ms, rows):
+    st = _query_stats.get(name)
+    if st is None:
+        st = _query_stats[name] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+                                   "buckets": [0] * (len(_QUERY_BUCKETS_MS) + 1)}
+    st["count"] += 1
+    st["total_ms"] += ms
+    st["max_ms"] = max(st["max_ms"], ms)
+    st["rows"] += rows
+    st["buckets"][bisect.bisect_left(_QUERY_BUCKETS_MS, ms)] += 1
+
+def _bucket_quantile(buckets, count, q):
+    target = q * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= target and n:
+            return _QUERY_BUCKETS_MS[i] if i < len(_QUERY_BUCKETS_MS) else None
+    return None
+
+def query_stats():
+    """Per-name latency histograms (upper bucket bounds in ms; p* are bucket bounds too)."""
+    out = []
+    for name, st in _query_stats.items():
+        n = st["count"]
+        out.append({
+            "name": name,
+            "count": n,
+            "rows": st["rows"],
+            "avg_ms": round(st["total_ms"] / n, 3) if n else 0,
+            "max_ms": round(st["max_ms"], 3),
+            "total_ms": round(st["total_ms"], 3),
+            "p50_ms": _bucket_quantile(st["buckets"], n, 0.5),
+            "p95_ms": _bucket_quantile(st["buckets"], n, 0.95),
+            "p99_ms": _bucket_quantile(st["buckets"], n, 0.99),
+            "histogram": {("le_" + str(b) if i < len(_QUERY_BUCKETS_MS) else "inf"): st["buckets"][i]
+                          for i, b in enumerate(list(_QUERY_BUCKETS_MS) + [None])},
+        })
+    out.sort(key=lambda x: x["total_ms"], reverse=True)
+    return {"queries": out, "slow": list(_slow_queries), "slow_ms": config.SLOW_QUERY_MS}
+
+def reset_query_stats():
+    _query_stats.clear()
+    _slow_queries.clear()
+
+async def _explain(sql, params):
+    try:
+        if use_sqlite():
+            async with _sqlite.execute("EXPLAIN QUERY PLAN " + sql, params) as cur:
+                return [" ".join(str(v) for v in tuple(r)[1:]) for r in await cur.fetchall()]
+        async with _pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("EXPLAIN " + sql, params)
+                return [list(r) for r in await cur.fetchall()]
+    except Exception as e:
+        # MySQL errors quote the interpolated statement, bind values included.
+        return [f"EXPLAIN failed: {type(e).__name__}"]
+
+async def _slow_query(name, sql, params, ms, rows):
+    entry = {
+        "name": name,
+        "ms": round(ms, 3),
+        "rows": rows,
+        "sql": " ".join(sql.split()),
+        # Bind values can be session tokens or password hashes: keep only the
+        # count and the Python types.
+        "params": {"count": len(params or ()), "types": [type(p).__name__ for p in (params or [])][:50]},
+        "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    if config.SLOW_QUERY_EXPLAIN and sql.lstrip().upper().startswith(("SELECT", "WITH")):
+        entry["plan"] = await _explain(sql, params)
+    _slow_queries.append(entry)
+    _slow_log.warning("slow query %s %.1fms rows=%s sql=%s params=%s plan=%s",
+                      name, ms, rows, entry["sql"], entry["params"], entry.get("plan"))
+
+async def _run(name, sql, params=(), fetch="all", dicts=False, commit=True):
+    """
+    Every statement should come through here: picks the driver, times it and
+    feeds the per-name histograms and the slow-query log. fetch is "all",
+    "one" or None; None returns the rowcount and, unless commit=False,
+    commits on SQLite.
+    """
+    name = name or sys._getframe(1).f_code.co_name
+    params = params if params is not None else ()
+    t0 = time.perf_counter()
+    if use_sqlite():
+        if not _sqlite: await init_sqlite()
+        async with _sqlite.execute(sql, params) as cur:
+            if fetch == "all":
+                res = await cur.fetchall()
+            elif fetch == "one":
+                res = await cur.fetchone()
+            else:
+                res = cur.rowcount
+        if fetch is None and commit:
+            await _sqlite.commit()
+        if dicts and fetch == "all":
+            res = [dict(r) for r in res]
+        elif dicts and res is not None and fetch == "one":
+            res = dict(res)
+    else:
+        if not _pool: await init_pool()
+        async with _pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor if dicts else aiomysql.Cursor) as cur:
+                await cur.execute(sql, params)
+                if fetch == "all":
+                    res = list(await cur.fetchall())
+                elif fetch == "one":
+                    res = await cur.fetchone()
+                else:
+                    res = cur.rowcount
+    ms = (time.perf_counter() - t0) * 1000
+    if fetch == "all":
+        rows = len(res)
+    elif fetch == "one":
+        rows = 1 if res is not None else 0
+    else:
+        rows = max(res or 0, 0)
+    _record_query(name, ms, rows)
+    if config.SLOW_QUERY_MS > 0 and ms >= config.SLOW_QUERY_MS:
+        await _slow_query(name, sql, params, ms, rows)
+    return res
+
+async def run_query(sql: str, params: list, name: str = None):
+    return await _run(name or sys._getframe(1).f_code.co_name, sql, params)
+
+
 import hashlib
 import uuid
 
@@ -26,17 +233,7 @@ def hash_password(password: str) -> str:
 async def authenticate_user(username, password):
     p_hash = hash_password(password)
     sql = "SELECT id, username, password_hash, role FROM users WHERE username=?" if use_sqlite() else "SELECT id, username, password_hash, role FROM users WHERE username=%s"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, (username,)) as cur:
-            row = await cur.fetchone()
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql, (username,))
-                row = await cur.fetchone()
+    row = await _run("authenticate_user", sql, (username,), fetch="one", dicts=True)
                 
     if row:
         stored_hash = row["password_hash"]
@@ -52,110 +249,90 @@ async def create_session(user_id):
     expires = datetime.datetime.now() + datetime.timedelta(days=7)
     
     sql = "INSERT INTO sessions (token, user_id, expires_at) VALUES (?, ?, ?)" if use_sqlite() else "INSERT INTO sessions (token, user_id, expires_at) VALUES (%s, %s, %s)"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (token, user_id, expires))
-        await _sqlite.commit()
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, (token, user_id, expires))
-                
+    await _run("create_session", sql, (token, user_id, expires), fetch=None)
     return token
 
+def _session_expiry(value):
+    # expires_at is written from datetime.now() in create_session; SQLite hands
+    # it back as text, MySQL as a datetime.
+    import datetime
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(str(value))
+    except (TypeError, ValueError):
+        return None
+
 async def get_user_by_token(token):
+    import datetime
+    hit = _session_cache.get(token)
+    if hit is not None:
+        user, expires = hit
+        if expires > datetime.datetime.now():
+            return dict(user)
+        _session_cache.pop(token)
     sql = """
-        SELECT u.id, u.username, u.role 
+        SELECT u.id, u.username, u.role, s.expires_at
         FROM sessions s
         JOIN users u ON s.user_id = u.id
         WHERE s.token = ? AND s.expires_at > CURRENT_TIMESTAMP
     """ if use_sqlite() else """
-        SELECT u.id, u.username, u.role 
+        SELECT u.id, u.username, u.role, s.expires_at
         FROM sessions s
         JOIN users u ON s.user_id = u.id
         WHERE s.token = %s AND s.expires_at > NOW()
     """
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, (token,)) as cur:
-            row = await cur.fetchone()
-            if row:
-                return {"id": row["id"], "username": row["username"], "role": row["role"]}
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql, (token,))
-                row = await cur.fetchone()
-                if row:
-                    return row
+    row = await _run("get_user_by_token", sql, (token,), fetch="one", dicts=True)
+    if row:
+        user = {"id": row["id"], "username": row["username"], "role": row["role"]}
+        # Never cache past the session's own expiry.
+        expires = _session_expiry(row["expires_at"])
+        left = (expires - datetime.datetime.now()).total_seconds() if expires else 0
+        if left > 0:
+            ttl = min(config.SESSION_CACHE_TTL_SEC, left) if config.SESSION_CACHE_TTL_SEC else left
+            _session_cache.set(token, (user, expires), ttl=ttl)
+        return dict(user)
     return None
 
 async def delete_session(token):
+    _session_cache.pop(token)
     sql = "DELETE FROM sessions WHERE token=?" if use_sqlite() else "DELETE FROM sessions WHERE token=%s"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (token,))
-        await _sqlite.commit()
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, (token,))
+    await _run("delete_session", sql, (token,), fetch=None)
+
+async def purge_expired_sessions(batch=None):
+    """Deletes expired sessions in batches so the write lock is never held for long."""
+    batch = max(1, int(batch or config.SESSION_PURGE_BATCH))
+    sql = (
+        "DELETE FROM sessions WHERE rowid IN "
+        "(SELECT rowid FROM sessions WHERE expires_at <= CURRENT_TIMESTAMP LIMIT ?)"
+    ) if use_sqlite() else "DELETE FROM sessions WHERE expires_at <= NOW() LIMIT %s"
+    purged = 0
+    while True:
+        n = await _run("purge_expired_sessions", sql, (batch,), fetch=None)
+        purged += n
+        if n < batch:
+            break
+        await asyncio.sleep(0)
+    return purged
 
 async def change_password(user_id, new_password):
     p_hash = hash_password(new_password)
     sql = "UPDATE users SET password_hash=? WHERE id=?" if use_sqlite() else "UPDATE users SET password_hash=%s WHERE id=%s"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (p_hash, user_id))
-        await _sqlite.commit()
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, (p_hash, user_id))
+    await _run("change_password", sql, (p_hash, user_id), fetch=None)
+    _session_cache.clear()
     return True
 
 async def get_all_users():
-    sql = "SELECT id, username, role, created_at, last_login FROM users ORDER BY id" if use_sqlite() else "SELECT id, username, role, created_at, last_login FROM users ORDER BY id"
-    # Note: last_login might not exist yet, let's check schema or add it.
-    # Looking at init_sqlite, there is no last_login column. I should add it or ignore it.
-    # The user requested "last login time" in the profile card.
-    # I'll stick to existing columns first: id, username, role, created_at.
-    
+    # last_login is not in the schema yet; stick to existing columns.
     sql = "SELECT id, username, role, created_at FROM users ORDER BY id"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return [dict(row) for row in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql)
-                return await cur.fetchall()
+    return await _run("get_all_users", sql, (), dicts=True)
 
 async def create_user(username, password, role="user"):
     p_hash = hash_password(password)
     sql = "INSERT INTO users (username, password_hash, role) VALUES (?, ?, ?)" if use_sqlite() else "INSERT INTO users (username, password_hash, role) VALUES (%s, %s, %s)"
     
     try:
-        if use_sqlite():
-            if not _sqlite: await init_sqlite()
-            await _sqlite.execute(sql, (username, p_hash, role))
-            await _sqlite.commit()
-        else:
-            if not _pool: await init_pool()
-            async with _pool.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(sql, (username, p_hash, role))
+        await _run("create_user", sql, (username, p_hash, role), fetch=None)
         return True
     except Exception as e:
         logging.error(f"Error creating user: {e}")
@@ -185,31 +362,16 @@ async def update_user(user_id, username=None, password=None, role=None):
     if not use_sqlite():
         sql_base = sql_base.replace("?", "%s")
         
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql_base, tuple(params))
-        await _sqlite.commit()
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql_base, tuple(params))
+    await _run("update_user", sql_base, tuple(params), fetch=None)
+    _session_cache.clear()
     return True
 
 async def delete_user(user_id):
     # Don't allow deleting admin (id=1 usually, or check username)
     # But let's just handle deletion here.
     sql = "DELETE FROM users WHERE id=?" if use_sqlite() else "DELETE FROM users WHERE id=%s"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (user_id,))
-        await _sqlite.commit()
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, (user_id,))
+    await _run("delete_user", sql, (user_id,), fetch=None)
+    _session_cache.clear()
     return True
 
 
@@ -222,155 +384,7 @@ async def init_sqlite():
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     _sqlite = await aiosqlite.connect(db_path)
     _sqlite.row_factory = aiosqlite.Row
-    
-    # Init tables
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE,
-            password_hash TEXT,
-            role TEXT DEFAULT 'user',
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS sessions (
-            token TEXT PRIMARY KEY,
-            user_id INTEGER,
-            expires_at DATETIME
-        )
-    """)
-    
-    # Check if admin exists, if not create default
-    async with _sqlite.execute("SELECT id FROM users WHERE username='admin'") as cur:
-        if not await cur.fetchone():
-            p_hash = hash_password("admin")
-            await _sqlite.execute("INSERT INTO users (username, password_hash, role) VALUES ('admin', ?, 'admin')", (p_hash,))
-
-    # Migration: Add created_at if not exists
-    try:
-        await _sqlite.execute("ALTER TABLE users ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP")
-    except Exception:
-        pass
-    
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uuid TEXT,
-            time DATETIME,
-            in_count INTEGER,
-            out_count INTEGER,
-            battery INTEGER,
-            btx INTEGER,
-            rec_type INTEGER,
-            signal_strength INTEGER,
-            warn_status INTEGER,
-            activity_type TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    await _sqlite.execute("CREATE INDEX IF NOT EXISTS idx_records_uuid_time ON records(uuid, time)")
-    
-    # Migration: Add activity_type if not exists
-    try:
-        await _sqlite.execute("ALTER TABLE records ADD COLUMN activity_type TEXT")
-    except Exception:
-        pass
-    
-    # Migration: Add warn_status if not exists
-    try:
-        await _sqlite.execute("ALTER TABLE records ADD COLUMN warn_status INTEGER")
-    except Exception:
-        pass
-    
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS registry (
-            uuid TEXT PRIMARY KEY,
-            name TEXT,
-            category TEXT,
-            description TEXT,
-            last_seen DATETIME,
-            ip TEXT,
-            bound_at DATETIME
-        )
-    """)
-    try:
-        await _sqlite.execute("ALTER TABLE registry ADD COLUMN ip TEXT")
-    except Exception:
-        pass
-    try:
-        await _sqlite.execute("ALTER TABLE registry ADD COLUMN bound_at DATETIME")
-    except Exception:
-        pass
-    
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS audit_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            actor TEXT,
-            action TEXT,
-            target TEXT,
-            details TEXT,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS academies (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT UNIQUE,
-            sort_order INTEGER DEFAULT 0
-        )
-    """)
-    async with _sqlite.execute("PRAGMA table_info(academies)") as cur:
-        cols = [r[1] for r in (await cur.fetchall() or []) if r and len(r) > 1]
-    if "sort_order" not in cols:
-        await _sqlite.execute("ALTER TABLE academies ADD COLUMN sort_order INTEGER DEFAULT 0")
-    
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS activity_events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            weekday TEXT,
-            start_time TEXT,
-            end_time TEXT,
-            duration_minutes INTEGER,
-            academy TEXT,
-            location TEXT,
-            activity_name TEXT,
-            activity_type TEXT,
-            audience_count INTEGER,
-            notes TEXT,
-            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS alerts (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            uuid TEXT,
-            type TEXT,
-            level INTEGER,
-            info TEXT,
-            time DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    await _sqlite.execute("""
-        CREATE TABLE IF NOT EXISTS location_academy (
-            location_name TEXT PRIMARY KEY,
-            academy_name TEXT
-        )
-    """)
-    try:
-        await _sqlite.execute("""
-            UPDATE registry
-            SET bound_at = COALESCE(bound_at, CURRENT_TIMESTAMP)
-            WHERE name IS NOT NULL
-              AND name != ''
-              AND name IN (SELECT location_name FROM location_academy)
-        """)
-    except Exception:
-        pass
-    await _sqlite.commit()
+    await migrations.migrate_sqlite(_sqlite)
 
 async def init_pool():
     global _pool, _sqlite
@@ -390,148 +404,9 @@ async def init_pool():
             db=config.DB_NAME,
             autocommit=True
         )
-        # Create tables if not exist (MySQL)
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
-                        username VARCHAR(64) UNIQUE,
-                        password_hash VARCHAR(128),
-                        role VARCHAR(32) DEFAULT 'user',
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                # MySQL Migration for users.created_at
-                try:
-                    await cur.execute("SHOW COLUMNS FROM users LIKE 'created_at'")
-                    if not await cur.fetchone():
-                        await cur.execute("ALTER TABLE users ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP")
-                except Exception as e:
-                    logging.info(f"MySQL Migration failed (users.created_at): {e}")
-
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS sessions (
-                        token VARCHAR(64) PRIMARY KEY,
-                        user_id BIGINT,
-                        expires_at DATETIME
-                    )
-                """)
-                # Check admin
-                await cur.execute("SELECT id FROM users WHERE username='admin'")
-                if not await cur.fetchone():
-                    p_hash = hash_password("admin")
-                    await cur.execute("INSERT INTO users (username, password_hash, role) VALUES ('admin', %s, 'admin')", (p_hash,))
-                
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS records (
-                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
-                        uuid VARCHAR(64),
-                        time DATETIME,
-                        in_count INT,
-                        out_count INT,
-                        battery INT,
-                        btx INT,
-                        rec_type INT,
-                        signal_strength INT,
-                        warn_status INT,
-                        activity_type VARCHAR(64),
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        INDEX idx_uuid_time (uuid, time)
-                    )
-                """)
-                # Migration MySQL
-                try:
-                    await cur.execute("ALTER TABLE records ADD COLUMN activity_type VARCHAR(64)")
-                except Exception:
-                    pass
-                try:
-                    await cur.execute("ALTER TABLE records ADD COLUMN warn_status INT")
-                except Exception:
-                    pass
-
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS registry (
-                        uuid VARCHAR(64) PRIMARY KEY,
-                        name VARCHAR(128),
-                        category VARCHAR(64),
-                        description TEXT,
-                        last_seen DATETIME,
-                        ip VARCHAR(64),
-                        bound_at DATETIME
-                    )
-                """)
-                try:
-                    await cur.execute("ALTER TABLE registry ADD COLUMN ip VARCHAR(64)")
-                except Exception:
-                    pass
-                try:
-                    await cur.execute("ALTER TABLE registry ADD COLUMN bound_at DATETIME")
-                except Exception:
-                    pass
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS audit_logs (
-                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
-                        actor VARCHAR(128),
-                        action VARCHAR(64),
-                        target VARCHAR(64),
-                        details TEXT,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS academies (
-                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
-                        name VARCHAR(128) UNIQUE,
-                        sort_order INT DEFAULT 0
-                    )
-                """)
-                try:
-                    await cur.execute("ALTER TABLE academies ADD COLUMN sort_order INT DEFAULT 0")
-                except Exception:
-                    pass
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS activity_events (
-                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
-                        date VARCHAR(20),
-                        weekday VARCHAR(20),
-                        start_time VARCHAR(20),
-                        end_time VARCHAR(20),
-                        duration_minutes INT,
-                        academy VARCHAR(128),
-                        location VARCHAR(128),
-                        activity_name VARCHAR(255),
-                        activity_type VARCHAR(64),
-                        audience_count INT,
-                        notes TEXT,
-                        create_time DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS alerts (
-                        id BIGINT AUTO_INCREMENT PRIMARY KEY,
-                        uuid VARCHAR(64),
-                        type VARCHAR(64),
-                        level INT,
-                        info TEXT,
-                        time DATETIME DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                await cur.execute("""
-                    CREATE TABLE IF NOT EXISTS location_academy (
-                        location_name VARCHAR(128) PRIMARY KEY,
-                        academy_name VARCHAR(64)
-                    )
-                """)
-                try:
-                    await cur.execute("""
-                        UPDATE registry r
-                        JOIN location_academy la ON r.name = la.location_name
-                        SET r.bound_at = IFNULL(r.bound_at, NOW())
-                        WHERE r.name IS NOT NULL AND r.name != ''
-                    """)
-                except Exception:
-                    pass
+                await migrations.migrate_mysql(cur)
     except Exception as e:
         logging.error(f"DB init failed: {e}")
 
@@ -543,28 +418,542 @@ async def close_pool():
     if _sqlite:
         await _sqlite.close()
 
+# --- Record Partitions ---
+#
+# MySQL partitions `records` natively (PARTITION BY RANGE on TO_DAYS(time)).
+# SQLite keeps the current months in `records` and seals finished months into
+# `records_YYYYMM` tables in the same file; readers go through _records_source()
+# so a range query only unions the months it overlaps, and dropping a month is
+# a DROP TABLE instead of a row-by-row DELETE.
+
+_RECORD_COLS = "id, uuid, time, in_count, out_count, battery, btx, rec_type, signal_strength, warn_status, activity_type, created_at"
+_RECORD_PARTITION_CHUNK = 5000
+_record_partitions = None
+# Sealed month -> {uuid: MAX(id)}. Rows only enter a sealed table when it is
+# created, and edits or deletes there bump _records_version, which clears this.
+_sealed_latest: Dict[str, Dict[str, int]] = {}
+
+def _month_key(month) -> str:
+    s = str(month or "").strip().replace("-", "")[:6]
+    if len(s) != 6 or not s.isdigit() or not 1 <= int(s[4:]) <= 12:
+        raise ValueError(f"invalid month: {month}")
+    return s
+
+def _month_offset(key: str, delta: int) -> str:
+    n = int(key[:4]) * 12 + int(key[4:]) - 1 + delta
+    return f"{n // 12:04d}{n % 12 + 1:02d}"
+
+def _month_bounds(key: str):
+    nxt = _month_offset(key, 1)
+    return f"{key[:4]}-{key[4:]}-01 00:00:00", f"{nxt[:4]}-{nxt[4:]}-01 00:00:00"
+
+async def _load_record_partitions(refresh=False):
+    global _record_partitions
+    if _record_partitions is not None and not refresh:
+        return _record_partitions
+    if not use_sqlite():
+        _record_partitions = []
+        return _record_partitions
+    rows = await run_query(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'records_[0-9][0-9][0-9][0-9][0-9][0-9]'",
+        [],
+    )
+    _record_partitions = sorted(r[0][len("records_"):] for r in rows)
+    return _record_partitions
+
+async def _records_tables(start=None, end=None):
+    tables = ["records"]
+    for key in await _load_record_partitions():
+        lo, hi = _month_bounds(key)
+        if start and str(start) >= hi[:10]:
+            continue
+        if end and str(end) < lo:
+            continue
+        tables.append(f"records_{key}")
+    return tables
+
+async def _records_source(start=None, end=None, alias=None):
+    """FROM-clause covering every records row between start and end (inclusive)."""
+    tables = await _records_tables(start, end)
+    if len(tables) == 1:
+        return f"records {alias}" if alias else "records"
+    union = " UNION ALL ".join(f"SELECT {_RECORD_COLS} FROM {t}" for t in tables)
+    return f"({union}) AS {alias or 'records'}"
+
+async def _sqlite_execute_records(sql: str, params, start=None, end=None):
+    """Runs sql on the hot table and the sealed months it may touch; `{table}` marks the table name."""
+    name = sys._getframe(1).f_code.co_name
+    count = 0
+    for t in await _records_tables(start, end):
+        count += await _run(name, sql.format(table=t), params, fetch=None, commit=False)
+    return count
+
+async def _sqlite_rehome_records(ids):
+    # Rows whose time was edited out of their sealed month go back to the hot
+    # table; the next maintenance run seals them into the right month.
+    ids = [i for i in ids if i is not None]
+    if not ids:
+        return
+    for key in await _load_record_partitions():
+        lo, hi = _month_bounds(key)
+        table = f"records_{key}"
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            placeholders = ",".join(["?"] * len(chunk))
+            cond = f"id IN ({placeholders}) AND (time < ? OR time >= ?)"
+            params = list(chunk) + [lo, hi]
+            await _sqlite.execute(f"INSERT OR REPLACE INTO records ({_RECORD_COLS}) SELECT {_RECORD_COLS} FROM {table} WHERE {cond}", params)
+            await _sqlite.execute(f"DELETE FROM {table} WHERE {cond}", params)
+
+async def _sqlite_time_slice(table, lo, hi):
+    """
+    WHERE-condition for roughly the oldest _RECORD_PARTITION_CHUNK rows of table
+    with lo <= time < hi. Returns (cond, params, last); last means the slice
+    reaches hi. Callers remove the slice before asking for the next one.
+    """
+    async with _sqlite.execute(
+        f"SELECT time FROM {table} WHERE time >= ? AND time < ? ORDER BY time LIMIT 1 OFFSET ?",
+        (lo, hi, _RECORD_PARTITION_CHUNK),
+    ) as cur:
+        row = await cur.fetchone()
+    cut = row[0] if row else None
+    if cut is None:
+        return "time >= ? AND time < ?", (lo, hi), True
+    async with _sqlite.execute(f"SELECT 1 FROM {table} WHERE time >= ? AND time < ? LIMIT 1", (lo, cut)) as cur:
+        if await cur.fetchone():
+            return "time >= ? AND time < ?", (lo, cut), False
+    # More than a chunk of rows share the oldest timestamp.
+    return "time >= ? AND time <= ?", (lo, cut), False
+
+async def _mysql_record_partitions(cur):
+    await cur.execute(
+        "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'records' AND PARTITION_NAME IS NOT NULL"
+    )
+    return [r[0] for r in await cur.fetchall()]
+
+def _mysql_partition_defs(months):
+    return ", ".join(
+        f"PARTITION p{k} VALUES LESS THAN (TO_DAYS('{_month_bounds(k)[1][:10]}'))" for k in months
+    )
+
+async def records_seal_month(month):
+    """Moves one month of rows from the hot SQLite table into records_YYYYMM, in short transactions."""
+    key = _month_key(month)
+    if not use_sqlite():
+        return 0
+    if not _sqlite: await init_sqlite()
+    lo, hi = _month_bounds(key)
+    table = f"records_{key}"
+    await _sqlite.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY,
+            uuid TEXT,
+            time DATETIME,
+            in_count INTEGER,
+            out_count INTEGER,
+            battery INTEGER,
+            btx INTEGER,
+            rec_type INTEGER,
+            signal_strength INTEGER,
+            warn_status INTEGER,
+            activity_type TEXT,
+            created_at DATETIME
+        )
+    """)
+    await _sqlite.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{table}_uuid_time ON {table}(uuid, time)")
+    await _sqlite.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_time ON {table}(time)")
+    await _sqlite.commit()
+    await _load_record_partitions(refresh=True)
+
+    moved = 0
+    while True:
+        # Each slice is moved in one transaction, so readers never see a row
+        # in both tables or in neither.
+        cond, params, last = await _sqlite_time_slice("records", lo, hi)
+        await _sqlite.execute(f"INSERT OR REPLACE INTO {table} ({_RECORD_COLS}) SELECT {_RECORD_COLS} FROM records WHERE {cond}", params)
+        async with _sqlite.execute(f"DELETE FROM records WHERE {cond}", params) as cur:
+            moved += max(cur.rowcount or 0, 0)
+        await _sqlite.commit()
+        if last:
+            break
+        await asyncio.sleep(0)
+    return moved
+
+async def records_drop_month(month):
+    """Drops a whole month of records (partition drop / table drop)."""
+    key = _month_key(month)
+    lo, hi = _month_bounds(key)
+    if use_sqlite():
+        if not _sqlite: await init_sqlite()
+        if key in await _load_record_partitions():
+            await _sqlite.execute(f"DROP TABLE IF EXISTS records_{key}")
+            await _sqlite.commit()
+            await _load_record_partitions(refresh=True)
+        # Late rows for a sealed month can still sit in the hot table.
+        await _sqlite.execute("DELETE FROM records WHERE time >= ? AND time < ?", (lo, hi))
+        await _sqlite.commit()
+    else:
+        if not _pool: await init_pool()
+        async with _pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                if f"p{key}" in await _mysql_record_partitions(cur):
+                    await cur.execute(f"ALTER TABLE records DROP PARTITION p{key}")
+                else:
+                    await cur.execute("DELETE FROM records WHERE time >= %s AND time < %s", (lo, hi))
+    _bump_records_version()
+    return True
+
+async def records_list_partitions():
+    if use_sqlite():
+        keys = await _load_record_partitions(refresh=True)
+        return [{"month": f"{k[:4]}-{k[4:]}", "table": f"records_{k}"} for k in keys]
+    rows = await run_query(
+        "SELECT PARTITION_NAME, TABLE_ROWS FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'records' AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION",
+        [],
+    )
+    return [
+        {"month": f"{r[0][1:5]}-{r[0][5:]}", "partition": r[0], "rows": r[1]}
+        for r in rows if r[0] and r[0] != "pmax"
+    ]
+
+async def records_maintain_partitions():
+    """
+    SQLite: seals every month older than RECORDS_PARTITION_HOT_MONTHS out of the hot table.
+    MySQL: partitions records on first run, then keeps RECORDS_PARTITION_MONTHS_AHEAD empty
+    future partitions split off pmax.
+    """
+    this_month = time.strftime("%Y%m")
+    if use_sqlite():
+        cutoff, _ = _month_bounds(_month_offset(this_month, 1 - max(1, config.RECORDS_PARTITION_HOT_MONTHS)))
+        rows = await run_query("SELECT DISTINCT strftime('%Y%m', time) FROM records WHERE time < ?", [cutoff])
+        sealed = {}
+        for r in rows:
+            if r[0]:
+                sealed[r[0]] = await records_seal_month(r[0])
+        return {"sealed": sealed}
+
+    if not _pool: await init_pool()
+    last = _month_offset(this_month, max(0, config.RECORDS_PARTITION_MONTHS_AHEAD))
+    async with _pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            existing = [p for p in await _mysql_record_partitions(cur) if p != "pmax"]
+            if existing:
+                first = _month_offset(max(p[1:] for p in existing), 1)
+            else:
+                await cur.execute("SELECT MIN(time) FROM records")
+                row = await cur.fetchone()
+                first = row[0].strftime("%Y%m") if row and row[0] else this_month
+            months = []
+            k = first
+            while k <= last:
+                months.append(k)
+                k = _month_offset(k, 1)
+            if not months:
+                return {"created": []}
+            if existing:
+                await cur.execute(
+                    f"ALTER TABLE records REORGANIZE PARTITION pmax INTO "
+                    f"({_mysql_partition_defs(months)}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+                )
+            else:
+                # Every unique key must contain the partitioning column.
+                await cur.execute("UPDATE records SET time = COALESCE(created_at, NOW()) WHERE time IS NULL")
+                await cur.execute(
+                    f"ALTER TABLE records DROP PRIMARY KEY, ADD PRIMARY KEY (id, time) "
+                    f"PARTITION BY RANGE (TO_DAYS(time)) "
+                    f"({_mysql_partition_defs(months)}, PARTITION pmax VALUES LESS THAN MAXVALUE)"
+                )
+    return {"created": [f"{k[:4]}-{k[4:]}" for k in months]}
+
+# --- Retention ---
+
+_HOURLY_UPSERT_SQLITE = (
+    "INSERT INTO records_hourly (uuid, hour, in_count, out_count, samples) "
+    "SELECT COALESCE(uuid, ''), strftime('%Y-%m-%d %H:00:00', time), "
+    "SUM(COALESCE(in_count, 0)), SUM(COALESCE(out_count, 0)), COUNT(*) "
+    "FROM {table} WHERE {cond} AND strftime('%Y-%m-%d %H:00:00', time) IS NOT NULL GROUP BY 1, 2 "
+    "ON CONFLICT(uuid, hour) DO UPDATE SET "
+    "in_count = in_count + excluded.in_count, "
+    "out_count = out_count + excluded.out_count, "
+    "samples = samples + excluded.samples"
+)
+
+_HOURLY_UPSERT_MYSQL = (
+    "INSERT INTO records_hourly (uuid, hour, in_count, out_count, samples) "
+    "SELECT COALESCE(uuid, ''), DATE_FORMAT(time, '%%Y-%%m-%%d %%H:00:00') AS h, "
+    "SUM(COALESCE(in_count, 0)), SUM(COALESCE(out_count, 0)), COUNT(*) "
+    "FROM records WHERE {cond} GROUP BY 1, h "
+    "ON DUPLICATE KEY UPDATE "
+    "in_count = records_hourly.in_count + VALUES(in_count), "
+    "out_count = records_hourly.out_count + VALUES(out_count), "
+    "samples = records_hourly.samples + VALUES(samples)"
+)
+
+async def _sqlite_db_bytes():
+    async with _sqlite.execute("PRAGMA page_count") as cur:
+        pages = (await cur.fetchone())[0]
+    async with _sqlite.execute("PRAGMA page_size") as cur:
+        size = (await cur.fetchone())[0]
+    async with _sqlite.execute("PRAGMA freelist_count") as cur:
+        free = (await cur.fetchone())[0]
+    return pages * size, free * size
+
+async def _sqlite_apply_retention(cutoff, hourly_cutoff):
+    deleted = 0
+    # Sealed months that are entirely older than the cutoff go in one step.
+    for key in await _load_record_partitions():
+        lo, hi = _month_bounds(key)
+        if hi > cutoff:
+            continue
+        table = f"records_{key}"
+        async with _sqlite.execute(f"SELECT COUNT(*) FROM {table}") as cur:
+            n = (await cur.fetchone())[0]
+        await _sqlite.execute(_HOURLY_UPSERT_SQLITE.format(table=table, cond="1=1"))
+        await _sqlite.execute(f"DROP TABLE IF EXISTS {table}")
+        await _sqlite.commit()
+        deleted += n
+    await _load_record_partitions(refresh=True)
+
+    for table in await _records_tables(None, cutoff):
+        while True:
+            # Rollup and delete of a slice share one transaction, so a crash
+            # never counts the same rows twice or loses them.
+            cond, params, last = await _sqlite_time_slice(table, "", cutoff)
+            await _sqlite.execute(_HOURLY_UPSERT_SQLITE.format(table=table, cond=cond), params)
+            async with _sqlite.execute(f"DELETE FROM {table} WHERE {cond}", params) as cur:
+                deleted += max(cur.rowcount or 0, 0)
+            await _sqlite.commit()
+            if last:
+                break
+            await asyncio.sleep(0)
+
+    hourly_deleted = 0
+    if hourly_cutoff:
+        async with _sqlite.execute("DELETE FROM records_hourly WHERE hour < ?", (hourly_cutoff,)) as cur:
+            hourly_deleted = max(cur.rowcount or 0, 0)
+        await _sqlite.commit()
+    return deleted, hourly_deleted
+
+async def _mysql_apply_retention(cutoff, hourly_cutoff):
+    # Chunks walk idx_time in (time, id) order, so a burst of rows sharing one
+    # timestamp is still cut into _RECORD_PARTITION_CHUNK pieces. The hourly
+    # upsert adds to existing buckets, so splitting an hour is harmless.
+    deleted = 0
+    async with _pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute("SELECT MIN(time) FROM records WHERE time < %s", (cutoff,))
+            row = await cur.fetchone()
+            lo = (row[0], 0) if row and row[0] is not None else None
+            after = "time >= %s AND (time > %s OR id > %s)"
+            while lo is not None:
+                await cur.execute(
+                    f"SELECT time, id FROM records WHERE {after} AND time < %s "
+                    "ORDER BY time, id LIMIT 1 OFFSET %s",
+                    (lo[0], lo[0], lo[1], cutoff, _RECORD_PARTITION_CHUNK - 1),
+                )
+                hi = await cur.fetchone()
+                if hi:
+                    cond = f"{after} AND time <= %s AND (time < %s OR id <= %s)"
+                    params = (lo[0], lo[0], lo[1], hi[0], hi[0], hi[1])
+                else:
+                    cond = f"{after} AND time < %s"
+                    params = (lo[0], lo[0], lo[1], cutoff)
+                await conn.begin()
+                try:
+                    await cur.execute(_HOURLY_UPSERT_MYSQL.format(cond=cond), params)
+                    await cur.execute(f"DELETE FROM records WHERE {cond}", params)
+                    deleted += max(cur.rowcount or 0, 0)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+                lo = (hi[0], hi[1]) if hi else None
+                await asyncio.sleep(0)
+            hourly_deleted = 0
+            if hourly_cutoff:
+                await cur.execute("DELETE FROM records_hourly WHERE hour < %s", (hourly_cutoff,))
+                hourly_deleted = max(cur.rowcount or 0, 0)
+    return deleted, hourly_deleted
+
+async def _mysql_table_bytes():
+    rows = await run_query(
+        "SELECT COALESCE(SUM(DATA_LENGTH + INDEX_LENGTH), 0), COALESCE(SUM(DATA_FREE), 0) "
+        "FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ('records', 'records_hourly')",
+        [],
+    )
+    return (int(rows[0][0] or 0), int(rows[0][1] or 0)) if rows else (0, 0)
+
+async def records_apply_retention():
+    """
+    Rolls raw records older than RETENTION_RAW_DAYS into records_hourly and
+    deletes them in chunks, then drops rollups older than RETENTION_HOURLY_DAYS
+    (0 keeps them forever). On SQLite the freed pages are returned with
+    incremental vacuum when the file was created with auto_vacuum=INCREMENTAL.
+    """
+    now = time.time()
+    cutoff = time.strftime("%Y-%m-%d 00:00:00", time.localtime(now - max(1, config.RETENTION_RAW_DAYS) * 86400))
+    hourly_cutoff = None
+    if config.RETENTION_HOURLY_DAYS > 0:
+        hourly_cutoff = time.strftime("%Y-%m-%d 00:00:00", time.localtime(now - config.RETENTION_HOURLY_DAYS * 86400))
+    report = {"cutoff": cutoff, "hourly_cutoff": hourly_cutoff}
+
+    if use_sqlite():
+        if not _sqlite: await init_sqlite()
+        before, _ = await _sqlite_db_bytes()
+        deleted, hourly_deleted = await _sqlite_apply_retention(cutoff, hourly_cutoff)
+        async with _sqlite.execute("PRAGMA auto_vacuum") as cur:
+            mode = (await cur.fetchone())[0]
+        if mode == 2:
+            pages = config.RETENTION_VACUUM_PAGES
+            sql = f"PRAGMA incremental_vacuum({int(pages)})" if pages > 0 else "PRAGMA incremental_vacuum"
+            async with _sqlite.execute(sql) as cur:
+                await cur.fetchall()
+            report["vacuum"] = "incremental"
+        else:
+            # Existing files keep their auto_vacuum mode until a full VACUUM.
+            report["vacuum"] = "skipped"
+        after, free = await _sqlite_db_bytes()
+    else:
+        if not _pool: await init_pool()
+        before, _ = await _mysql_table_bytes()
+        deleted, hourly_deleted = await _mysql_apply_retention(cutoff, hourly_cutoff)
+        # InnoDB statistics lag behind; these figures are estimates.
+        after, free = await _mysql_table_bytes()
+        report["vacuum"] = "n/a"
+
+    p = "?" if use_sqlite() else "%s"
+    await _run("records_apply_retention.merged", f"DELETE FROM records_merged WHERE time < {p}", (cutoff,), fetch=None)
+    if deleted:
+        _bump_records_version()
+    report.update({
+        "deleted_rows": deleted,
+        "hourly_deleted_rows": hourly_deleted,
+        "bytes_before": before,
+        "bytes_after": after,
+        "bytes_reclaimed": max(before - after, 0),
+        "bytes_free": free,
+    })
+    return report
+
+# --- Archive ---
+
+async def records_archive_month(month):
+    """
+    Moves a finished month of records into the columnar archive, one device
+    at a time, and deletes the archived rows from the database.
+    """
+    key = _month_key(month)
+    if key >= time.strftime("%Y%m"):
+        raise ValueError("only finished months can be archived")
+    lo, hi = _month_bounds(key)
+    p = "?" if use_sqlite() else "%s"
+    src = await _records_source(lo, hi)
+    devices = [r[0] for r in await run_query(f"SELECT DISTINCT uuid FROM {src} WHERE time >= {p} AND time < {p}", [lo, hi])]
+
+    archived = 0
+    for uuid in devices:
+        cond = f"uuid = {p}" if uuid is not None else "uuid IS NULL"
+        params = [uuid] if uuid is not None else []
+        sql = f"SELECT {_RECORD_COLS} FROM {src} WHERE {cond} AND time >= {p} AND time < {p}"
+        if use_sqlite():
+            async with _sqlite.execute(sql, params + [lo, hi]) as cur:
+                rows = [dict(r) for r in await cur.fetchall()]
+        else:
+            async with _pool.acquire() as conn:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    await cur.execute(sql, params + [lo, hi])
+                    rows = list(await cur.fetchall())
+        if not rows:
+            continue
+        await asyncio.to_thread(archive.write_month, key, rows)
+        # Only rows that were written; later inserts get higher ids.
+        max_id = max(int(r["id"]) for r in rows)
+        delete = f"DELETE FROM {{table}} WHERE {cond} AND time >= {p} AND time < {p} AND id <= {p}"
+        if use_sqlite():
+            await _sqlite_execute_records(delete, params + [lo, hi, max_id], lo, hi)
+        else:
+            async with _pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute(delete.format(table="records"), params + [lo, hi, max_id])
+        archived += len(rows)
+
+    if use_sqlite() and key in await _load_record_partitions():
+        async with _sqlite.execute(f"SELECT 1 FROM records_{key} LIMIT 1") as cur:
+            empty = await cur.fetchone() is None
+        if empty:
+            await _sqlite.execute(f"DROP TABLE IF EXISTS records_{key}")
+            await _sqlite.commit()
+            await _load_record_partitions(refresh=True)
+    if archived:
+        _bump_records_version()
+    return {"month": f"{key[:4]}-{key[4:]}", "devices": len(devices), "rows": archived}
+
+async def records_archive_due():
+    """Archives every month older than RECORDS_ARCHIVE_AFTER_MONTHS."""
+    first_kept = _month_offset(time.strftime("%Y%m"), -max(1, config.RECORDS_ARCHIVE_AFTER_MONTHS))
+    cutoff, _ = _month_bounds(first_kept)
+    expr = "strftime('%Y%m', time)" if use_sqlite() else "DATE_FORMAT(time, '%%Y%%m')"
+    p = "?" if use_sqlite() else "%s"
+    rows = await run_query(f"SELECT DISTINCT {expr} FROM {await _records_source(None, cutoff)} WHERE time < {p}", [cutoff])
+    done = []
+    for r in sorted(r[0] for r in rows if r[0]):
+        done.append(await records_archive_month(r))
+    return {"archived": done}
+
+async def records_list_archive():
+    out = []
+    for key in await asyncio.to_thread(archive.months):
+        files = await asyncio.to_thread(archive.month_files, key)
+        out.append({"month": f"{key[:4]}-{key[4:]}", "files": len(files)})
+    return out
+
+async def _archive_counts(by, uuids=None, start=None, end=None):
+    if not await asyncio.to_thread(archive.months):
+        return []
+    return await asyncio.to_thread(archive.aggregate, by, uuids, start, end)
+
 # --- Device / Records ---
 
 async def fetch_latest():
-    # Return list of latest record per device
-    # Join with registry to get names
+    """
+    Latest record (highest id) per device with its registry name. Only the hot
+    table is queried for devices that have rows there; sealed months are
+    consulted newest first, through _sealed_latest, for the rest.
+    """
     sql = """
-    SELECT r.*, reg.name, reg.category 
+    SELECT r.*, reg.name, reg.category
     FROM records r
     LEFT JOIN registry reg ON r.uuid = reg.uuid
     WHERE r.id IN (SELECT MAX(id) FROM records GROUP BY uuid)
     """
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return [dict(row) for row in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql)
-                return await cur.fetchall()
+    rows = await _run("fetch_latest", sql, (), dicts=True)
+    keys = await _load_record_partitions()
+    if not keys:
+        return rows
+    for key in list(_sealed_latest):
+        if key not in keys:
+            _sealed_latest.pop(key, None)
+    found = {r["uuid"] for r in rows}
+    for key in reversed(keys):
+        latest = _sealed_latest.get(key)
+        if latest is None:
+            latest = {r[0]: r[1] for r in await _run(
+                "fetch_latest.sealed", f"SELECT uuid, MAX(id) FROM records_{key} GROUP BY uuid")}
+            _sealed_latest[key] = latest
+        ids = [i for u, i in latest.items() if u not in found]
+        found.update(u for u in latest)
+        for i in range(0, len(ids), _SQLITE_MAX_VARS):
+            part = ids[i:i + _SQLITE_MAX_VARS]
+            rows.extend(await _run(
+                "fetch_latest.sealed",
+                f"SELECT r.*, reg.name, reg.category FROM records_{key} r "
+                f"LEFT JOIN registry reg ON r.uuid = reg.uuid WHERE r.id IN ({','.join(['?'] * len(part))})",
+                part, dicts=True,
+            ))
+    return rows
 
 async def fetch_history(uuid=None, start=None, end=None, limit=100):
     where = ["1=1"]
@@ -579,68 +968,77 @@ async def fetch_history(uuid=None, start=None, end=None, limit=100):
         where.append("time <= ?" if use_sqlite() else "time <= %s")
         params.append(end)
         
-    sql = f"SELECT * FROM records WHERE {' AND '.join(where)} ORDER BY time DESC LIMIT {limit}"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            rows = await cur.fetchall()
-            return [dict(row) for row in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql, params)
-                return await cur.fetchall()
+    sql = f"SELECT * FROM {await _records_source(start, end)} WHERE {' AND '.join(where)} ORDER BY time DESC LIMIT {limit}"
+    rows = await _run("fetch_history", sql, params, dicts=True)
+
+    archive_end = await asyncio.to_thread(archive.newest_month_end)
+    if archive_end is None:
+        return rows
+    if len(rows) >= int(limit) and rows and str(rows[-1]["time"]) >= archive_end:
+        return rows
+    cold = await asyncio.to_thread(archive.fetch, [uuid] if uuid else None, start, end, int(limit))
+    rows.extend(cold)
+    rows.sort(key=lambda r: str(r.get("time") or ""), reverse=True)
+    return rows[:int(limit)]
 
 async def get_device_ip(uuid):
     sql = "SELECT ip FROM registry WHERE uuid=?" if use_sqlite() else "SELECT ip FROM registry WHERE uuid=%s"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        cur = await _sqlite.execute(sql, (uuid,))
-        row = await cur.fetchone()
-        return row[0] if row else None
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, (uuid,))
-                row = await cur.fetchone()
-                return row[0] if row else None
+    row = await _run("get_device_ip", sql, (uuid,), fetch="one")
+    return row[0] if row else None
 
 async def list_devices():
     # Get all unique UUIDs from registry or records
-    sql = "SELECT DISTINCT uuid FROM registry UNION SELECT DISTINCT uuid FROM records"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return [{"uuid": row[0]} for row in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql)
-                rows = await cur.fetchall()
-                return [{"uuid": row[0]} for row in rows]
+    sql = f"SELECT DISTINCT uuid FROM registry UNION SELECT DISTINCT uuid FROM {await _records_source()}"
+    rows = await _run("list_devices", sql)
+    return [{"uuid": row[0]} for row in rows]
+
+async def get_device_mapping_tagged():
+    """(mapping, etag); cached until the registry changes or the TTL runs out."""
+    key = ("device", _mapping_version)
+    hit = _mapping_cache.get(key)
+    if hit is not None:
+        return hit
+    rows = await _run("get_device_mapping", "SELECT uuid, name, category FROM registry")
+    data = {"mapping": {row[0]: {"name": row[1], "category": row[2]} for row in rows}}
+    hit = (data, _etag(data))
+    _mapping_cache.set(key, hit)
+    return hit
 
 async def get_device_mapping():
-    sql = "SELECT uuid, name, category FROM registry"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return {"mapping": {row[0]: {"name": row[1], "category": row[2]} for row in rows}}
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql)
-                rows = await cur.fetchall()
-                return {"mapping": {row[0]: {"name": row[1], "category": row[2]} for row in rows}}
+    return (await get_device_mapping_tagged())[0]
 
 # --- Stats ---
 
+async def _hourly_rollup(group_sqlite, group_mysql, uuid=None, start=None, end=None):
+    """(key, in, out) rows from records_hourly, i.e. traffic already compacted out of records."""
+    where = ["1=1"]
+    params = []
+    if uuid:
+        where.append("uuid = ?" if use_sqlite() else "uuid = %s")
+        params.append(uuid)
+    if start:
+        where.append("hour >= ?" if use_sqlite() else "hour >= %s")
+        params.append(start)
+    if end:
+        where.append("hour <= ?" if use_sqlite() else "hour <= %s")
+        params.append(end)
+    expr = group_sqlite if use_sqlite() else group_mysql
+    sql = f"SELECT {expr} as k, SUM(in_count), SUM(out_count) FROM records_hourly WHERE {' AND '.join(where)} GROUP BY k"
+    rows = await run_query(sql, params, name="stats_rollup")
+    return [(str(r[0]), r[1], r[2]) for r in rows if r[0] is not None]
+
+def _merge_counts(rows, extra):
+    if not extra:
+        return rows
+    acc = {}
+    for k, i, o in list(rows) + list(extra):
+        if k is None:
+            continue
+        cur = acc.setdefault(k, [0, 0])
+        cur[0] += int(i or 0)
+        cur[1] += int(o or 0)
+    return [(k, v[0], v[1]) for k, v in sorted(acc.items())]
+
 async def stats_daily(uuid=None, start=None, end=None):
     # Group by date
     # SQLite: strftime('%Y-%m-%d', time)
@@ -658,26 +1056,17 @@ async def stats_daily(uuid=None, start=None, end=None):
         where.append(f"time <= ?") if use_sqlite() else where.append("time <= %s")
         params.append(end)
         
-    sql = f"SELECT {date_func} as d, SUM(in_count), SUM(out_count) FROM records WHERE {' AND '.join(where)} GROUP BY d ORDER BY d"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            rows = await cur.fetchall()
-            return [{"date": r[0], "in": r[1], "out": r[2]} for r in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, params)
-                rows = await cur.fetchall()
-                return [{"date": str(r[0]), "in": r[1], "out": r[2]} for r in rows]
+    sql = f"SELECT {date_func} as d, SUM(in_count), SUM(out_count) FROM {await _records_source(start, end)} WHERE {' AND '.join(where)} GROUP BY d ORDER BY d"
+    rows = [(r[0] if r[0] is None else str(r[0]), r[1], r[2]) for r in await _run("stats_daily", sql, params)]
+    rolled = await _hourly_rollup("strftime('%Y-%m-%d', hour)", "DATE(hour)", uuid, start, end)
+    rolled += await _archive_counts("day", [uuid] if uuid else None, start, end)
+    return [{"date": k, "in": i, "out": o} for k, i, o in _merge_counts(rows, rolled)]
 
 async def stats_hourly(uuid=None, start=None, end=None):
     # Group by hour
     # SQLite: strftime('%Y-%m-%d %H:00', time)
-    # MySQL: DATE_FORMAT(time, '%Y-%m-%d %H:00')
-    date_func = "strftime('%Y-%m-%d %H:00', time)" if use_sqlite() else "DATE_FORMAT(time, '%Y-%m-%d %H:00')"
+    # MySQL: DATE_FORMAT(time, '%Y-%m-%d %H:00'), % doubled since params are always passed
+    date_func = "strftime('%Y-%m-%d %H:00', time)" if use_sqlite() else "DATE_FORMAT(time, '%%Y-%%m-%%d %%H:00')"
     where = ["1=1"]
     params = []
     if uuid:
@@ -690,20 +1079,11 @@ async def stats_hourly(uuid=None, start=None, end=None):
         where.append(f"time <= ?") if use_sqlite() else where.append("time <= %s")
         params.append(end)
         
-    sql = f"SELECT {date_func} as h, SUM(in_count), SUM(out_count) FROM records WHERE {' AND '.join(where)} GROUP BY h ORDER BY h"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            rows = await cur.fetchall()
-            return [{"hour": r[0], "in": r[1], "out": r[2]} for r in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, params)
-                rows = await cur.fetchall()
-                return [{"hour": str(r[0]), "in": r[1], "out": r[2]} for r in rows]
+    sql = f"SELECT {date_func} as h, SUM(in_count), SUM(out_count) FROM {await _records_source(start, end)} WHERE {' AND '.join(where)} GROUP BY h ORDER BY h"
+    rows = [(r[0] if r[0] is None else str(r[0]), r[1], r[2]) for r in await _run("stats_hourly", sql, params)]
+    rolled = await _hourly_rollup("strftime('%Y-%m-%d %H:00', hour)", "DATE_FORMAT(hour, '%%Y-%%m-%%d %%H:00')", uuid, start, end)
+    rolled += await _archive_counts("hour", [uuid] if uuid else None, start, end)
+    return [{"hour": k, "in": i, "out": o} for k, i, o in _merge_counts(rows, rolled)]
 
 async def stats_total(uuid=None, start=None, end=None):
     where = ["1=1"]
@@ -718,19 +1098,15 @@ async def stats_total(uuid=None, start=None, end=None):
         where.append(f"time <= ?") if use_sqlite() else where.append("time <= %s")
         params.append(end)
     
-    sql = f"SELECT SUM(in_count), SUM(out_count) FROM records WHERE {' AND '.join(where)}"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            row = await cur.fetchone()
-            return {"in": row[0] or 0, "out": row[1] or 0}
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, params)
-                row = await cur.fetchone()
-                return {"in": row[0] or 0, "out": row[1] or 0}
+    sql = f"SELECT SUM(in_count), SUM(out_count) FROM {await _records_source(start, end)} WHERE {' AND '.join(where)}"
+    row = await _run("stats_total", sql, params, fetch="one")
+    total = {"in": row[0] or 0, "out": row[1] or 0}
+    extra = await _hourly_rollup("'total'", "'total'", uuid, start, end)
+    extra += await _archive_counts("total", [uuid] if uuid else None, start, end)
+    for _, i, o in extra:
+        total["in"] += int(i or 0)
+        total["out"] += int(o or 0)
+    return total
 
 async def stats_summary(uuid=None):
     # Simple summary + last update time
@@ -742,164 +1118,98 @@ async def stats_summary(uuid=None):
         where.append("uuid = ?" if use_sqlite() else "uuid = %s")
         params.append(uuid)
         
-    sql = f"SELECT MAX(time) FROM records WHERE {' AND '.join(where)}"
+    sql = f"SELECT MAX(time) FROM {await _records_source()} WHERE {' AND '.join(where)}"
     last_time = None
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            row = await cur.fetchone()
-            if row and row[0]:
-                last_time = row[0]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, params)
-                row = await cur.fetchone()
-                if row and row[0]:
-                    last_time = str(row[0])
+    row = await _run("stats_summary", sql, params, fetch="one")
+    if row and row[0]:
+        last_time = str(row[0])
+
+    if last_time is None:
+        rows = await run_query(f"SELECT MAX(hour) FROM records_hourly WHERE {' AND '.join(where)}", params, name="stats_rollup")
+        if rows and rows[0][0]:
+            last_time = str(rows[0][0])
                     
     return {**total, "last_time": last_time}
 
 async def stats_top(limit=10):
     # Top devices by traffic
-    sql = f"SELECT uuid, SUM(in_count) + SUM(out_count) as total FROM records GROUP BY uuid ORDER BY total DESC LIMIT {limit}"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return [{"uuid": r[0], "total": r[1]} for r in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql)
-                rows = await cur.fetchall()
-                return [{"uuid": r[0], "total": r[1]} for r in rows]
+    sql = f"SELECT uuid, COALESCE(SUM(in_count), 0) + COALESCE(SUM(out_count), 0) as total FROM {await _records_source()} GROUP BY uuid"
+    rows = await _run("stats_top", sql)
+    totals = {r[0]: r[1] for r in rows}
+    for k, i, o in await _hourly_rollup("uuid", "uuid") + await _archive_counts("uuid"):
+        totals[k] = int(totals.get(k) or 0) + int(i or 0) + int(o or 0)
+    ranked = sorted(totals.items(), key=lambda kv: kv[1] or 0, reverse=True)[:limit]
+    return [{"uuid": k, "total": v} for k, v in ranked]
 
 # --- Academies ---
 
 async def get_academies():
     sql = "SELECT * FROM academies ORDER BY sort_order ASC, name ASC"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return [{"id": r[0], "name": r[1], "sort_order": r[2] if len(r)>2 else 0} for r in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql)
-                rows = await cur.fetchall()
-                return [{"id": r[0], "name": r[1], "sort_order": r[2] if len(r)>2 else 0} for r in rows]
+    rows = await _run("get_academies", sql)
+    return [{"id": r[0], "name": r[1], "sort_order": r[2] if len(r)>2 else 0} for r in rows]
 
 async def update_academy_order(order_list: List[int]):
     # order_list is a list of IDs in the desired order
     logging.info(f"Updating academy order: {order_list}")
+    positions = {}
+    for idx, aid in enumerate(order_list):
+        positions[aid] = idx
+    if not positions:
+        return True
+    items = list(positions.items())
+    p = "?" if use_sqlite() else "%s"
+    # One CASE update per chunk (three bound values per academy), all in one transaction.
+    step = _SQLITE_MAX_VARS // 3
+    stmts = []
+    for i in range(0, len(items), step):
+        part = items[i:i + step]
+        sql = (f"UPDATE academies SET sort_order = CASE id {' '.join([f'WHEN {p} THEN {p}'] * len(part))} END "
+               f"WHERE id IN ({','.join([p] * len(part))})")
+        stmts.append((sql, [v for pair in part for v in pair] + [aid for aid, _ in part]))
     if use_sqlite():
         if not _sqlite: await init_sqlite()
         try:
-            for idx, aid in enumerate(order_list):
-                await _sqlite.execute("UPDATE academies SET sort_order=? WHERE id=?", (idx, aid))
+            for sql, params in stmts:
+                await _sqlite.execute(sql, params)
             await _sqlite.commit()
             logging.info("Academy order updated successfully (SQLite)")
             return True
-        except Exception as e:
-            logging.error(f"Failed to update academy order: {e}")
-            return False
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                try:
-                    for idx, aid in enumerate(order_list):
-                        await cur.execute("UPDATE academies SET sort_order=%s WHERE id=%s", (idx, aid))
-                    logging.info("Academy order updated successfully (MySQL)")
-                    return True
-                except Exception as e:
-                    logging.error(f"Failed to update academy order: {e}")
-                    return False
-
-async def add_academy(name):
-    sql = "INSERT INTO academies (name) VALUES (?)" if use_sqlite() else "INSERT INTO academies (name) VALUES (%s)"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        try:
-            await _sqlite.execute(sql, (name,))
-            await _sqlite.commit()
-            return True
-        except:
-            return False
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                try:
-                    await cur.execute(sql, (name,))
-                    return True
-                except:
-                    return False
-
-async def delete_academy(id):
-    sql = "DELETE FROM academies WHERE id=?" if use_sqlite() else "DELETE FROM academies WHERE id=%s"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (id,))
-        await _sqlite.commit()
-        return True
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, (id,))
-                return True
-
-# --- Admin ---
-
-async def admin_count_records(uuid=None, start=None, end=None, warn=None, rec_type=None, btx_min=None, btx_max=None):
-    where = ["1=1"]
-    params = []
-    if uuid:
-        where.append("uuid = ?" if use_sqlite() else "uuid = %s")
-        params.append(uuid)
-    if start:
-        where.append("time >= ?" if use_sqlite() else "time >= %s")
-        params.append(start)
-    if end:
-        where.append("time <= ?" if use_sqlite() else "time <= %s")
-        params.append(end)
-    if warn is not None:
-        where.append("warn_status = ?" if use_sqlite() else "warn_status = %s")
-        params.append(warn)
-    if rec_type is not None:
-        where.append("rec_type = ?" if use_sqlite() else "rec_type = %s")
-        params.append(rec_type)
-    if btx_min is not None:
-        where.append("btx >= ?" if use_sqlite() else "btx >= %s")
-        params.append(btx_min)
-    if btx_max is not None:
-        where.append("btx <= ?" if use_sqlite() else "btx <= %s")
-        params.append(btx_max)
-
-    sql = f"SELECT COUNT(*) FROM records WHERE {' AND '.join(where)}"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            row = await cur.fetchone()
-            return row[0]
+        except Exception as e:
+            await _sqlite.rollback()
+            logging.error(f"Failed to update academy order: {e}")
+            return False
     else:
         if not _pool: await init_pool()
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, params)
-                row = await cur.fetchone()
-                return row[0]
+                await conn.begin()
+                try:
+                    for sql, params in stmts:
+                        await cur.execute(sql, params)
+                    await conn.commit()
+                    logging.info("Academy order updated successfully (MySQL)")
+                    return True
+                except Exception as e:
+                    await conn.rollback()
+                    logging.error(f"Failed to update academy order: {e}")
+                    return False
 
-async def admin_list_records(page=1, limit=50, uuid=None, start=None, end=None, warn=None, rec_type=None, btx_min=None, btx_max=None):
-    offset = (page - 1) * limit
+async def add_academy(name):
+    sql = "INSERT INTO academies (name) VALUES (?)" if use_sqlite() else "INSERT INTO academies (name) VALUES (%s)"
+    try:
+        await _run("add_academy", sql, (name,), fetch=None)
+        return True
+    except:
+        return False
+
+async def delete_academy(id):
+    sql = "DELETE FROM academies WHERE id=?" if use_sqlite() else "DELETE FROM academies WHERE id=%s"
+    await _run("delete_academy", sql, (id,), fetch=None)
+    return True
+
+# --- Admin ---
+
+def _admin_records_where(uuid=None, start=None, end=None, warn=None, rec_type=None, btx_min=None, btx_max=None):
     where = ["1=1"]
     params = []
     if uuid:
@@ -923,20 +1233,90 @@ async def admin_list_records(page=1, limit=50, uuid=None, start=None, end=None,
     if btx_max is not None:
         where.append("btx <= ?" if use_sqlite() else "btx <= %s")
         params.append(btx_max)
-    
-    sql = f"SELECT * FROM records WHERE {' AND '.join(where)} ORDER BY time DESC LIMIT {limit} OFFSET {offset}"
-    
+    return " AND ".join(where), params
+
+async def admin_count_records(uuid=None, start=None, end=None, warn=None, rec_type=None, btx_min=None, btx_max=None):
+    key = (uuid, start, end, warn, rec_type, btx_min, btx_max)
+    cached = _count_cache.get(key)
+    if cached is not None:
+        return cached
+
+    where, params = _admin_records_where(uuid, start, end, warn, rec_type, btx_min, btx_max)
+    sql = f"SELECT COUNT(*) FROM {await _records_source(start, end)} WHERE {where}"
+    total = (await _run("admin_count_records", sql, params, fetch="one"))[0]
+    _count_cache.set(key, total)
+    return total
+
+async def admin_estimate_records(uuid=None, start=None, end=None, warn=None, rec_type=None, btx_min=None, btx_max=None):
+    """
+    Approximate row count from table statistics, without scanning records.
+    Only the unfiltered count can be answered this way; returns None otherwise
+    so the caller can fall back to admin_count_records.
+    """
+    if uuid or start or end or any(v is not None for v in (warn, rec_type, btx_min, btx_max)):
+        return None
     if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            rows = await cur.fetchall()
-            return [dict(row) for row in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql, params)
-                return await cur.fetchall()
+        # MIN/MAX on the rowid are index lookups; deleted rows make this an upper bound.
+        total = 0
+        for t in await _records_tables():
+            rows = await run_query(f"SELECT MAX(id) - MIN(id) + 1 FROM {t}", [])
+            if rows and rows[0][0] is not None:
+                total += int(rows[0][0])
+        return total
+    rows = await run_query(
+        "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'records'",
+        [],
+    )
+    if not rows or rows[0][0] is None:
+        return 0
+    return int(rows[0][0])
+
+async def admin_list_records(page=1, limit=50, uuid=None, start=None, end=None, warn=None, rec_type=None, btx_min=None, btx_max=None):
+    offset = (page - 1) * limit
+    where, params = _admin_records_where(uuid, start, end, warn, rec_type, btx_min, btx_max)
+    
+    sql = f"SELECT * FROM {await _records_source(start, end)} WHERE {where} ORDER BY time DESC LIMIT {limit} OFFSET {offset}"
+    return await _run("admin_list_records", sql, params, dicts=True)
+
+_EXPORT_CHUNK = 2000
+
+async def admin_iter_records(uuid=None, start=None, end=None, warn=None, rec_type=None, btx_min=None, btx_max=None, chunk=_EXPORT_CHUNK):
+    """
+    Yields lists of record dicts in (time, id) order, archived months first.
+    Pages by keyset rather than holding a cursor open, so memory stays at one
+    chunk and other queries on the shared connection are not blocked. An
+    archived month is filtered and sorted as columns, one month at a time,
+    and only each chunk is turned into dicts.
+    """
+    equals = {"warn_status": warn, "rec_type": rec_type}
+    ranges = {"btx": (btx_min, btx_max)}
+    if await asyncio.to_thread(archive.months):
+        for key in await asyncio.to_thread(archive.months_for, start, end):
+            lo, hi = _month_bounds(key)
+            cols = await asyncio.to_thread(archive.select_sorted, key, [uuid] if uuid else None,
+                                           max(str(start or lo), lo), min(str(end or hi), hi), equals, ranges)
+            if cols is None:
+                continue
+            for i in range(0, len(cols["time"]), chunk):
+                yield await asyncio.to_thread(archive.rows_slice, cols, i, i + chunk)
+
+    where, params = _admin_records_where(uuid, start, end, warn, rec_type, btx_min, btx_max)
+    src = await _records_source(start, end)
+    p = "?" if use_sqlite() else "%s"
+    last = None
+    while True:
+        cond, args = where, list(params)
+        if last is not None:
+            cond += f" AND (time > {p} OR (time = {p} AND id > {p}))"
+            args += [last[0], last[0], last[1]]
+        sql = f"SELECT {_RECORD_COLS} FROM {src} WHERE {cond} AND time IS NOT NULL ORDER BY time, id LIMIT {int(chunk)}"
+        rows = await _run("admin_iter_records", sql, args, dicts=True)
+        if not rows:
+            break
+        yield rows
+        if len(rows) < chunk:
+            break
+        last = (rows[-1]["time"], rows[-1]["id"])
 
 async def save_device_data(data: dict, ip: str = None):
     uuid = data.get("uuid")
@@ -955,44 +1335,25 @@ async def save_device_data(data: dict, ip: str = None):
         "warn_status": 0,
         "activity_type": "default"
     }
-    await admin_create_record(rec)
+    # A re-sent upload or a journal replay carries the same payload and is a
+    # no-op; a different upload stamped with the same second adds its counts.
+    await records_upsert([rec], accumulate=True)
     
     # Update registry last_seen and ip
-    sql_check = "SELECT uuid FROM registry WHERE uuid=?" if use_sqlite() else "SELECT uuid FROM registry WHERE uuid=%s"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        cur = await _sqlite.execute(sql_check, (uuid,))
-        row = await cur.fetchone()
-        if row:
-            sql = "UPDATE registry SET last_seen=CURRENT_TIMESTAMP"
-            params = []
-            if ip:
-                sql += ", ip=?"
-                params.append(ip)
-            sql += " WHERE uuid=?"
-            params.append(uuid)
-            await _sqlite.execute(sql, params)
-        else:
-            await _sqlite.execute("INSERT INTO registry (uuid, last_seen, ip) VALUES (?, CURRENT_TIMESTAMP, ?)", (uuid, ip))
-        await _sqlite.commit()
+    p = "?" if use_sqlite() else "%s"
+    row = await _run("save_device_data.registry", f"SELECT uuid FROM registry WHERE uuid={p}", (uuid,), fetch="one")
+    if row:
+        sql = "UPDATE registry SET last_seen=CURRENT_TIMESTAMP"
+        params = []
+        if ip:
+            sql += f", ip={p}"
+            params.append(ip)
+        sql += f" WHERE uuid={p}"
+        params.append(uuid)
+        await _run("save_device_data.registry", sql, params, fetch=None)
     else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql_check, (uuid,))
-                row = await cur.fetchone()
-                if row:
-                    sql = "UPDATE registry SET last_seen=CURRENT_TIMESTAMP"
-                    params = []
-                    if ip:
-                        sql += ", ip=%s"
-                        params.append(ip)
-                    sql += " WHERE uuid=%s"
-                    params.append(uuid)
-                    await cur.execute(sql, params)
-                else:
-                    await cur.execute("INSERT INTO registry (uuid, last_seen, ip) VALUES (%s, CURRENT_TIMESTAMP, %s)", (uuid, ip))
+        await _run("save_device_data.registry", f"INSERT INTO registry (uuid, last_seen, ip) VALUES ({p}, CURRENT_TIMESTAMP, {p})", (uuid, ip), fetch=None)
+        _bump_mapping_version()
 
 async def admin_create_record(data):
     # data is dict
@@ -1000,18 +1361,16 @@ async def admin_create_record(data):
     vals = list(data.values())
     placeholders = ["?"] * len(cols) if use_sqlite() else ["%s"] * len(cols)
     sql = f"INSERT INTO records ({','.join(cols)}) VALUES ({','.join(placeholders)})"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, vals)
-        await _sqlite.commit()
-        return True
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, vals)
-                return True
+    try:
+        await _run("admin_create_record", sql, vals, fetch=None)
+    except Exception as e:
+        if use_sqlite():
+            await _sqlite.rollback()
+        if _is_integrity_error(e):
+            raise RecordConflict(f"record {data.get('uuid')} @ {data.get('time')} already exists") from e
+        raise
+    _bump_records_version()
+    return True
 
 async def admin_update_record(id, data: dict):
     cols = []
@@ -1039,18 +1398,31 @@ async def admin_update_record(id, data: dict):
         return False
         
     vals.append(id)
-    sql = f"UPDATE records SET {','.join(cols)} WHERE id=?" if use_sqlite() else f"UPDATE records SET {','.join(cols)} WHERE id=%s"
+    sql = f"UPDATE {{table}} SET {','.join(cols)} WHERE id=?" if use_sqlite() else f"UPDATE records SET {','.join(cols)} WHERE id=%s"
     
     if use_sqlite():
         if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, vals)
-        await _sqlite.commit()
+        try:
+            await _sqlite_execute_records(sql, vals)
+            if "time" in data:
+                await _sqlite_rehome_records([id])
+            await _sqlite.commit()
+        except Exception as e:
+            await _sqlite.rollback()
+            if _is_integrity_error(e):
+                raise RecordConflict(f"another record already has time {data.get('time')}") from e
+            raise
+        _bump_records_version()
         return True
     else:
         if not _pool: await init_pool()
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, vals)
+                try:
+                    await cur.execute(sql, vals)
+                except pymysql.err.IntegrityError as e:
+                    raise RecordConflict(f"another record already has time {data.get('time')}") from e
+                _bump_records_version()
                 return True
 
 async def admin_batch_update(ids: list, data: dict):
@@ -1088,25 +1460,42 @@ async def admin_batch_update(ids: list, data: dict):
     
     vals.extend(ids)
     
-    sql = f"UPDATE records SET {','.join(cols)} {where}"
+    sql = f"UPDATE {{table}} SET {','.join(cols)} {where}"
     
     if use_sqlite():
         if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, vals)
-        await _sqlite.commit()
+        try:
+            await _sqlite_execute_records(sql, vals)
+            if "time" in data:
+                await _sqlite_rehome_records(ids)
+            await _sqlite.commit()
+        except Exception as e:
+            await _sqlite.rollback()
+            if _is_integrity_error(e):
+                raise RecordConflict(f"records would share time {data.get('time')}") from e
+            raise
+        _bump_records_version()
         return True
     else:
         if not _pool: await init_pool()
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, vals)
+                try:
+                    await cur.execute(sql.format(table="records"), vals)
+                except pymysql.err.IntegrityError as e:
+                    raise RecordConflict(f"records would share time {data.get('time')}") from e
+                _bump_records_version()
                 return True
 
 async def admin_batch_save_records(creates: list, updates: list):
-    # Batch save records (creates and updates)
+    """
+    Creates and updates in one transaction. A (uuid, time) collision rolls
+    the whole batch back and raises RecordConflict; other errors roll back
+    and propagate.
+    """
     if not creates and not updates:
         return True
-        
+
     if use_sqlite():
         if not _sqlite: await init_sqlite()
         try:
@@ -1129,17 +1518,24 @@ async def admin_batch_save_records(creates: list, updates: list):
                         vals.append(v)
                     if cols:
                         vals.append(uid)
-                        sql = f"UPDATE records SET {','.join(cols)} WHERE id=?"
-                        await _sqlite.execute(sql, vals)
+                        sql = f"UPDATE {{table}} SET {','.join(cols)} WHERE id=?"
+                        await _sqlite_execute_records(sql, vals)
+                        if "time" in u:
+                            await _sqlite_rehome_records([uid])
             await _sqlite.commit()
-            return True
         except Exception as e:
+            await _sqlite.rollback()
             logging.error(f"Batch save failed: {e}")
-            return False
+            if _is_integrity_error(e):
+                raise RecordConflict("batch would create duplicate (uuid, time) records") from e
+            raise
+        _bump_records_version()
+        return True
     else:
         if not _pool: await init_pool()
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
+                await conn.begin()
                 try:
                     # Creates
                     if creates:
@@ -1162,132 +1558,254 @@ async def admin_batch_save_records(creates: list, updates: list):
                                 vals.append(uid)
                                 sql = f"UPDATE records SET {','.join(cols)} WHERE id=%s"
                                 await cur.execute(sql, vals)
-                    return True
+                    await conn.commit()
                 except Exception as e:
+                    await conn.rollback()
                     logging.error(f"Batch save failed: {e}")
-                    return False
+                    if _is_integrity_error(e):
+                        raise RecordConflict("batch would create duplicate (uuid, time) records") from e
+                    raise
+        _bump_records_version()
+        return True
+
+_UPSERT_COLS = ["uuid", "time", "in_count", "out_count", "battery", "btx", "rec_type",
+                "signal_strength", "warn_status", "activity_type"]
+
+async def _records_accumulate(values):
+    """
+    Device-ingest variant of records_upsert, one row at a time in a single
+    transaction. A new (uuid, time) is inserted. On a collision the upload is
+    a retransmit, and changes nothing, when its payload equals the stored row
+    (nothing merged yet) or one of the digests in records_merged; otherwise
+    its counters are added to the row, its other columns replace the stored
+    ones, the digests are recorded and the key is queued in walkin_dirty.
+    """
+    payload_cols = migrations.RECORD_PAYLOAD_COLS
+    cols = ",".join(_UPSERT_COLS)
+    sets = ",".join(f"{c}=COALESCE({c}, 0) + COALESCE({{p}}, 0)" if c in ("in_count", "out_count") else f"{c}={{p}}"
+                    for c in payload_cols)
+
+    async def merge(q, p, tables, v):
+        uuid, ts, payload = v[0], v[1], v[2:]
+        for table in tables:
+            row = await q(f"SELECT {','.join(payload_cols)} FROM {table} WHERE uuid={p} AND time={p}", (uuid, ts))
+            if row is not None:
+                break
+        else:
+            await q(f"INSERT INTO records ({cols}) VALUES ({','.join([p] * len(v))})", v)
+            # A key that was deleted and comes back starts without history.
+            await q(f"DELETE FROM records_merged WHERE uuid={p} AND time={p}", (uuid, ts))
+            return
+        digest = migrations.record_digest(payload)
+        seen = await q(f"SELECT digest FROM records_merged WHERE uuid={p} AND time={p}", (uuid, ts), many=True)
+        seen = {r[0] for r in seen}
+        if digest in seen or (not seen and tuple(row) == tuple(payload)):
+            return
+        add = f"INSERT INTO records_merged (uuid, time, digest) VALUES ({p}, {p}, {p})"
+        if not seen:
+            await q(add, (uuid, ts, migrations.record_digest(tuple(row))))
+        await q(add, (uuid, ts, digest))
+        await q(f"UPDATE {table} SET {sets.format(p=p)} WHERE uuid={p} AND time={p}", payload + (uuid, ts))
+        await q(f"INSERT INTO walkin_dirty (uuid, time) VALUES ({p}, {p})", (uuid, ts))
 
-async def admin_delete_record(id):
-    sql = "DELETE FROM records WHERE id=?" if use_sqlite() else "DELETE FROM records WHERE id=%s"
     if use_sqlite():
         if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (id,))
-        await _sqlite.commit()
-        return True
+        sealed = set(await _load_record_partitions())
+
+        async def q(sql, params, many=False):
+            async with _sqlite.execute(sql, params) as cur:
+                return await cur.fetchall() if many else await cur.fetchone()
+        try:
+            for v in values:
+                # A sealed month's late rows wait in the hot table until the next seal.
+                key = str(v[1]).replace("-", "")[:6]
+                await merge(q, "?", [f"records_{key}", "records"] if key in sealed else ["records"], v)
+            await _sqlite.commit()
+        except Exception:
+            await _sqlite.rollback()
+            raise
     else:
         if not _pool: await init_pool()
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, (id,))
-                return True
+                async def q(sql, params, many=False):
+                    await cur.execute(sql, params)
+                    return await cur.fetchall() if many else await cur.fetchone()
+                await conn.begin()
+                try:
+                    for v in values:
+                        await merge(q, "%s", ["records"], v)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
 
-async def admin_delete_range(start, end):
-    sql = "DELETE FROM records WHERE time >= ? AND time <= ?" if use_sqlite() else "DELETE FROM records WHERE time >= %s AND time <= %s"
-    if use_sqlite():
+async def records_upsert(rows: list, accumulate: bool = False):
+    """
+    Inserts rows keyed on (uuid, time), overwriting the counters of rows that
+    already exist. One executemany per target table, no lookups beforehand.
+    accumulate=True is the device-ingest rule of _records_accumulate instead.
+    """
+    rows = [r for r in rows or [] if r.get("uuid") and r.get("time")]
+    if not rows:
+        return 0
+    cols = ",".join(_UPSERT_COLS)
+    values = [tuple(r.get(c) for c in _UPSERT_COLS) for r in rows]
+    set_cols = [c for c in _UPSERT_COLS if c not in ("uuid", "time")]
+    t0 = time.perf_counter()
+    if accumulate:
+        await _records_accumulate(values)
+    elif use_sqlite():
         if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (start, end))
-        await _sqlite.commit()
-        return True
+        on_conflict = "ON CONFLICT(uuid, time) DO UPDATE SET " + ",".join(f"{c}=excluded.{c}" for c in set_cols)
+        marks = ",".join(["?"] * len(_UPSERT_COLS))
+        sealed = set(await _load_record_partitions())
+        hot, cold = [], {}
+        for v in values:
+            key = str(v[1]).replace("-", "")[:6]
+            if key in sealed:
+                cold.setdefault(key, []).append(v)
+            else:
+                hot.append(v)
+        try:
+            if hot:
+                await _sqlite.executemany(f"INSERT INTO records ({cols}) VALUES ({marks}) {on_conflict}", hot)
+            for key, part in cold.items():
+                # Existing rows live in the sealed table; new ones go to the hot
+                # table like any late row, and the next seal moves them over.
+                table = f"records_{key}"
+                sets = ",".join(f"{c}=?" for c in set_cols)
+                await _sqlite.executemany(
+                    f"UPDATE {table} SET {sets} WHERE uuid=? AND time=?",
+                    [v[2:] + v[:2] for v in part],
+                )
+                await _sqlite.executemany(
+                    f"INSERT INTO records ({cols}) SELECT {marks} "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE uuid=? AND time=?) {on_conflict}",
+                    [v + v[:2] for v in part],
+                )
+            await _sqlite.commit()
+        except Exception:
+            await _sqlite.rollback()
+            raise
     else:
         if not _pool: await init_pool()
+        on_dup = "ON DUPLICATE KEY UPDATE " + ",".join(f"{c}=VALUES({c})" for c in set_cols)
+        marks = ",".join(["%s"] * len(_UPSERT_COLS))
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, (start, end))
-                return True
+                await cur.executemany(f"INSERT INTO records ({cols}) VALUES ({marks}) {on_dup}", values)
+    _record_query("records_upsert", (time.perf_counter() - t0) * 1000, len(values))
+    _bump_records_version()
+    return len(values)
 
-async def admin_list_registry():
-    sql = "SELECT * FROM registry"
+async def admin_delete_record(id):
+    sql = "DELETE FROM {table} WHERE id=?" if use_sqlite() else "DELETE FROM records WHERE id=%s"
     if use_sqlite():
         if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return [dict(row) for row in rows]
+        await _sqlite_execute_records(sql, (id,))
+        await _sqlite.commit()
     else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql)
-                return await cur.fetchall()
+        await _run("admin_delete_record", sql, (id,), fetch=None)
+    _bump_records_version()
+    return True
+
+async def admin_delete_range(start, end, job=None):
+    """
+    Deletes records with start <= time <= end in chunks of
+    RECORDS_DELETE_CHUNK, committing and yielding between chunks so ingest
+    can get the write lock. Chunks follow the time index in (time, id) order,
+    each one seeking past the previous chunk's last row, so a chunk costs
+    its own size rather than a rescan of the range. Progress goes into
+    job["deleted"] when given.
+    """
+    p = "?" if use_sqlite() else "%s"
+    after = f"time >= {p} AND (time > {p} OR id > {p})"
+    tables = await _records_tables(start, end) if use_sqlite() else ["records"]
+    deleted = 0
+    for table in tables:
+        lo = (start, 0)
+        while True:
+            hi = await _run(
+                "admin_delete_range.chunk",
+                f"SELECT time, id FROM {table} WHERE {after} AND time <= {p} "
+                f"ORDER BY time, id LIMIT 1 OFFSET {p}",
+                (lo[0], lo[0], lo[1], end, config.RECORDS_DELETE_CHUNK - 1), fetch="one",
+            )
+            if hi:
+                cond = f"{after} AND time <= {p} AND (time < {p} OR id <= {p})"
+                params = (lo[0], lo[0], lo[1], hi[0], hi[0], hi[1])
+            else:
+                cond = f"{after} AND time <= {p}"
+                params = (lo[0], lo[0], lo[1], end)
+            n = await _run("admin_delete_range", f"DELETE FROM {table} WHERE {cond}", params, fetch=None)
+            deleted += max(n or 0, 0)
+            _bump_records_version()
+            if job is not None:
+                job["deleted"] = deleted
+            if not hi:
+                break
+            lo = (hi[0], hi[1])
+            await _delete_pause()
+    _bump_records_version()
+    return deleted
+
+async def admin_list_registry():
+    return await _run("admin_list_registry", "SELECT * FROM registry", dicts=True)
 
 async def admin_upsert_registry(uuid, name=None, category=None):
-    # Check if exists
-    sql_check = "SELECT uuid FROM registry WHERE uuid=?" if use_sqlite() else "SELECT uuid FROM registry WHERE uuid=%s"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        cursor = await _sqlite.execute(sql_check, (uuid,))
-        row = await cursor.fetchone()
-        if row:
-            # Update
-            updates = []
-            params = []
-            if name is not None:
-                updates.append("name=?")
-                params.append(name)
-            if category is not None:
-                updates.append("category=?")
-                params.append(category)
-            if updates:
-                params.append(uuid)
-                await _sqlite.execute(f"UPDATE registry SET {','.join(updates)} WHERE uuid=?", params)
-        else:
-            # Insert
-            await _sqlite.execute("INSERT INTO registry (uuid, name, category) VALUES (?, ?, ?)", (uuid, name, category))
-        await _sqlite.commit()
-        return True
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql_check, (uuid,))
-                row = await cur.fetchone()
-                if row:
-                    updates = []
-                    params = []
-                    if name is not None:
-                        updates.append("name=%s")
-                        params.append(name)
-                    if category is not None:
-                        updates.append("category=%s")
-                        params.append(category)
-                    if updates:
-                        params.append(uuid)
-                        await cur.execute(f"UPDATE registry SET {','.join(updates)} WHERE uuid=%s", params)
-                else:
-                    await cur.execute("INSERT INTO registry (uuid, name, category) VALUES (%s, %s, %s)", (uuid, name, category))
-                return True
+    return await admin_batch_upsert([{"uuid": uuid, "name": name, "category": category}]) > 0
 
 async def admin_batch_upsert(items: list):
+    """
+    Upserts registry rows in one executemany and one transaction; a None
+    name/category leaves the stored value alone. Returns the number of
+    items written.
+    """
+    rows = {}
     for item in items:
-        await admin_upsert_registry(item.get("uuid"), item.get("name"), item.get("category"))
-    return True
-
-async def admin_write_op(actor, action, target, details):
-    sql = "INSERT INTO audit_logs (actor, action, target, details) VALUES (?, ?, ?, ?)" if use_sqlite() else "INSERT INTO audit_logs (actor, action, target, details) VALUES (%s, %s, %s, %s)"
+        uuid = item.get("uuid")
+        if uuid:
+            rows[uuid] = (uuid, item.get("name"), item.get("category"))
+    rows = list(rows.values())
+    if not rows:
+        return 0
+    t0 = time.perf_counter()
     if use_sqlite():
         if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (actor, action, target, details))
-        await _sqlite.commit()
+        sql = ("INSERT INTO registry (uuid, name, category) VALUES (?, ?, ?) "
+               "ON CONFLICT(uuid) DO UPDATE SET name=COALESCE(excluded.name, registry.name), "
+               "category=COALESCE(excluded.category, registry.category)")
+        try:
+            await _sqlite.executemany(sql, rows)
+            await _sqlite.commit()
+        except Exception:
+            await _sqlite.rollback()
+            raise
     else:
         if not _pool: await init_pool()
+        sql = ("INSERT INTO registry (uuid, name, category) VALUES (%s, %s, %s) "
+               "ON DUPLICATE KEY UPDATE name=COALESCE(VALUES(name), name), category=COALESCE(VALUES(category), category)")
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, (actor, action, target, details))
+                await conn.begin()
+                try:
+                    await cur.executemany(sql, rows)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+    _record_query("admin_batch_upsert", (time.perf_counter() - t0) * 1000, len(rows))
+    _bump_mapping_version()
+    return len(rows)
+
+async def admin_write_op(actor, action, target, details):
+    sql = "INSERT INTO audit_logs (actor, action, target, details) VALUES (?, ?, ?, ?)" if use_sqlite() else "INSERT INTO audit_logs (actor, action, target, details) VALUES (%s, %s, %s, %s)"
+    await _run("admin_write_op", sql, (actor, action, target, details), fetch=None)
 
 async def admin_get_categories():
-    sql = "SELECT DISTINCT category FROM registry"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return [r[0] for r in rows if r[0]]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql)
-                rows = await cur.fetchall()
-                return [r[0] for r in rows if r[0]]
+    rows = await _run("admin_get_categories", "SELECT DISTINCT category FROM registry")
+    return [r[0] for r in rows if r[0]]
 
 async def admin_get_uuids():
     return await list_devices()
@@ -1304,170 +1822,182 @@ async def list_alerts(uuid=None, limit=100):
         params.append(uuid)
     
     sql += f" ORDER BY time DESC LIMIT {limit}"
-    
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            rows = await cur.fetchall()
-            return [dict(row) for row in rows]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(sql, params)
-                return await cur.fetchall()
+    return await _run("list_alerts", sql, params, dicts=True)
 
 # --- Activity Events (Preserved) ---
 
+_ACTIVITY_COLS = ["date", "weekday", "start_time", "end_time", "duration_minutes", "academy", "location", "activity_name", "activity_type", "audience_count", "notes"]
+_ACTIVITY_SIG = ["date", "start_time", "location", "activity_name"]
+_ACTIVITY_LOOKUP_CHUNK = 200
+
+# activity_events is a view over activity_facts; location, academy and type are
+# stored as ids into their dimension tables. view column -> (fact column, table)
+_ACTIVITY_DIMS = {col: (fk, table) for fk, table, col in migrations.ACTIVITY_DIMENSIONS}
+_ACTIVITY_FACT_COLS = [_ACTIVITY_DIMS[c][0] if c in _ACTIVITY_DIMS else c for c in _ACTIVITY_COLS]
+_ACTIVITY_FACT_SIG = [_ACTIVITY_DIMS[c][0] if c in _ACTIVITY_DIMS else c for c in _ACTIVITY_SIG]
+# view column -> {name: id}. Dimension rows are never deleted and a rename
+# keeps its id, so entries stay valid; missing names are looked up on demand.
+_activity_dim_ids = {col: {} for col in _ACTIVITY_DIMS}
+
+async def _activity_dim_resolve(col, names):
+    """name -> id in col's dimension table, adding names seen for the first time."""
+    known = _activity_dim_ids[col]
+    missing = sorted({n for n in names if n is not None and n not in known})
+    if not missing:
+        return known
+    _, table = _ACTIVITY_DIMS[col]
+    p = "?" if use_sqlite() else "%s"
+    insert = "INSERT OR IGNORE" if use_sqlite() else "INSERT IGNORE"
+    for i in range(0, len(missing), _SQLITE_MAX_VARS):
+        part = missing[i:i + _SQLITE_MAX_VARS]
+        await _run("activity_dims.insert", f"{insert} INTO {table} (name) VALUES {','.join([f'({p})'] * len(part))}", part, fetch=None)
+        rows = await _run("activity_dims.lookup", f"SELECT name, id FROM {table} WHERE name IN ({','.join([p] * len(part))})", part)
+        got = {r[0]: r[1] for r in rows}
+        known.update(got)
+        # MySQL's PAD SPACE collations match "Room A " to a stored "Room A"
+        # and return the stored spelling; map the requested name to that id.
+        folded = {str(n).rstrip(): i for n, i in got.items()}
+        for n in part:
+            if n not in known and str(n).rstrip() in folded:
+                known[n] = folded[str(n).rstrip()]
+    return known
+
+def _activity_fact_values(e, cols):
+    """Values of cols from a name-keyed event, dimension names replaced by their (resolved) ids."""
+    return tuple(_activity_dim_ids[c].get(e.get(c)) if c in _ACTIVITY_DIMS else e.get(c) for c in cols)
+
+def _activity_sig(e):
+    sig = tuple(e.get(c) for c in _ACTIVITY_SIG)
+    # NULLs never collide in the unique index, so they never count as duplicates.
+    return None if any(v is None for v in sig) else sig
+
+async def _activity_existing_sigs(sigs):
+    """
+    Stored rows among these signatures, sig -> {column: value}; index
+    lookups, O(batch). The filter-option columns come along so the options
+    dictionary can be adjusted when an overwrite changes them. The signature
+    locations must already be resolved.
+    """
+    p = "?" if use_sqlite() else "%s"
+    # OR of equality groups rather than a row-value IN: both engines turn it
+    # into unique-index probes, SQLite scans the index for the IN form.
+    match = "(" + " AND ".join(f"f.{c}={p}" for c in _ACTIVITY_FACT_SIG) + ")"
+    extra = [c for _, c in _OPTION_DIMS if c not in _ACTIVITY_SIG]
+    select = [f"f.{c}" for c in _ACTIVITY_FACT_SIG]
+    joins = ""
+    for c in extra:
+        if c in _ACTIVITY_DIMS:
+            fk, table = _ACTIVITY_DIMS[c]
+            select.append(f"{table}.name")
+            joins += f" LEFT JOIN {table} ON {table}.id = f.{fk}"
+        else:
+            select.append(f"f.{c}")
+    found = {}
+    sigs = list(sigs)
+    for i in range(0, len(sigs), _ACTIVITY_LOOKUP_CHUNK):
+        part = sigs[i:i + _ACTIVITY_LOOKUP_CHUNK]
+        keys = {_activity_fact_values(dict(zip(_ACTIVITY_SIG, sig)), _ACTIVITY_SIG): sig for sig in part}
+        rows = await _run(
+            "activity_bulk_insert.lookup",
+            f"SELECT {','.join(select)} FROM activity_facts f{joins} "
+            f"WHERE {' OR '.join([match] * len(keys))}",
+            [v for key in keys for v in key],
+        )
+        for r in rows:
+            r = tuple(r)
+            sig = keys[r[:len(_ACTIVITY_SIG)]]
+            found[sig] = dict(zip(_ACTIVITY_SIG + extra, sig + r[len(_ACTIVITY_SIG):]))
+    return found
+
 async def activity_bulk_insert(events: list[dict], mode: str = "skip"):
+    """
+    Inserts activities keyed on the uq_activity_signature index. mode "skip"
+    leaves existing rows alone and reports the batch indices that were
+    duplicates; "overwrite" updates them in place. One executemany either way.
+    """
     if not events:
         return {"inserted": 0, "updated": 0, "duplicates": []}
-    
-    # 1. Prepare
-    # Normalize keys for comparison. Key: (date, start_time, location, activity_name)
-    dates = [e.get("date") for e in events if e.get("date")]
-    if not dates:
-        return {"inserted": 0, "updated": 0, "duplicates": []}
 
-    min_date, max_date = min(dates), max(dates)
-    
-    # Fetch existing signatures in range with IDs
-    # Map: (date, start_time, location, activity_name) -> id
-    existing_map = {}
-    
-    cols = ["date", "weekday", "start_time", "end_time", "duration_minutes", "academy", "location", "activity_name", "activity_type", "audience_count", "notes"]
-    
-    check_sql = "SELECT id, date, start_time, location, activity_name FROM activity_events WHERE date >= ? AND date <= ?" if use_sqlite() else \
-                "SELECT id, date, start_time, location, activity_name FROM activity_events WHERE date >= %s AND date <= %s"
-    
-    rows = await run_query(check_sql, [min_date, max_date])
-    for r in rows:
-        # Tuple of (date, start_time, location, activity_name) -> id
-        sig = (r[1], r[2], r[3], r[4])
-        existing_map[sig] = r[0]
-        
-    to_insert = []
-    to_delete_ids = []
-    duplicate_indices = []
-    
-    # Track signatures processed in this batch to handle internal duplicates
-    batch_sigs = set()
+    for col in _ACTIVITY_DIMS:
+        await _activity_dim_resolve(col, (e.get(col) for e in events))
+    sigs = {_activity_sig(e) for e in events} - {None}
+    existing = await _activity_existing_sigs(sigs) if sigs else {}
 
+    duplicate_indices = []
+    current = dict(existing)  # sig -> values it will hold after this batch
+    new_sigs = set()
+    rows = []
+    option_deltas = []
     for i, e in enumerate(events):
-        sig = (e.get("date"), e.get("start_time"), e.get("location"), e.get("activity_name"))
-        
-        # Check against DB
-        db_id = existing_map.get(sig)
-        
-        # Check against current batch (internal duplicates)
-        is_internal_dup = sig in batch_sigs
-        
-        if db_id is not None:
-            # Exists in DB
-            if mode == "overwrite":
-                if not is_internal_dup:
-                    to_delete_ids.append(db_id)
-                    to_insert.append(e)
-                    batch_sigs.add(sig)
-                else:
-                    # If it's an internal duplicate and we are overwriting, 
-                    # we essentially just want the last one or first one?
-                    # Let's assume we append it to insert, but since we deleted the DB one, 
-                    # we will have multiple copies in DB unless we dedup inputs.
-                    # Standard behavior: insert all provided inputs.
-                    to_insert.append(e)
-            else:
-                duplicate_indices.append(i)
-        else:
-            # Not in DB
-            to_insert.append(e)
-            batch_sigs.add(sig)
-
-    inserted_count = 0
-    updated_count = 0
-    
-    # Connection Management
-    conn = None
-    cur = None
-    should_close = False
-    
-    try:
-        if use_sqlite():
-            if _sqlite is None: await init_sqlite()
-            conn = _sqlite
-            # SQLite doesn't need explicit cursor for execute/executemany on connection object usually, 
-            # but for transaction control we rely on the connection.
+        sig = _activity_sig(e)
+        if sig is not None and sig in current and mode != "overwrite":
+            duplicate_indices.append(i)
+            continue
+        if sig is not None:
+            if sig in current:
+                option_deltas.append((current[sig], -1))
+            elif sig not in existing:
+                new_sigs.add(sig)
+            current[sig] = e
+        option_deltas.append((e, 1))
+        rows.append(_activity_fact_values(e, _ACTIVITY_COLS))
+
+    cols = ",".join(_ACTIVITY_FACT_COLS)
+    set_cols = [c for c in _ACTIVITY_FACT_COLS if c not in _ACTIVITY_FACT_SIG]
+    t0 = time.perf_counter()
+    written = 0
+    if use_sqlite():
+        if _sqlite is None: await init_sqlite()
+        marks = ",".join(["?"] * len(_ACTIVITY_COLS))
+        if mode == "overwrite":
+            sql = (f"INSERT INTO activity_facts ({cols}) VALUES ({marks}) "
+                   f"ON CONFLICT({','.join(_ACTIVITY_FACT_SIG)}) DO UPDATE SET " + ",".join(f"{c}=excluded.{c}" for c in set_cols))
         else:
-            if _pool is None: await init_pool()
-            conn = await _pool.acquire()
-            cur = await conn.cursor()
-            should_close = True
-            await conn.begin() # Start transaction for MySQL
-
-        # 2. Bulk Delete (for Overwrite)
-        if to_delete_ids:
-            # SQLite limit is usually 999 vars, MySQL packet size limit. Safe batch: 500.
-            BATCH_SIZE = 500
-            for i in range(0, len(to_delete_ids), BATCH_SIZE):
-                chunk_ids = to_delete_ids[i:i + BATCH_SIZE]
-                placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(chunk_ids))
-                del_sql = f"DELETE FROM activity_events WHERE id IN ({placeholders})"
-                
-                if use_sqlite():
-                    await conn.execute(del_sql, chunk_ids)
-                else:
-                    await cur.execute(del_sql, chunk_ids)
-            
-            updated_count = len(to_delete_ids)
-
-        # 3. Bulk Insert (New + Overwritten)
-        if to_insert:
-            BATCH_SIZE = 500
-            for i in range(0, len(to_insert), BATCH_SIZE):
-                chunk = to_insert[i:i + BATCH_SIZE]
-                
-                vals = []
-                for e in chunk:
-                    vals.extend([e.get(c) for c in cols])
-                
-                placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(cols))
-                row_placeholder = f"({placeholders})"
-                all_placeholders = ",".join([row_placeholder] * len(chunk))
-                
-                insert_sql = f"INSERT INTO activity_events({','.join(cols)}) VALUES {all_placeholders}"
-                
-                if use_sqlite():
-                    await conn.execute(insert_sql, vals)
-                else:
-                    await cur.execute(insert_sql, vals)
-            
-            inserted_count = len(to_insert) - updated_count # True new inserts
-            # Wait, if mode=overwrite, inserted_count should probably reflect total inserted?
-            # Or "inserted" = new records, "updated" = replaced records.
-            # If I delete 10 and insert 15 (10 replaced + 5 new), then updated=10, inserted=5?
-            # Simpler: inserted = len(to_insert) if mode!=overwrite else len(to_insert) - len(to_delete_ids)
-            # Actually return raw counts makes more sense
-            inserted_count = len(to_insert)
-
-        # Commit Transaction
-        if use_sqlite():
-            await conn.commit()
+            sql = f"INSERT OR IGNORE INTO activity_facts ({cols}) VALUES ({marks})"
+        try:
+            if rows:
+                cur = await _sqlite.executemany(sql, rows)
+                written = max(cur.rowcount or 0, 0)
+            await _sqlite.commit()
+        except Exception as e:
+            await _sqlite.rollback()
+            logging.error(f"Bulk insert failed: {e}")
+            raise
+    else:
+        if _pool is None: await init_pool()
+        marks = ",".join(["%s"] * len(_ACTIVITY_COLS))
+        if mode == "overwrite":
+            sql = (f"INSERT INTO activity_facts ({cols}) VALUES ({marks}) "
+                   f"ON DUPLICATE KEY UPDATE " + ",".join(f"{c}=VALUES({c})" for c in set_cols))
         else:
-            await conn.commit()
-            
-    except Exception as e:
-        if not use_sqlite() and conn:
-            await conn.rollback()
-        logging.error(f"Bulk insert failed: {e}")
-        raise e
-    finally:
-        if should_close and cur:
-            await cur.close()
-        if should_close and conn:
-            # release back to pool
-            _pool.release(conn)
-
-    return {"inserted": inserted_count, "updated": updated_count, "duplicates": duplicate_indices}
+            sql = f"INSERT IGNORE INTO activity_facts ({cols}) VALUES ({marks})"
+        async with _pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                try:
+                    if rows:
+                        await cur.executemany(sql, rows)
+                        written = max(cur.rowcount or 0, 0)
+                except Exception as e:
+                    logging.error(f"Bulk insert failed: {e}")
+                    raise
+    _record_query("activity_bulk_insert", (time.perf_counter() - t0) * 1000, len(rows))
+    if mode != "overwrite" and written != len(rows):
+        # Someone else inserted some of these in the meantime.
+        _activity_options_invalidate()
+    else:
+        for values, delta in option_deltas:
+            _activity_options_apply(values, delta)
+    _bump_activity_version()
+
+    nulls = sum(1 for e in events if _activity_sig(e) is None)
+    if mode == "overwrite":
+        inserted = len(new_sigs) + nulls
+        updated = len(rows) - inserted
+    else:
+        # INSERT OR IGNORE / INSERT IGNORE rowcount is what actually went in.
+        inserted = written
+        updated = 0
+    return {"inserted": inserted, "updated": updated, "duplicates": duplicate_indices}
 
 async def activity_list(start_date: str = None, end_date: str = None, locations: list = None, types: list = None, academies: list = None, weekdays: list = None, start_times: list = None, page: int = 1, page_size: int = 50):
     offset = (page - 1) * page_size
@@ -1496,84 +2026,103 @@ async def activity_list(start_date: str = None, end_date: str = None, locations:
         sql += f" AND weekday IN ({placeholders})"
         params.extend(weekdays)
     if start_times:
-        placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(start_times))
-        sql += f" AND start_time IN ({placeholders})"
-        params.extend(start_times)
-    
-    sql += " ORDER BY date DESC, start_time DESC"
-    
-    count_sql_opt = sql.replace("SELECT *", "SELECT COUNT(*)", 1)
-    
-    total = 0
-    items = []
-    
-    if use_sqlite():
-        if _sqlite is None:
-            await init_sqlite()
-        if _sqlite:
-            cur = await _sqlite.execute(count_sql_opt, params)
-            row = await cur.fetchone()
-            total = row[0] if row else 0
-            
-            sql += " LIMIT ? OFFSET ?"
-            params.extend([page_size, offset])
-            cur = await _sqlite.execute(sql, params)
-            rows = await cur.fetchall()
-            items = [dict(r) for r in rows]
-            return {"total": total, "items": items}
-            
-    if _pool is None:
-        await init_pool()
-    if _pool:
-        async with _pool.acquire() as conn:
-            async with conn.cursor(aiomysql.DictCursor) as cur:
-                await cur.execute(count_sql_opt, params)
-                row = await cur.fetchone()
-                total = row['COUNT(*)'] if row else 0
-                
-                sql += " LIMIT %s OFFSET %s"
-                params.extend([page_size, offset])
-                await cur.execute(sql, params)
-                rows = await cur.fetchall()
-                items = rows
+        placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(start_times))
+        sql += f" AND start_time IN ({placeholders})"
+        params.extend(start_times)
+    
+    sql += " ORDER BY date DESC, start_time DESC"
+    
+    count_sql_opt = sql.replace("SELECT *", "SELECT COUNT(*)", 1)
+    
+    row = await _run("activity_list.count", count_sql_opt, params, fetch="one")
+    total = row[0] if row else 0
+
+    sql += " LIMIT ? OFFSET ?" if use_sqlite() else " LIMIT %s OFFSET %s"
+    items = await _run("activity_list", sql, params + [page_size, offset], dicts=True)
     return {"total": total, "items": items}
 
+# --- Activity filter options ---
+#
+# Distinct values of the activity page filters, with row counts so a value
+# disappears with its last row. Built with one grouped scan per dimension on
+# first use (and every ACTIVITY_OPTIONS_REFRESH_SEC), then adjusted in place
+# by the activity writers.
+
+_OPTION_DIMS = (("locations", "location"), ("types", "activity_type"), ("academies", "academy"),
+                ("weekdays", "weekday"), ("times", "start_time"))
+_activity_options = None  # key -> {value: rows}
+_activity_options_stale = set()
+_activity_options_built = 0.0
+_activity_options_tagged = None  # (data, etag)
+
+def _activity_options_apply(values, delta):
+    global _activity_options_tagged
+    if _activity_options is None:
+        return
+    for key, col in _OPTION_DIMS:
+        v = values.get(col)
+        if not v:
+            continue
+        counts = _activity_options[key]
+        n = counts.get(v, 0) + delta
+        if n > 0:
+            counts[v] = n
+        else:
+            counts.pop(v, None)
+    _activity_options_tagged = None
+
+def _activity_options_invalidate(*keys):
+    global _activity_options_tagged
+    _activity_options_stale.update(keys or [k for k, _ in _OPTION_DIMS])
+    _activity_options_tagged = None
+
+async def _activity_option_counts(col):
+    if col in _ACTIVITY_DIMS:
+        # Group on the integer key, then name the groups.
+        fk, table = _ACTIVITY_DIMS[col]
+        sql = (f"SELECT d.name, c.n FROM (SELECT {fk}, COUNT(*) AS n FROM activity_facts GROUP BY {fk}) c "
+               f"JOIN {table} d ON d.id = c.{fk}")
+    else:
+        sql = f"SELECT {col}, COUNT(*) FROM activity_facts GROUP BY {col}"
+    rows = await _run("activity_get_options", sql)
+    return {r[0]: r[1] for r in rows if r[0]}
+
+async def activity_get_options_tagged():
+    """(options, etag); no query unless the dictionary is missing or stale."""
+    global _activity_options, _activity_options_built, _activity_options_tagged
+    if _activity_options is None or time.monotonic() - _activity_options_built > config.ACTIVITY_OPTIONS_REFRESH_SEC:
+        _activity_options_stale.update(k for k, _ in _OPTION_DIMS)
+    if _activity_options_stale:
+        version = _activity_version
+        keys = set(_activity_options_stale)
+        _activity_options_stale.clear()
+        built = dict(_activity_options or {})
+        for key, col in _OPTION_DIMS:
+            if key in keys:
+                built[key] = await _activity_option_counts(col)
+        if len(keys) == len(_OPTION_DIMS):
+            _activity_options_built = time.monotonic()
+        if _activity_version != version:
+            # A write landed while we were scanning; look again next time.
+            _activity_options_stale.update(keys)
+        _activity_options = built
+        _activity_options_tagged = None
+    if _activity_options_tagged is None:
+        data = {key: sorted(_activity_options[key]) for key, _ in _OPTION_DIMS}
+        _activity_options_tagged = (data, _etag(data))
+    return _activity_options_tagged
+
 async def activity_get_options():
-    if use_sqlite():
-        if _sqlite is None:
-            await init_sqlite()
-        if _sqlite:
-            l_cur = await _sqlite.execute("SELECT DISTINCT location FROM activity_events ORDER BY location")
-            locations = [r[0] for r in await l_cur.fetchall() if r[0]]
-            t_cur = await _sqlite.execute("SELECT DISTINCT activity_type FROM activity_events ORDER BY activity_type")
-            types = [r[0] for r in await t_cur.fetchall() if r[0]]
-            a_cur = await _sqlite.execute("SELECT DISTINCT academy FROM activity_events ORDER BY academy")
-            academies = [r[0] for r in await a_cur.fetchall() if r[0]]
-            w_cur = await _sqlite.execute("SELECT DISTINCT weekday FROM activity_events ORDER BY weekday")
-            weekdays = [r[0] for r in await w_cur.fetchall() if r[0]]
-            s_cur = await _sqlite.execute("SELECT DISTINCT start_time FROM activity_events ORDER BY start_time")
-            times = [r[0] for r in await s_cur.fetchall() if r[0]]
-            return {"locations": locations, "types": types, "academies": academies, "weekdays": weekdays, "times": times}
-    
-    if _pool is None:
-        await init_pool()
-    if _pool:
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("SELECT DISTINCT location FROM activity_events ORDER BY location")
-                locations = [r[0] for r in await cur.fetchall() if r[0]]
-                await cur.execute("SELECT DISTINCT activity_type FROM activity_events ORDER BY activity_type")
-                types = [r[0] for r in await cur.fetchall() if r[0]]
-                await cur.execute("SELECT DISTINCT academy FROM activity_events ORDER BY academy")
-                academies = [r[0] for r in await cur.fetchall() if r[0]]
-                await cur.execute("SELECT DISTINCT weekday FROM activity_events ORDER BY weekday")
-                weekdays = [r[0] for r in await cur.fetchall() if r[0]]
-                await cur.execute("SELECT DISTINCT start_time FROM activity_events ORDER BY start_time")
-                times = [r[0] for r in await cur.fetchall() if r[0]]
-                return {"locations": locations, "types": types, "academies": academies, "weekdays": weekdays, "times": times}
-    return {"locations": [], "types": [], "academies": [], "weekdays": [], "times": []}
+    return (await activity_get_options_tagged())[0]
+
+def _filter_key(*values):
+    return tuple(tuple(sorted(set(v))) if isinstance(v, (list, tuple, set)) else (v or None) for v in values)
 
 async def activity_stats(start_date: str = None, end_date: str = None, locations: list = None, types: list = None, academies: list = None, weekdays: list = None, start_times: list = None):
+    key = _filter_key(start_date, end_date, locations, types, academies, weekdays, start_times)
+    cached = _activity_stats_cache.get(key)
+    if cached is not None:
+        return cached
     where = " WHERE 1=1"
     params = []
     if start_date:
@@ -1584,15 +2133,15 @@ async def activity_stats(start_date: str = None, end_date: str = None, locations
         params.append(end_date)
     if locations:
         placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(locations))
-        where += f" AND location IN ({placeholders})"
+        where += f" AND location_id IN (SELECT id FROM activity_locations WHERE name IN ({placeholders}))"
         params.extend(locations)
     if types:
         placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(types))
-        where += f" AND activity_type IN ({placeholders})"
+        where += f" AND type_id IN (SELECT id FROM activity_types WHERE name IN ({placeholders}))"
         params.extend(types)
     if academies:
         placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(academies))
-        where += f" AND academy IN ({placeholders})"
+        where += f" AND academy_id IN (SELECT id FROM activity_academies WHERE name IN ({placeholders}))"
         params.extend(academies)
     if weekdays:
         placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(weekdays))
@@ -1603,55 +2152,59 @@ async def activity_stats(start_date: str = None, end_date: str = None, locations
         where += f" AND start_time IN ({placeholders})"
         params.extend(start_times)
 
-    async def run_query(sql, p):
-        if use_sqlite():
-             if _sqlite is None: await init_sqlite()
-             if _sqlite:
-                 cur = await _sqlite.execute(sql, p)
-                 return await cur.fetchall()
-        elif _pool:
-             if not _pool: await init_pool()
-             async with _pool.acquire() as conn:
-                 async with conn.cursor() as cur:
-                     await cur.execute(sql, p)
-                     return await cur.fetchall()
-        return []
+    # One grouped scan over the integer keys; every breakdown is a rollup of
+    # these groups, which are named afterwards.
+    hour = "substr(start_time, 1, 2)" if use_sqlite() else "LEFT(start_time, 2)"
+    sql = ("SELECT g.weekday, g.hour, l.name, t.name, g.n, g.audience, g.audience_rows FROM ("
+           f"SELECT weekday, {hour} AS hour, location_id, type_id, COUNT(*) AS n, SUM(audience_count) AS audience, "
+           f"COUNT(audience_count) AS audience_rows FROM activity_facts {where} "
+           f"GROUP BY weekday, {hour}, location_id, type_id) g "
+           "LEFT JOIN activity_locations l ON l.id = g.location_id LEFT JOIN activity_types t ON t.id = g.type_id")
+    rows = await run_query(sql, params, name="activity_stats")
+
+    def add(acc, k, n, aud):
+        cur = acc.get(k)
+        if cur is None:
+            acc[k] = [n, aud]
+        else:
+            cur[0] += n
+            if aud is not None:
+                cur[1] = aud if cur[1] is None else cur[1] + aud
+
+    wd, hr, loc, typ = {}, {}, {}, {}
+    total = audience = audience_rows = 0
+    for r in rows:
+        n, aud = r[4], r[5]
+        total += n
+        audience += aud or 0
+        audience_rows += r[6] or 0
+        add(wd, r[0], n, aud)
+        add(hr, r[1], n, aud)
+        add(loc, r[2], n, aud)
+        add(typ, r[3], n, aud)
+
+    def nulls_first(k):
+        return (k is not None, k or "")
 
-    kpi_sql = f"SELECT COUNT(*), SUM(audience_count), AVG(audience_count) FROM activity_events {where}"
-    kpi_res = await run_query(kpi_sql, params)
     kpis = {
-        "total_events": kpi_res[0][0] if kpi_res and kpi_res[0][0] else 0,
-        "total_audience": kpi_res[0][1] if kpi_res and kpi_res[0][1] else 0,
-        "avg_audience": round(kpi_res[0][2], 1) if kpi_res and kpi_res[0][2] else 0
+        "total_events": total,
+        "total_audience": audience,
+        "avg_audience": round(audience / audience_rows, 1) if audience_rows and audience else 0
     }
+    weekday_stats = [{"weekday": k, "count": v[0], "audience": v[1]} for k, v in sorted(wd.items(), key=lambda kv: nulls_first(kv[0]))]
+    time_stats = [{"hour": k, "count": v[0], "audience": v[1]} for k, v in sorted(hr.items(), key=lambda kv: nulls_first(kv[0]))]
+    location_top = [{"location": k, "count": v[0], "audience": v[1]} for k, v in sorted(loc.items(), key=lambda kv: -kv[1][0])[:20]]
+    type_stats = [{"type": k, "count": v[0], "audience": v[1]} for k, v in sorted(typ.items(), key=lambda kv: -kv[1][0])]
 
-    wd_sql = f"SELECT weekday, COUNT(*), SUM(audience_count) FROM activity_events {where} GROUP BY weekday ORDER BY weekday"
-    wd_res = await run_query(wd_sql, params)
-    weekday_stats = [{"weekday": r[0], "count": r[1], "audience": r[2]} for r in wd_res]
-
-    if use_sqlite():
-        time_sql = f"SELECT substr(start_time, 1, 2) as h, COUNT(*), SUM(audience_count) FROM activity_events {where} GROUP BY h ORDER BY h"
-    else:
-        time_sql = f"SELECT LEFT(start_time, 2) as h, COUNT(*), SUM(audience_count) FROM activity_events {where} GROUP BY h ORDER BY h"
-    
-    time_res = await run_query(time_sql, params)
-    time_stats = [{"hour": r[0], "count": r[1], "audience": r[2]} for r in time_res]
-    
-    loc_sql = f"SELECT location, COUNT(*), SUM(audience_count) FROM activity_events {where} GROUP BY location ORDER BY COUNT(*) DESC LIMIT 20"
-    loc_res = await run_query(loc_sql, params)
-    location_top = [{"location": r[0], "count": r[1], "audience": r[2]} for r in loc_res]
-    
-    type_sql = f"SELECT activity_type, COUNT(*), SUM(audience_count) FROM activity_events {where} GROUP BY activity_type ORDER BY COUNT(*) DESC"
-    type_res = await run_query(type_sql, params)
-    type_stats = [{"type": r[0], "count": r[1], "audience": r[2]} for r in type_res]
-    
-    return {
+    result = {
         "kpis": kpis,
         "weekday": weekday_stats,
         "time_bins": time_stats,
         "location_top": location_top,
         "activity_types": type_stats
     }
+    _activity_stats_cache.set(key, result)
+    return result
 
 async def admin_get_record_ids(uuid=None, start=None, end=None):
     where = " WHERE 1=1"
@@ -1666,168 +2219,204 @@ async def admin_get_record_ids(uuid=None, start=None, end=None):
         where += " AND time <= ?" if use_sqlite() else " AND time <= %s"
         params.append(end)
         
-    sql = f"SELECT id FROM records {where}"
+    sql = f"SELECT id FROM {await _records_source(start, end)} {where}"
     rows = await run_query(sql, params)
     return [r[0] for r in rows]
 
-async def admin_get_record_id_map_by_times(uuid: str, times: list):
-    if not uuid or not times:
-        return {}
+async def admin_batch_delete(ids, job=None):
+    """Deletes by id in sorted chunks that stay under SQLite's bound-variable limit."""
+    ids = sorted({int(i) for i in ids or [] if i is not None})
+    if not ids: return 0
+    chunk = max(1, min(config.RECORDS_DELETE_CHUNK, _SQLITE_MAX_VARS))
+    p = "?" if use_sqlite() else "%s"
+    deleted = 0
+    for i in range(0, len(ids), chunk):
+        part = ids[i:i + chunk]
+        sql = f"DELETE FROM {{table}} WHERE id IN ({','.join([p] * len(part))})"
+        if use_sqlite():
+            if _sqlite is None: await init_sqlite()
+            n = await _sqlite_execute_records(sql, part)
+            await _sqlite.commit()
+        else:
+            n = await _run("admin_batch_delete", sql.format(table="records"), part, fetch=None)
+        deleted += max(n or 0, 0)
+        _bump_records_version()
+        if job is not None:
+            job["deleted"] = deleted
+        await _delete_pause()
+    return deleted
+
+# --- Delete jobs ---
+#
+# Large deletes run as background tasks in this process; clients poll
+# get_delete_job(). Finished jobs are kept for a while in a small LRU.
+
+_SQLITE_MAX_VARS = 500
+_delete_jobs = LRUCache(maxsize=100, ttl=24 * 3600)
+_delete_tasks = set()
+
+async def _delete_pause():
+    await asyncio.sleep(config.RECORDS_DELETE_PAUSE_MS / 1000.0)
+
+async def _count_range(start, end):
+    p = "?" if use_sqlite() else "%s"
+    row = await _run(
+        "delete_job.count",
+        f"SELECT COUNT(*) FROM {await _records_source(start, end)} WHERE time >= {p} AND time <= {p}",
+        (start, end), fetch="one",
+    )
+    return int(row[0] or 0) if row else 0
+
+async def _run_delete_job(job, fn, *args):
+    job["status"] = "running"
+    job["started_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        if job["total"] is None:
+            job["total"] = await _count_range(*args)
+        job["deleted"] = await fn(*args, job=job)
+        job["status"] = "done"
+    except asyncio.CancelledError:
+        job["status"] = "cancelled"
+        raise
+    except Exception as e:
+        logging.exception("delete job %s failed", job["id"])
+        job["status"] = "failed"
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
 
-    placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(times))
-    sql = f"SELECT id, time FROM records WHERE uuid = {'?' if use_sqlite() else '%s'} AND time IN ({placeholders})"
-    params = [uuid]
-    params.extend(times)
-    rows = await run_query(sql, params)
-    return {str(r[1]): r[0] for r in rows}
+def _start_delete_job(kind, total, fn, *args):
+    job = {
+        "id": uuid.uuid4().hex, "kind": kind, "status": "queued",
+        "total": total, "deleted": 0, "error": None,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "started_at": None, "finished_at": None,
+    }
+    _delete_jobs.set(job["id"], job)
+    task = asyncio.create_task(_run_delete_job(job, fn, *args))
+    _delete_tasks.add(task)
+    task.add_done_callback(_delete_tasks.discard)
+    return dict(job)
+
+def start_delete_range_job(start, end):
+    return _start_delete_job("range", None, admin_delete_range, start, end)
+
+def start_batch_delete_job(ids):
+    ids = [i for i in ids or [] if i is not None]
+    return _start_delete_job("ids", len(set(ids)), admin_batch_delete, ids)
+
+def get_delete_job(job_id):
+    job = _delete_jobs.get(job_id)
+    return dict(job) if job else None
+
+# --- Walk-in visitors ---
+#
+# Walk-in events are the positive in_count of each device summed per slot of
+# the day (app.walkin, WALKIN_BUCKET_MINUTES wide). The database does the
+# bucketing, so a preview reads at most one row per device and slot however
+# dense the records are.
+#
+# The walk-in page re-requests the same preview while the operator adjusts the
+# view, so finished previews are cached. The key carries _records_version and
+# _mapping_version for writes made here, plus MAX(records.id) and
+# MAX(walkin_dirty.id) because tcp_server appends and merges from its own
+# process; the TTL covers anything else.
+
+_walkin_preview_cache = LRUCache(maxsize=config.WALKIN_PREVIEW_CACHE_SIZE, ttl=config.WALKIN_PREVIEW_CACHE_TTL_SEC)
+
+async def _walkin_preview_key(kind, devices, span, minutes):
+    row = await _run("walkin_preview.max_id",
+                     "SELECT (SELECT MAX(id) FROM records), (SELECT MAX(id) FROM walkin_dirty)", fetch="one")
+    hi = tuple(row) if row else None
+    return (kind, tuple(sorted(set(devices or []))), span, minutes, _records_version, _mapping_version, hi)
+
+def _walkin_bucket_exprs(minutes=None):
+    """(day, slot index) SQL expressions over records.time."""
+    return walkin.sql_exprs(use_sqlite(), walkin.bucket_minutes(minutes))
+
+async def _walkin_buckets(source, where, params, minutes=None):
+    """{(uuid, day, slot): in_count} for the rows of source matching where."""
+    day, idx = _walkin_bucket_exprs(minutes)
+    sql = (f"SELECT uuid, {day} AS d, {idx} AS b, SUM(CASE WHEN in_count > 0 THEN in_count ELSE 0 END) AS n "
+           f"FROM {source} {where} AND time IS NOT NULL GROUP BY uuid, d, b HAVING n > 0")
+    rows = await run_query(sql, params, name="walkin_buckets")
+    return {(r[0], str(r[1])[:10], int(r[2])): int(r[3]) for r in rows}
+
+async def _walkin_events(buckets, minutes=None, mapping=None, loc_academy=None):
+    import datetime
 
-async def admin_batch_delete(ids):
-    if not ids: return
-    placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(ids))
-    sql = f"DELETE FROM records WHERE id IN ({placeholders})"
-    
-    if use_sqlite():
-        if _sqlite is None: await init_sqlite()
-        if _sqlite:
-            await _sqlite.execute(sql, ids)
-            await _sqlite.commit()
-    elif not _pool: await init_pool()
-    if _pool:
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, ids)
+    minutes = walkin.bucket_minutes(minutes)
+    if mapping is None:
+        mapping_res = await get_device_mapping()
+        mapping = (mapping_res or {}).get("mapping") or {}
+    if loc_academy is None:
+        loc_academy = await get_location_academy_mapping()
 
-async def run_query(sql: str, params: list):
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql, params) as cur:
-            return await cur.fetchall()
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, params)
-                return await cur.fetchall()
+    wd_map = {1: "周一", 2: "周二", 3: "周三", 4: "周四", 5: "周五", 6: "周六", 7: "周日"}
+    weekdays = {}
 
-async def walkin_preview(devices: list, start: str, end: str):
-    # Query records
-    where = " WHERE 1=1"
-    params = []
-    
-    if devices:
-        placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(devices))
-        where += f" AND uuid IN ({placeholders})"
-        params.extend(devices)
-        
-    if start:
-        where += " AND time >= ?" if use_sqlite() else " AND time >= %s"
-        params.append(start)
-    if end:
-        where += " AND time <= ?" if use_sqlite() else " AND time <= %s"
-        params.append(end)
-        
-    sql = f"SELECT uuid, time, in_count FROM records {where} ORDER BY uuid, time"
-    
-    rows = await run_query(sql, params)
-    if not rows: return []
-    
-    import datetime
+    events = []
+    for (uuid, date, idx), count in buckets.items():
+        if count <= 0:
+            continue
+        s_time, e_time = walkin.slot_times(idx, minutes)
 
-    def to_dt(v):
-        if v is None:
-            return None
-        if isinstance(v, datetime.datetime):
-            return v
-        if isinstance(v, datetime.date):
-            return datetime.datetime(v.year, v.month, v.day, 0, 0, 0)
-        s = str(v).strip()
-        if not s:
-            return None
-        s = s.replace("T", " ")
-        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M"):
+        weekday = weekdays.get(date)
+        if weekday is None:
             try:
-                return datetime.datetime.strptime(s, fmt)
-            except Exception:
-                continue
-        return None
+                weekday = wd_map.get(datetime.date.fromisoformat(date).isoweekday(), "")
+            except ValueError:
+                weekday = ""
+            weekdays[date] = weekday
 
-    data_map = {}  # (uuid, date, interval_idx) -> {"sum": int}
-    
-    # 30 min intervals
-    def get_interval(dt):
-        idx = dt.hour * 2 + (1 if dt.minute >= 30 else 0)
-        return idx
-        
-    for r in rows:
-        uuid = r[0]
-        dt = to_dt(r[1])
-        in_c = r[2]
-        if dt is None or in_c is None:
-            continue
-            
-        date = dt.strftime("%Y-%m-%d")
-        idx = get_interval(dt)
-        
-        key = (uuid, date, idx)
-        if key not in data_map:
-            data_map[key] = {"sum": 0}
-        try:
-            v = int(in_c)
-        except Exception:
-            continue
-        if v > 0:
-            data_map[key]["sum"] += v
-            
-    # Generate Events
-    events = []
-    mapping_res = await get_device_mapping()
-    mapping = (mapping_res or {}).get("mapping") or {}
-    loc_academy = await get_location_academy_mapping()
-    
-    wd_map = {1:"周一", 2:"周二", 3:"周三", 4:"周四", 5:"周五", 6:"周六", 7:"周日"}
-    
-    for (uuid, date, idx), val in data_map.items():
-        count = int(val.get("sum") or 0)
-        if count <= 0: continue
-        
-        # Start Time
-        h = idx // 2
-        m = (idx % 2) * 30
-        s_time = f"{h:02d}:{m:02d}"
-        
-        # End Time
-        end_idx = idx + 1
-        eh = end_idx // 2
-        em = (end_idx % 2) * 30
-        if eh >= 24: 
-             e_time = "23:59"
-        else:
-             e_time = f"{eh:02d}:{em:02d}"
-             
-        dt = datetime.datetime.strptime(date, "%Y-%m-%d")
-        weekday = wd_map.get(dt.isoweekday(), "")
         dev = mapping.get(uuid) or {}
         loc_name = str((dev.get("name") or "")).strip() or uuid
         academy = str((loc_academy.get(loc_name) or dev.get("category") or "公共")).strip() or "公共"
-        
+
         events.append({
             "date": date,
             "weekday": weekday,
             "start_time": s_time,
             "end_time": e_time,
-            "duration_minutes": 30,
-            "academy": academy, 
-            "location": loc_name, 
+            "duration_minutes": minutes,
+            "academy": academy,
+            "location": loc_name,
             "activity_name": "散客",
             "activity_type": "散客访问",
             "audience_count": count,
             "notes": f"from device {uuid}"
         })
-    
-    # Sort by date, time
-    events.sort(key=lambda x: (x['date'], x['start_time']))
+    events.sort(key=lambda x: (x.get("date") or "", x.get("start_time") or "", x.get("location") or ""))
     return events
 
+async def walkin_preview(devices: list, start: str, end: str, bucket_minutes: int = None):
+    where = " WHERE 1=1"
+    params = []
+
+    if devices:
+        placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(devices))
+        where += f" AND uuid IN ({placeholders})"
+        params.extend(devices)
+
+    if start:
+        where += " AND time >= ?" if use_sqlite() else " AND time >= %s"
+        params.append(start)
+    if end:
+        where += " AND time <= ?" if use_sqlite() else " AND time <= %s"
+        params.append(end)
+
+    minutes = walkin.bucket_minutes(bucket_minutes)
+    key = await _walkin_preview_key("range", devices, (start or None, end or None), minutes)
+    cached = _walkin_preview_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    buckets = await _walkin_buckets(await _records_source(start, end), where, params, minutes)
+    if await asyncio.to_thread(archive.months):
+        cold = await asyncio.to_thread(archive.walkin_buckets, devices or None, start, end, minutes)
+        for k, n in cold.items():
+            buckets[k] = buckets.get(k, 0) + n
+    events = await _walkin_events(buckets, minutes) if buckets else []
+    _walkin_preview_cache.set(key, events)
+    return list(events)
 
 async def walkin_available_dates(devices: list):
     if not devices:
@@ -1835,7 +2424,7 @@ async def walkin_available_dates(devices: list):
     placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(devices))
     if use_sqlite():
         d_expr = "strftime('%Y-%m-%d', time)"
-        sql = f"SELECT {d_expr} as d FROM records WHERE uuid IN ({placeholders}) AND time IS NOT NULL GROUP BY d ORDER BY d"
+        sql = f"SELECT {d_expr} as d FROM {await _records_source()} WHERE uuid IN ({placeholders}) AND time IS NOT NULL GROUP BY d ORDER BY d"
     else:
         d_expr = "DATE(time)"
         sql = f"SELECT {d_expr} as d FROM records WHERE uuid IN ({placeholders}) AND time IS NOT NULL GROUP BY d ORDER BY d"
@@ -1854,110 +2443,27 @@ async def walkin_available_dates(devices: list):
     return {"dates": dates, "min_date": (dates[0] if dates else None), "max_date": (dates[-1] if dates else None)}
 
 
-async def walkin_preview_by_dates(devices: list, dates: list[str]):
+async def walkin_preview_by_dates(devices: list, dates: list[str], bucket_minutes: int = None):
     if not devices or not dates:
         return []
+    minutes = walkin.bucket_minutes(bucket_minutes)
+    key = await _walkin_preview_key("dates", devices, tuple(sorted(set(dates))), minutes)
+    cached = _walkin_preview_cache.get(key)
+    if cached is not None:
+        return list(cached)
     placeholders_u = ",".join(["?" if use_sqlite() else "%s"] * len(devices))
     placeholders_d = ",".join(["?" if use_sqlite() else "%s"] * len(dates))
-    params = []
-    params.extend(devices)
-    params.extend(dates)
-    if use_sqlite():
-        d_expr = "strftime('%Y-%m-%d', time)"
-        sql = f"SELECT uuid, time, in_count FROM records WHERE uuid IN ({placeholders_u}) AND time IS NOT NULL AND {d_expr} IN ({placeholders_d}) ORDER BY uuid, time"
-    else:
-        d_expr = "DATE(time)"
-        sql = f"SELECT uuid, time, in_count FROM records WHERE uuid IN ({placeholders_u}) AND time IS NOT NULL AND {d_expr} IN ({placeholders_d}) ORDER BY uuid, time"
-    rows = await run_query(sql, params)
-    if not rows:
-        return []
-
-    import datetime
-
-    def to_dt(v):
-        if v is None:
-            return None
-        if isinstance(v, datetime.datetime):
-            return v
-        if isinstance(v, datetime.date):
-            return datetime.datetime(v.year, v.month, v.day, 0, 0, 0)
-        s = str(v).strip()
-        if not s:
-            return None
-        s = s.replace("T", " ")
-        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M"):
-            try:
-                return datetime.datetime.strptime(s, fmt)
-            except Exception:
-                continue
-        return None
-
-    def get_interval(dt):
-        return dt.hour * 2 + (1 if dt.minute >= 30 else 0)
-
-    data_map = {}
-    for r in rows:
-        uuid = r[0]
-        dt = to_dt(r[1])
-        in_c = r[2]
-        if dt is None or in_c is None:
-            continue
-        date = dt.strftime("%Y-%m-%d")
-        idx = get_interval(dt)
-        key = (uuid, date, idx)
-        if key not in data_map:
-            data_map[key] = {"sum": 0}
-        try:
-            v = int(in_c)
-        except Exception:
-            continue
-        if v > 0:
-            data_map[key]["sum"] += v
-
-    events = []
-    mapping_res = await get_device_mapping()
-    mapping = (mapping_res or {}).get("mapping") or {}
-    loc_academy = await get_location_academy_mapping()
-
-    wd_map = {1: "周一", 2: "周二", 3: "周三", 4: "周四", 5: "周五", 6: "周六", 7: "周日"}
-
-    for (uuid, date, idx), val in data_map.items():
-        count = int(val.get("sum") or 0)
-        if count <= 0:
-            continue
-        h = idx // 2
-        m = (idx % 2) * 30
-        s_time = f"{h:02d}:{m:02d}"
-        end_idx = idx + 1
-        eh = end_idx // 2
-        em = (end_idx % 2) * 30
-        if eh >= 24:
-            e_time = "23:59"
-        else:
-            e_time = f"{eh:02d}:{em:02d}"
-
-        dt_d = datetime.datetime.strptime(date, "%Y-%m-%d").date()
-        weekday = wd_map.get(dt_d.isoweekday(), "")
-
-        dev = mapping.get(uuid) or {}
-        loc_name = str((dev.get("name") or "")).strip() or uuid
-        academy = str((loc_academy.get(loc_name) or dev.get("category") or "公共")).strip() or "公共"
-
-        events.append({
-            "date": date,
-            "weekday": weekday,
-            "start_time": s_time,
-            "end_time": e_time,
-            "duration_minutes": 30,
-            "academy": academy,
-            "location": loc_name,
-            "activity_name": "散客",
-            "activity_type": "散客访问",
-            "audience_count": count,
-            "notes": f"from device {uuid}"
-        })
-    events.sort(key=lambda x: (x.get("date") or "", x.get("start_time") or "", x.get("location") or ""))
-    return events
+    day, _ = _walkin_bucket_exprs()
+    start, end = f"{min(dates)} 00:00:00", f"{max(dates)} 23:59:59"
+    p = "?" if use_sqlite() else "%s"
+    # The time bounds let the (uuid, time) index narrow the scan before the day filter.
+    where = f" WHERE uuid IN ({placeholders_u}) AND time >= {p} AND time <= {p} AND {day} IN ({placeholders_d})"
+    params = list(devices) + [start, end] + list(dates)
+    src = await _records_source(start, end) if use_sqlite() else "records"
+    buckets = await _walkin_buckets(src, where, params, minutes)
+    events = await _walkin_events(buckets, minutes) if buckets else []
+    _walkin_preview_cache.set(key, events)
+    return list(events)
 
 async def _walkin_eligible_devices(devices: list | None = None):
     mapping_res = await get_device_mapping()
@@ -2008,166 +2514,446 @@ async def activity_sync_visitors(date: str = None, devices: list = None, start:
             total += int(res or 0)
         return {"count": total, "skipped": skipped}
 
+    res = await walkin_sync_history(eligible_devices, mode=mode)
+    return {"count": res["count"], "skipped": skipped}
+
+async def walkin_sync_history(devices: list, mode: str = "overwrite", job: dict = None):
+    """
+    Walk-in events for the whole history of these devices in one ordered
+    pass: records are bucketed WALKIN_SYNC_WINDOW_DAYS at a time in (day,
+    uuid) order, gaps without data are skipped, and events are written
+    WALKIN_SYNC_BATCH at a time. Archived months are merged in per window,
+    as walkin_preview does. Mappings are read once. With a job dict,
+    progress is reported into it and job["cancel"] stops the pass between
+    batches.
+    """
     import datetime
-    placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(eligible_devices))
-    if use_sqlite():
-        d_expr = "strftime('%Y-%m-%d', time)"
-        range_sql = f"SELECT MIN({d_expr}) as min_d, MAX({d_expr}) as max_d FROM records WHERE uuid IN ({placeholders}) AND time IS NOT NULL"
-    else:
-        d_expr = "DATE(time)"
-        range_sql = f"SELECT MIN({d_expr}) as min_d, MAX({d_expr}) as max_d FROM records WHERE uuid IN ({placeholders}) AND time IS NOT NULL"
 
-    range_rows = await run_query(range_sql, eligible_devices)
-    min_d = None
-    max_d = None
-    if range_rows and range_rows[0]:
-        min_d = range_rows[0][0]
-        max_d = range_rows[0][1] if len(range_rows[0]) > 1 else None
+    p = "?" if use_sqlite() else "%s"
+    devs = ",".join([p] * len(devices))
+    src = await _records_source()
+    has_archive = bool(await asyncio.to_thread(archive.months))
+
+    def pick(f, *values):
+        # Bounds from the database and the archive, either of which may be missing.
+        values = [str(v) for v in values if v is not None]
+        return f(values) if values else None
+
+    row = await _run("walkin_sync_history.range",
+                     f"SELECT MIN(time), MAX(time) FROM {src} WHERE uuid IN ({devs}) AND time IS NOT NULL",
+                     devices, fetch="one")
+    lo, hi = (row[0], row[1]) if row else (None, None)
+    if has_archive:
+        lo = pick(min, lo, await asyncio.to_thread(archive.first_time, devices))
+        hi = pick(max, hi, await asyncio.to_thread(archive.last_time, devices))
+    if lo is None:
+        return {"count": 0, "events": 0, "cancelled": False}
+    first = datetime.date.fromisoformat(str(lo)[:10])
+    last = datetime.date.fromisoformat(str(hi)[:10])
 
-    def parse_date(v):
-        if v is None:
-            return None
-        s = str(v).split(" ")[0].strip()
-        if not s:
-            return None
-        try:
-            return datetime.datetime.strptime(s, "%Y-%m-%d").date()
-        except Exception:
-            return None
+    mapping_res = await get_device_mapping()
+    mapping = (mapping_res or {}).get("mapping") or {}
+    loc_academy = await get_location_academy_mapping()
+    if job is not None:
+        job["days_total"] = (last - first).days + 1
 
-    start_date = parse_date(min_d)
-    end_date = parse_date(max_d)
-    if not start_date or not end_date:
-        return {"count": 0, "skipped": skipped}
-    if end_date < start_date:
-        start_date, end_date = end_date, start_date
-
-    cur = start_date
-    while cur <= end_date:
-        d = cur.strftime("%Y-%m-%d")
-        day_start = f"{d} 00:00:00"
-        day_end = f"{d} 23:59:59"
-        items = await walkin_preview(eligible_devices, day_start, day_end)
+    window = max(1, config.WALKIN_SYNC_WINDOW_DAYS)
+    batch_size = max(1, config.WALKIN_SYNC_BATCH)
+    total = events = 0
+    pending = []
+
+    async def write(items):
+        nonlocal total
         if items:
             res = await activity_bulk_insert(items, mode=mode)
-            if isinstance(res, dict):
+            total += int(res.get("inserted") or 0) + int(res.get("updated") or 0)
+        if job is not None:
+            job["written"] = total
+
+    day = first
+    while day <= last:
+        if job is not None and job.get("cancel"):
+            await write(pending)
+            return {"count": total, "events": events, "cancelled": True}
+        upto = min(last, day + datetime.timedelta(days=window - 1))
+        start, end = f"{day} 00:00:00", f"{upto} 23:59:59"
+        where = f" WHERE uuid IN ({devs}) AND time >= {p} AND time <= {p}"
+        buckets = await _walkin_buckets(src, where, list(devices) + [start, end])
+        if has_archive:
+            cold = await asyncio.to_thread(archive.walkin_buckets, devices, start, end)
+            for k, n in cold.items():
+                buckets[k] = buckets.get(k, 0) + n
+        # Events come back in day order, so batches advance through history.
+        items = await _walkin_events(buckets, mapping=mapping, loc_academy=loc_academy)
+        events += len(items)
+        pending.extend(items)
+        while len(pending) >= batch_size:
+            await write(pending[:batch_size])
+            del pending[:batch_size]
+        if job is not None:
+            job["days_done"] = (upto - first).days + 1
+            job["current_day"] = str(upto)
+            job["events"] = events
+        # Jump over stretches without any records.
+        nxt = await _run("walkin_sync_history.next",
+                         f"SELECT MIN(time) FROM {src} WHERE uuid IN ({devs}) AND time > {p}",
+                         list(devices) + [end], fetch="one")
+        nxt = nxt[0] if nxt else None
+        if has_archive:
+            after = f"{upto + datetime.timedelta(days=1)} 00:00:00"
+            nxt = pick(min, nxt, await asyncio.to_thread(archive.first_time, devices, after))
+        if nxt is None:
+            break
+        day = datetime.date.fromisoformat(str(nxt)[:10])
+    await write(pending)
+    if job is not None:
+        job["days_done"] = job["days_total"]
+    return {"count": total, "events": events, "cancelled": False}
+
+# --- Walk-in sync jobs ---
+#
+# Full-history syncs can take minutes, so the API can also run them as
+# background tasks like the delete jobs; clients poll get_walkin_sync_job()
+# and may ask for cancellation.
+
+_walkin_jobs = LRUCache(maxsize=20, ttl=24 * 3600)
+_walkin_tasks = set()
+
+async def _run_walkin_sync_job(job, devices, mode):
+    job["status"] = "running"
+    job["started_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        eligible, skipped = await _walkin_eligible_devices(devices)
+        job["skipped"] = skipped
+        if eligible:
+            res = await walkin_sync_history(eligible, mode=mode, job=job)
+            job["count"] = res["count"]
+        job["status"] = "cancelled" if job.get("cancel") else "done"
+    except Exception as e:
+        logging.exception("walk-in sync job %s failed", job["id"])
+        job["status"] = "failed"
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+def start_walkin_sync_job(devices: list = None, mode: str = "overwrite"):
+    job = {
+        "id": uuid.uuid4().hex, "kind": "walkin_sync", "status": "queued", "mode": mode,
+        "days_total": None, "days_done": 0, "current_day": None, "events": 0, "written": 0,
+        "count": 0, "skipped": [], "cancel": False, "error": None,
+        "created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "started_at": None, "finished_at": None,
+    }
+    _walkin_jobs.set(job["id"], job)
+    task = asyncio.create_task(_run_walkin_sync_job(job, devices, mode))
+    _walkin_tasks.add(task)
+    task.add_done_callback(_walkin_tasks.discard)
+    return dict(job)
+
+def get_walkin_sync_job(job_id):
+    job = _walkin_jobs.get(job_id)
+    return dict(job) if job else None
+
+def cancel_walkin_sync_job(job_id):
+    """Asks a running job to stop after its current batch; returns the job."""
+    job = _walkin_jobs.get(job_id)
+    if not job:
+        return None
+    if job["status"] in ("queued", "running"):
+        job["cancel"] = True
+    return dict(job)
+
+# --- Walk-in auto sync ---
+#
+# The background sync keeps the last records.id it has processed in
+# sync_state. New rows always get a higher id, so a cycle only recomputes the
+# (uuid, day, slot) buckets those rows fall into, and an idle cycle is a
+# single MAX(id) lookup. Edits, deletes and imports in this process bump
+# _records_version, and mapping changes bump _mapping_version; either one
+# makes the next cycle recompute the whole backfill window, as every cycle
+# used to.
+#
+# A device upload merged into an existing (uuid, time) row keeps that row's
+# id, so tcp_server queues the key in walkin_dirty in the same transaction;
+# a second watermark over walkin_dirty.id picks those up alongside the new
+# records. Consumed entries are pruned except the newest, which keeps MAX(id)
+# moving forward for the preview cache key. WALKIN_SYNC_FULL_INTERVAL_SEC
+# adds a periodic full pass as a safety net; it is off by default.
+
+_WALKIN_WATERMARK = "walkin_records_id"
+_WALKIN_DIRTY_WATERMARK = "walkin_dirty_id"
+_walkin_watermark = None  # last records.id synced; loaded from sync_state once
+_walkin_dirty_watermark = 0  # last walkin_dirty.id synced
+_walkin_sync_seen = None  # (records version, mapping version) at the last cycle
+_walkin_full_at = None    # time.monotonic() of the last full pass
+
+async def _sync_state_get(name):
+    p = "?" if use_sqlite() else "%s"
+    row = await _run("sync_state_get", f"SELECT value FROM sync_state WHERE name = {p}", (name,), fetch="one")
+    return row[0] if row else None
+
+async def _sync_state_set(name, value):
+    if use_sqlite():
+        sql = ("INSERT INTO sync_state (name, value) VALUES (?, ?) "
+               "ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP")
+    else:
+        sql = ("INSERT INTO sync_state (name, value) VALUES (%s, %s) "
+               "ON DUPLICATE KEY UPDATE value = VALUES(value), updated_at = NOW()")
+    await _run("sync_state_set", sql, (name, str(value)), fetch=None)
+
+async def walkin_auto_sync(days: int = 1, mode: str = "overwrite"):
+    """
+    One cycle of the background walk-in sync over the last `days` days.
+    Returns {"count", "buckets", "full"}; buckets is None after a full pass.
+    """
+    global _walkin_watermark, _walkin_dirty_watermark, _walkin_sync_seen, _walkin_full_at
+    import datetime
+
+    days = max(1, int(days or 1))
+    row = await _run("walkin_auto_sync.max_id",
+                     "SELECT (SELECT MAX(id) FROM records), (SELECT MAX(id) FROM walkin_dirty)", fetch="one")
+    hi = int(row[0]) if row and row[0] is not None else 0
+    dirty_hi = int(row[1]) if row and row[1] is not None else 0
+    seen = (_records_version, _mapping_version)
+    if _walkin_watermark is None:
+        stored = await _sync_state_get(_WALKIN_WATERMARK)
+        if stored is not None:
+            _walkin_watermark = int(stored)
+            _walkin_dirty_watermark = int(await _sync_state_get(_WALKIN_DIRTY_WATERMARK) or 0)
+            _walkin_sync_seen = seen
+    interval = config.WALKIN_SYNC_FULL_INTERVAL_SEC
+    due = interval > 0 and (_walkin_full_at is None or time.monotonic() - _walkin_full_at >= interval)
+    full = _walkin_watermark is None or _walkin_sync_seen != seen or hi < _walkin_watermark or due
+    if not full and hi == _walkin_watermark and dirty_hi == _walkin_dirty_watermark:
+        return {"count": 0, "buckets": 0, "full": False}
+
+    today = datetime.date.today()
+    window = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+    total = 0
+    dirty_count = None
+    if full:
+        for d in window:
+            res = await activity_sync_visitors(date=d, mode=mode)
+            total += int(res.get("count") or 0)
+        _walkin_full_at = time.monotonic()
+    else:
+        day, idx = _walkin_bucket_exprs()
+        p = "?" if use_sqlite() else "%s"
+        since = f"{window[-1]} 00:00:00"
+        rows = await run_query(
+            f"SELECT DISTINCT uuid, {day}, {idx} FROM records WHERE id > {p} AND id <= {p} AND time >= {p}",
+            [_walkin_watermark, hi, since],
+            name="walkin_auto_sync.dirty",
+        )
+        if dirty_hi > _walkin_dirty_watermark:
+            rows += await run_query(
+                f"SELECT DISTINCT uuid, {day}, {idx} FROM walkin_dirty WHERE id > {p} AND id <= {p} AND time >= {p}",
+                [_walkin_dirty_watermark, dirty_hi, since],
+                name="walkin_auto_sync.merged",
+            )
+        eligible, _ = await _walkin_eligible_devices()
+        eligible = set(eligible)
+        dirty = {}
+        for r in rows:
+            if r[0] in eligible:
+                dirty.setdefault(str(r[1])[:10], set()).add((r[0], str(r[1])[:10], int(r[2])))
+        dirty_count = sum(len(v) for v in dirty.values())
+        for d, keys in sorted(dirty.items()):
+            uuids = sorted({k[0] for k in keys})
+            start, end = f"{d} 00:00:00", f"{d} 23:59:59"
+            where = f" WHERE uuid IN ({','.join([p] * len(uuids))}) AND time >= {p} AND time <= {p}"
+            buckets = await _walkin_buckets(await _records_source(start, end), where, uuids + [start, end])
+            items = await _walkin_events({k: n for k, n in buckets.items() if k in keys})
+            if items:
+                res = await activity_bulk_insert(items, mode=mode)
                 total += int(res.get("inserted") or 0) + int(res.get("updated") or 0)
-            else:
-                total += int(res or 0)
-        cur = cur + datetime.timedelta(days=1)
 
-    return {"count": total, "skipped": skipped}
+    await _sync_state_set(_WALKIN_WATERMARK, hi)
+    _walkin_watermark = hi
+    if dirty_hi > _walkin_dirty_watermark:
+        p = "?" if use_sqlite() else "%s"
+        await _sync_state_set(_WALKIN_DIRTY_WATERMARK, dirty_hi)
+        await _run("walkin_auto_sync.prune", f"DELETE FROM walkin_dirty WHERE id < {p}", (dirty_hi,), fetch=None)
+        _walkin_dirty_watermark = dirty_hi
+    _walkin_sync_seen = seen
+    return {"count": total, "buckets": dirty_count, "full": full}
 
 # --- Location-Academy Mapping ---
 
 async def get_location_academy_mapping():
     """Returns {location_name: academy_name}"""
-    sql = "SELECT location_name, academy_name FROM location_academy"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return {row[0]: row[1] for row in rows}
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql)
-                rows = await cur.fetchall()
-                return {row[0]: row[1] for row in rows}
+    key = ("location_academy", _mapping_version)
+    hit = _mapping_cache.get(key)
+    if hit is not None:
+        return hit
+    rows = await _run("get_location_academy_mapping", "SELECT location_name, academy_name FROM location_academy")
+    hit = {row[0]: row[1] for row in rows}
+    _mapping_cache.set(key, hit)
+    return hit
 
 async def update_location_academy_mapping(location_name: str, academy_name: str):
     """Updates or inserts a mapping"""
     # Upsert logic
     if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute("INSERT OR REPLACE INTO location_academy (location_name, academy_name) VALUES (?, ?)", (location_name, academy_name))
-        await _sqlite.commit()
+        sql = "INSERT OR REPLACE INTO location_academy (location_name, academy_name) VALUES (?, ?)"
+        params = (location_name, academy_name)
     else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("""
-                    INSERT INTO location_academy (location_name, academy_name) 
-                    VALUES (%s, %s) 
-                    ON DUPLICATE KEY UPDATE academy_name=%s
-                """, (location_name, academy_name, academy_name))
+        sql = """
+            INSERT INTO location_academy (location_name, academy_name) 
+            VALUES (%s, %s) 
+            ON DUPLICATE KEY UPDATE academy_name=%s
+        """
+        params = (location_name, academy_name, academy_name)
+    await _run("update_location_academy_mapping", sql, params, fetch=None)
+    _bump_mapping_version()
 
 async def delete_location_academy_mapping(location_name: str):
     """Deletes a mapping"""
     sql = "DELETE FROM location_academy WHERE location_name=?" if use_sqlite() else "DELETE FROM location_academy WHERE location_name=%s"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        await _sqlite.execute(sql, (location_name,))
-        await _sqlite.commit()
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, (location_name,))
+    await _run("delete_location_academy_mapping", sql, (location_name,), fetch=None)
+    _bump_mapping_version()
 
 async def get_all_activity_locations():
     """Returns list of distinct locations from activity_events"""
-    sql = "SELECT DISTINCT location FROM activity_events ORDER BY location"
-    if use_sqlite():
-        if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql) as cur:
-            rows = await cur.fetchall()
-            return [row[0] for row in rows if row[0]]
-    else:
-        if not _pool: await init_pool()
-        async with _pool.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql)
-                rows = await cur.fetchall()
-                return [row[0] for row in rows if row[0]]
+    rows = await _run(
+        "get_all_activity_locations",
+        "SELECT l.name FROM activity_locations l "
+        "WHERE EXISTS (SELECT 1 FROM activity_facts f WHERE f.location_id = l.id) ORDER BY l.name",
+    )
+    return [row[0] for row in rows if row[0]]
 
 async def correct_location_data(target_location: str, target_academy: str, merge_locations: list = None):
     """
     Updates academy for target_location.
-    Optionally merges other locations into target_location (renaming them and setting academy).
+    Optionally merges other locations into target_location (repointing them and setting academy).
     Returns total modified rows.
     """
-    count = 0
-    
-    # 1. Fix exact matches (update academy only)
-    sql_exact = "UPDATE activity_events SET academy = ? WHERE location = ?" if use_sqlite() else "UPDATE activity_events SET academy = %s WHERE location = %s"
-    params_exact = (target_academy, target_location)
-    
-    # 2. Merge similar locations (update location AND academy)
-    sql_merge = None
-    params_merge = []
-    if merge_locations:
-        placeholders = ",".join(["?" if use_sqlite() else "%s"] * len(merge_locations))
-        sql_merge = f"UPDATE activity_events SET location = ?, academy = ? WHERE location IN ({placeholders})"
-        if use_sqlite():
-            params_merge = [target_location, target_academy] + merge_locations
-        else:
-            # MySQL might need distinct params structure depending on driver, usually list is fine
-            params_merge = [target_location, target_academy] + merge_locations
+    counts = await correct_locations_batch([(target_location, target_academy, merge_locations or [])])
+    return sum(counts.values())
+
+async def correct_locations_batch(corrections):
+    """
+    Applies [(target_location, target_academy, merge_locations), ...] in one
+    transaction: the source -> (target, academy) ids go into a temp mapping
+    table and one UPDATE repoints every affected activity. A target that is
+    not a known location yet takes over the id of its first source (a
+    one-row rename). Rows whose merged signature already exists at the
+    target are removed as duplicates. Returns {target_location: rows}.
+    """
+    # Same target twice: sources are combined, the last academy wins. A
+    # location is merged at most once and never away from being a target.
+    plan = {}
+    for target, academy, sources in corrections:
+        if not target:
+            continue
+        entry = plan.setdefault(target, [academy, []])
+        entry[0] = academy
+        entry[1].extend(sources or [])
+    claimed = set(plan)
+    for target, entry in plan.items():
+        srcs = []
+        for m in entry[1]:
+            if m is not None and m not in claimed:
+                claimed.add(m)
+                srcs.append(m)
+        entry[1] = srcs
+    if not plan:
+        return {}
 
+    p = "?" if use_sqlite() else "%s"
+    names = sorted(claimed)
+    ids = {}
+    for i in range(0, len(names), _SQLITE_MAX_VARS):
+        part = names[i:i + _SQLITE_MAX_VARS]
+        rows = await _run("correct_locations_batch.lookup",
+                          f"SELECT name, id FROM activity_locations WHERE name IN ({','.join([p] * len(part))})", part)
+        ids.update((r[0], r[1]) for r in rows)
+    academy_ids = await _activity_dim_resolve("academy", [a for a, _ in plan.values()])
+
+    renames = []   # (new name, id, old name)
+    mapping = []   # (source_id, target_id, academy_id)
+    target_of = {}  # target_id -> target name
+    for target, (academy, srcs) in plan.items():
+        src_ids = [ids[m] for m in srcs if m in ids]
+        target_id = ids.get(target)
+        if target_id is None:
+            if not src_ids:
+                continue
+            target_id = src_ids.pop(0)
+            renames.append((target, target_id, next(m for m in srcs if ids.get(m) == target_id)))
+        target_of[target_id] = target
+        academy_id = academy_ids.get(academy)
+        mapping.append((target_id, target_id, academy_id))
+        mapping.extend((s, target_id, academy_id) for s in src_ids)
+    if not mapping:
+        return {target: 0 for target in plan}
+
+    sql_insert = f"INSERT INTO location_fix (source_id, target_id, academy_id) VALUES ({p}, {p}, {p})"
+    sql_rename = f"UPDATE activity_locations SET name = {p} WHERE id = {p}"
+    sql_counts = ("SELECT m.target_id, COUNT(*) FROM activity_facts f JOIN location_fix m ON m.source_id = f.location_id "
+                  "GROUP BY m.target_id")
+    sql_leftover = "DELETE FROM activity_facts WHERE location_id IN (SELECT source_id FROM location_fix WHERE source_id <> target_id)"
+    renamed = [(n, i) for n, i, _ in renames]
+
+    counts = {}
+    t0 = time.perf_counter()
     if use_sqlite():
         if not _sqlite: await init_sqlite()
-        async with _sqlite.execute(sql_exact, params_exact) as cur:
-            count += cur.rowcount
-        if sql_merge:
-            async with _sqlite.execute(sql_merge, params_merge) as cur:
-                count += cur.rowcount
-        await _sqlite.commit()
+        try:
+            await _sqlite.execute("CREATE TEMP TABLE location_fix (source_id INTEGER PRIMARY KEY, target_id INTEGER, academy_id INTEGER)")
+            await _sqlite.executemany(sql_insert, mapping)
+            if renamed:
+                await _sqlite.executemany(sql_rename, renamed)
+            async with _sqlite.execute(sql_counts) as cur:
+                counts = {r[0]: r[1] for r in await cur.fetchall()}
+            await _sqlite.execute(
+                "UPDATE OR IGNORE activity_facts SET "
+                "location_id = (SELECT m.target_id FROM location_fix m WHERE m.source_id = activity_facts.location_id), "
+                "academy_id = (SELECT m.academy_id FROM location_fix m WHERE m.source_id = activity_facts.location_id) "
+                "WHERE location_id IN (SELECT source_id FROM location_fix)"
+            )
+            await _sqlite.execute(sql_leftover)
+            await _sqlite.commit()
+        except Exception:
+            await _sqlite.rollback()
+            raise
+        finally:
+            await _sqlite.execute("DROP TABLE IF EXISTS temp.location_fix")
     else:
         if not _pool: await init_pool()
         async with _pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql_exact, params_exact)
-                count += cur.rowcount
-                if sql_merge:
-                    await cur.execute(sql_merge, params_merge)
-                    count += cur.rowcount
-            # aiomysql pool connection commits automatically on context exit or needs explicit commit? 
-            # Usually autocommit is off by default.
-            await conn.commit()
-            
-    return count
+                await cur.execute("CREATE TEMPORARY TABLE location_fix (source_id BIGINT PRIMARY KEY, target_id BIGINT, academy_id BIGINT)")
+                await conn.begin()
+                try:
+                    await cur.executemany(sql_insert, mapping)
+                    if renamed:
+                        await cur.executemany(sql_rename, renamed)
+                    await cur.execute(sql_counts)
+                    counts = {r[0]: r[1] for r in await cur.fetchall()}
+                    await cur.execute(
+                        "UPDATE IGNORE activity_facts f JOIN location_fix m ON m.source_id = f.location_id "
+                        "SET f.location_id = m.target_id, f.academy_id = m.academy_id"
+                    )
+                    await cur.execute(sql_leftover)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+                finally:
+                    await cur.execute("DROP TEMPORARY TABLE IF EXISTS location_fix")
+    _record_query("correct_locations_batch", (time.perf_counter() - t0) * 1000, sum(counts.values()))
+
+    for new, target_id, old in renames:
+        _activity_dim_ids["location"].pop(old, None)
+        _activity_dim_ids["location"][new] = target_id
+
+    # Which academies lost rows is unknown here; recount these two.
+    _activity_options_invalidate("locations", "academies")
+    _bump_activity_version()
+    result = {target: 0 for target in plan}
+    for target_id, n in counts.items():
+        result[target_of[target_id]] = n
+    return result
 
 
 
@@ -0,0 +1,304 @@
+"""
+Local ingest journal for tcp_server.
+
+Parsed device uploads are appended to newline-delimited JSON segments under
+INGEST_JOURNAL_DIR and fsync'ed in small batches (group commit), so the device
+can be ACKed as soon as its record is on disk, whatever state the database is
+in. A replay task feeds the journal into the database in order and records
+how far it got in a checkpoint file; after a crash or a database outage it
+resumes from the checkpoint. Delivery into the database is at-least-once: a
+crash between a save and the next checkpoint replays that batch.
+
+Database outages are retried until they pass. A record the database rejects
+outright (permanent(e) is true: bad data, constraint violations) is retried
+INGEST_JOURNAL_MAX_ATTEMPTS times and then moved to the dead-letter file, so
+one bad upload cannot hold back everything journaled after it. Unreadable
+lines go straight there.
+
+    <dir>/ingest-00000001.jsonl   segment, rotated at INGEST_JOURNAL_SEGMENT_BYTES
+    <dir>/checkpoint.json         {"segment": 1, "offset": 12345}
+    <dir>/dead-letter.jsonl       {"segment", "offset", "error", "line"} per rejected line
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+from . import config
+
+_SEGMENT_RE = re.compile(r"ingest-(\d{8})\.jsonl$")
+_CHECKPOINT = "checkpoint.json"
+_DEAD_LETTER = "dead-letter.jsonl"
+
+def _segment_name(n: int) -> str:
+    return f"ingest-{n:08d}.jsonl"
+
+def _fsync_dir(path: str):
+    # Not supported on Windows; the file fsync is what matters there.
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def segments(root: str) -> List[int]:
+    if not os.path.isdir(root):
+        return []
+    out = []
+    for name in os.listdir(root):
+        m = _SEGMENT_RE.match(name)
+        if m:
+            out.append(int(m.group(1)))
+    return sorted(out)
+
+def read_checkpoint(root: str) -> Tuple[int, int]:
+    try:
+        with open(os.path.join(root, _CHECKPOINT), "r", encoding="utf-8") as f:
+            d = json.load(f)
+        return int(d.get("segment") or 0), int(d.get("offset") or 0)
+    except (OSError, ValueError):
+        return 0, 0
+
+def _write_checkpoint(root: str, segment: int, offset: int):
+    path = os.path.join(root, _CHECKPOINT)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"segment": segment, "offset": offset}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _write_dead_letter(root: str, segment: int, offset: int, raw: bytes, error: Exception):
+    # Durable before the checkpoint moves past the line.
+    entry = {"segment": segment, "offset": offset, "error": f"{type(error).__name__}: {error}",
+             "line": raw.decode("utf-8", errors="replace").rstrip("\n")}
+    with open(os.path.join(root, _DEAD_LETTER), "ab") as f:
+        f.write(json.dumps(entry, ensure_ascii=False).encode("utf-8") + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def _dead_letter_count(root: str) -> int:
+    try:
+        with open(os.path.join(root, _DEAD_LETTER), "rb") as f:
+            return sum(1 for _ in f)
+    except OSError:
+        return 0
+
+def status(root: Optional[str] = None) -> dict:
+    """Backlog still to be replayed, read from disk (works from any process)."""
+    root = root or config.INGEST_JOURNAL_DIR
+    segs = segments(root)
+    seg, off = read_checkpoint(root)
+    pending = 0
+    for n in segs:
+        try:
+            size = os.path.getsize(os.path.join(root, _segment_name(n)))
+        except OSError:
+            continue
+        if n > seg:
+            pending += size
+        elif n == seg:
+            pending += max(0, size - off)
+    return {"segments": len(segs), "checkpoint": {"segment": seg, "offset": off}, "pending_bytes": pending,
+            "dead_letter": _dead_letter_count(root)}
+
+class IngestJournal:
+    def __init__(self, root: str, fsync_ms: int = 20, segment_bytes: int = 16 * 1024 * 1024,
+                 replay_batch: int = 500, max_attempts: int = 5):
+        self.root = root
+        self.fsync_delay = max(0, fsync_ms) / 1000.0
+        self.segment_bytes = segment_bytes
+        self.replay_batch = replay_batch
+        self.max_attempts = max(1, max_attempts)
+        self._segment = 0
+        self._file = None
+        self._pending: List[Tuple[bytes, asyncio.Future]] = []
+        self._wakeup = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self.replayed = 0
+        self.dead_lettered = 0
+        self._failed_at: Optional[Tuple[int, int]] = None
+        self._failures = 0
+
+    # --- Writer ---
+
+    def _open_segment(self, n: int):
+        if self._file:
+            self._file.close()
+        self._segment = n
+        self._file = open(os.path.join(self.root, _segment_name(n)), "ab")
+        _fsync_dir(self.root)
+
+    def open(self):
+        os.makedirs(self.root, exist_ok=True)
+        segs = segments(self.root)
+        self._open_segment(segs[-1] if segs else 1)
+
+    def _write_batch(self, lines: List[bytes]):
+        if self._file.tell() >= self.segment_bytes:
+            self._open_segment(self._segment + 1)
+        self._file.write(b"".join(lines))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    async def append(self, record: dict):
+        """Returns once the record is durable on disk."""
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((line, fut))
+        self._wakeup.set()
+        await fut
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            if self.fsync_delay:
+                # Let concurrent connections join this fsync.
+                await asyncio.sleep(self.fsync_delay)
+            self._wakeup.clear()
+            batch, self._pending = self._pending, []
+            if not batch:
+                continue
+            try:
+                await asyncio.to_thread(self._write_batch, [line for line, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result(None)
+            self._flushed.set()
+
+    # --- Replay ---
+
+    def _read_from(self, segment: int, offset: int):
+        """Complete lines from segment[offset:], at most replay_batch of them."""
+        path = os.path.join(self.root, _segment_name(segment))
+        lines = []
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break
+                lines.append(raw)
+                if len(lines) >= self.replay_batch:
+                    break
+        return lines
+
+    def _advance(self, segment: int, offset: int) -> Tuple[int, int]:
+        """Moves past a fully replayed segment that the writer has left behind."""
+        if segment >= self._segment:
+            return segment, offset
+        path = os.path.join(self.root, _segment_name(segment))
+        if os.path.exists(path) and offset < os.path.getsize(path):
+            return segment, offset
+        nxt = [n for n in segments(self.root) if n > segment]
+        segment, offset = (nxt[0] if nxt else self._segment), 0
+        _write_checkpoint(self.root, segment, offset)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return segment, offset
+
+    async def _dead_letter(self, segment: int, offset: int, raw: bytes, error: Exception):
+        await asyncio.to_thread(_write_dead_letter, self.root, segment, offset, raw, error)
+        self.dead_lettered += 1
+
+    async def _replay_loop(self, save: Callable[[dict], Awaitable[None]],
+                           permanent: Optional[Callable[[Exception], bool]] = None):
+        segment, offset = await asyncio.to_thread(read_checkpoint, self.root)
+        segs = await asyncio.to_thread(segments, self.root)
+        if segs and segment not in segs:
+            segment, offset = segs[0], 0
+        retry = 1.0
+        while True:
+            segment, offset = await asyncio.to_thread(self._advance, segment, offset)
+            lines = await asyncio.to_thread(self._read_from, segment, offset)
+            if not lines:
+                self._flushed.clear()
+                try:
+                    await asyncio.wait_for(self._flushed.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            done = 0
+            try:
+                for raw in lines:
+                    pos = (segment, offset + done)
+                    try:
+                        rec = json.loads(raw)
+                    except ValueError as e:
+                        logging.error("ingest journal: dead-lettering unreadable line at %s:%s", *pos)
+                        await self._dead_letter(*pos, raw, e)
+                    else:
+                        try:
+                            await save(rec)
+                            self.replayed += 1
+                        except Exception as e:
+                            if permanent is None or not permanent(e):
+                                raise
+                            self._failures = self._failures + 1 if self._failed_at == pos else 1
+                            self._failed_at = pos
+                            if self._failures < self.max_attempts:
+                                raise
+                            logging.error("ingest journal: dead-lettering record at %s:%s after %d attempts: %s",
+                                          pos[0], pos[1], self._failures, e)
+                            await self._dead_letter(*pos, raw, e)
+                    done += len(raw)
+                retry = 1.0
+            except Exception as e:
+                if permanent is not None and permanent(e):
+                    # Same record again soon; backing off only helps outages.
+                    logging.error("ingest journal: record at %s:%s rejected (%s), attempt %d of %d",
+                                  segment, offset + done, e, self._failures, self.max_attempts)
+                    await asyncio.sleep(1.0)
+                else:
+                    logging.error("ingest journal replay stalled (%s); retrying in %.0fs", e, retry)
+                    await asyncio.sleep(retry)
+                    retry = min(retry * 2, 30.0)
+            if done:
+                offset += done
+                await asyncio.to_thread(_write_checkpoint, self.root, segment, offset)
+
+    # --- Lifecycle ---
+
+    def start(self, save: Callable[[dict], Awaitable[None]],
+              permanent: Optional[Callable[[Exception], bool]] = None):
+        self.open()
+        self._tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._replay_loop(save, permanent)),
+        ]
+
+    async def stop(self):
+        # Stop replaying first, then give queued appends one last fsync.
+        for t in reversed(self._tasks):
+            if t is self._tasks[0]:
+                for _ in range(50):
+                    if not self._pending:
+                        break
+                    await asyncio.sleep(0.02)
+            t.cancel()
+            try:
+                await t
+            except BaseException:
+                pass
+        self._tasks = []
+        for _, fut in self._pending:
+            if not fut.done():
+                fut.cancel()
+        self._pending = []
+        if self._file:
+            self._file.close()
+            self._file = None
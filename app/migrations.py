@@ -0,0 +1,725 @@
+"""
+Versioned schema migrations.
+
+Each backend keeps an ordered list of (version, name, fn). SQLite tracks the
+applied version in PRAGMA user_version, MySQL in a one-row `schema_version`
+table, so starting against an up-to-date database costs a single read instead
+of re-running every CREATE/ALTER. New schema changes are appended to the lists
+below; never edit a migration that has shipped.
+
+Migration 1 is the schema the old init code created on every start. It is
+written to be idempotent because databases from before this module exist at
+version 0 with all of it already in place.
+"""
+import hashlib
+import json
+import logging
+
+# Secondary indexes for the non-records tables: (name, table, columns). The
+# column lists are valid on both SQLite and MySQL.
+SECONDARY_INDEXES = [
+    # activity_list / activity_stats date ranges, bulk-insert signature scan
+    ("idx_activity_date_location", "activity_events", "date, location"),
+    # correct_location_data, location filters, DISTINCT location
+    ("idx_activity_location", "activity_events", "location"),
+    # academy filters over a date range, DISTINCT academy
+    ("idx_activity_academy_date", "activity_events", "academy, date"),
+    ("idx_alerts_uuid_time", "alerts", "uuid, time DESC"),
+    ("idx_alerts_time", "alerts", "time"),
+    ("idx_sessions_expires_at", "sessions", "expires_at"),
+    ("idx_audit_logs_created_at", "audit_logs", "created_at"),
+]
+
+def _default_admin_hash():
+    from .db import hash_password
+    return hash_password("admin")
+
+# --- SQLite ---
+
+async def _sqlite_try(conn, sql):
+    try:
+        await conn.execute(sql)
+    except Exception:
+        pass
+
+async def _sqlite_baseline(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE,
+            password_hash TEXT,
+            role TEXT DEFAULT 'user',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            token TEXT PRIMARY KEY,
+            user_id INTEGER,
+            expires_at DATETIME
+        )
+    """)
+    async with conn.execute("SELECT id FROM users WHERE username='admin'") as cur:
+        if not await cur.fetchone():
+            await conn.execute("INSERT INTO users (username, password_hash, role) VALUES ('admin', ?, 'admin')", (_default_admin_hash(),))
+    await _sqlite_try(conn, "ALTER TABLE users ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid TEXT,
+            time DATETIME,
+            in_count INTEGER,
+            out_count INTEGER,
+            battery INTEGER,
+            btx INTEGER,
+            rec_type INTEGER,
+            signal_strength INTEGER,
+            warn_status INTEGER,
+            activity_type TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_records_uuid_time ON records(uuid, time)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_records_time ON records(time)")
+    await _sqlite_try(conn, "ALTER TABLE records ADD COLUMN activity_type TEXT")
+    await _sqlite_try(conn, "ALTER TABLE records ADD COLUMN warn_status INTEGER")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS registry (
+            uuid TEXT PRIMARY KEY,
+            name TEXT,
+            category TEXT,
+            description TEXT,
+            last_seen DATETIME,
+            ip TEXT,
+            bound_at DATETIME
+        )
+    """)
+    await _sqlite_try(conn, "ALTER TABLE registry ADD COLUMN ip TEXT")
+    await _sqlite_try(conn, "ALTER TABLE registry ADD COLUMN bound_at DATETIME")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            actor TEXT,
+            action TEXT,
+            target TEXT,
+            details TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS academies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE,
+            sort_order INTEGER DEFAULT 0
+        )
+    """)
+    async with conn.execute("PRAGMA table_info(academies)") as cur:
+        cols = [r[1] for r in (await cur.fetchall() or []) if r and len(r) > 1]
+    if "sort_order" not in cols:
+        await conn.execute("ALTER TABLE academies ADD COLUMN sort_order INTEGER DEFAULT 0")
+
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS activity_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT,
+            weekday TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            duration_minutes INTEGER,
+            academy TEXT,
+            location TEXT,
+            activity_name TEXT,
+            activity_type TEXT,
+            audience_count INTEGER,
+            notes TEXT,
+            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS alerts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid TEXT,
+            type TEXT,
+            level INTEGER,
+            info TEXT,
+            time DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS location_academy (
+            location_name TEXT PRIMARY KEY,
+            academy_name TEXT
+        )
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS records_hourly (
+            uuid TEXT,
+            hour DATETIME,
+            in_count INTEGER DEFAULT 0,
+            out_count INTEGER DEFAULT 0,
+            samples INTEGER DEFAULT 0,
+            PRIMARY KEY (uuid, hour)
+        )
+    """)
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_records_hourly_hour ON records_hourly(hour)")
+    for name, table, cols in SECONDARY_INDEXES:
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({cols})")
+    await _sqlite_try(conn, """
+        UPDATE registry
+        SET bound_at = COALESCE(bound_at, CURRENT_TIMESTAMP)
+        WHERE name IS NOT NULL
+          AND name != ''
+          AND name IN (SELECT location_name FROM location_academy)
+    """)
+
+# Device payload columns of a records row, in _UPSERT_COLS order. When two
+# different uploads land on one (uuid, time) their counts are added and the
+# digest of each is kept in records_merged, so a re-send of either is still
+# recognised as a retransmit afterwards. Keys that never collide have no rows.
+RECORD_PAYLOAD_COLS = ("in_count", "out_count", "battery", "btx", "rec_type",
+                       "signal_strength", "warn_status", "activity_type")
+
+def record_digest(payload) -> str:
+    return hashlib.sha1(json.dumps(list(payload), default=str).encode()).hexdigest()[:16]
+
+def _record_dups_sql(table: str) -> str:
+    # One row per duplicated (uuid, time): the newest id survives and gets the
+    # counts of the distinct payloads summed, so a retransmitted copy counts
+    # once and two different uploads both count (the ingest rule).
+    payload = ", ".join(f"x.{c}" for c in RECORD_PAYLOAD_COLS)
+    return f"""
+        SELECT keep, uuid, time, MAX(n) AS n, MAX(ids) AS ids,
+               SUM(COALESCE(in_count, 0)) AS in_sum, SUM(COALESCE(out_count, 0)) AS out_sum
+        FROM (
+            SELECT DISTINCT g.keep, g.uuid, g.time, g.n, g.ids, {payload}
+            FROM {table} x
+            JOIN (SELECT uuid, time, MAX(id) AS keep, COUNT(*) AS n, GROUP_CONCAT(id) AS ids
+                  FROM {table} WHERE uuid IS NOT NULL AND time IS NOT NULL
+                  GROUP BY uuid, time HAVING COUNT(*) > 1) g
+              ON x.uuid = g.uuid AND x.time = g.time
+        ) d
+        GROUP BY keep, uuid, time
+    """
+
+_RECORD_DUPS_LOGGED = 200
+
+def _log_record_dups(table: str, rows):
+    for uuid, time, keep, n, ids, in_sum, out_sum in rows[:_RECORD_DUPS_LOGGED]:
+        logging.warning(f"{table}: folded {n} rows for ({uuid}, {time}) ids={ids} into id {keep} "
+                        f"in_count={in_sum} out_count={out_sum}")
+    if len(rows) > _RECORD_DUPS_LOGGED:
+        logging.warning(f"{table}: ... and {len(rows) - _RECORD_DUPS_LOGGED} more duplicate groups folded")
+    if rows:
+        logging.warning(f"{table}: {len(rows)} duplicate (uuid, time) groups, "
+                        f"{sum(r[3] for r in rows) - len(rows)} rows removed")
+
+async def _sqlite_records_unique(conn):
+    # One row per (uuid, time), duplicates folded as in _record_dups_sql.
+    # Sealed month tables (records_YYYYMM) get the same key.
+    async with conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name GLOB 'records_[0-9][0-9][0-9][0-9][0-9][0-9]'"
+    ) as cur:
+        tables = ["records"] + [r[0] for r in await cur.fetchall()]
+    for t in tables:
+        await conn.execute("DROP TABLE IF EXISTS temp.records_dups")
+        await conn.execute(f"CREATE TEMP TABLE records_dups AS {_record_dups_sql(t)}")
+        async with conn.execute("SELECT uuid, time, keep, n, ids, in_sum, out_sum FROM records_dups ORDER BY keep") as cur:
+            _log_record_dups(t, await cur.fetchall())
+        await conn.execute(f"""
+            UPDATE {t} SET
+                in_count = (SELECT in_sum FROM records_dups d WHERE d.keep = {t}.id),
+                out_count = (SELECT out_sum FROM records_dups d WHERE d.keep = {t}.id)
+            WHERE id IN (SELECT keep FROM records_dups)
+        """)
+        await conn.execute(f"""
+            DELETE FROM {t} WHERE id IN (
+                SELECT x.id FROM {t} x JOIN records_dups d ON x.uuid = d.uuid AND x.time = d.time AND x.id <> d.keep
+            )
+        """)
+        await conn.execute("DROP TABLE temp.records_dups")
+        await conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{t}_uuid_time ON {t}(uuid, time)")
+        await conn.execute(f"DROP INDEX IF EXISTS idx_{t}_uuid_time")
+
+# An activity is identified by (date, start_time, location, activity_name);
+# activity_bulk_insert relies on this key to skip or overwrite duplicates.
+ACTIVITY_SIGNATURE = "date, start_time, location, activity_name"
+
+async def _sqlite_activity_unique(conn):
+    await conn.execute(f"""
+        DELETE FROM activity_events
+        WHERE id NOT IN (SELECT MAX(id) FROM activity_events GROUP BY {ACTIVITY_SIGNATURE})
+          AND date IS NOT NULL AND start_time IS NOT NULL AND location IS NOT NULL AND activity_name IS NOT NULL
+    """)
+    await conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_activity_signature ON activity_events({ACTIVITY_SIGNATURE})")
+
+# Dictionary-encoded activities: location, academy and type live once in small
+# dimension tables and activity_facts carries their integer ids. activity_events
+# becomes a view with the original columns, so readers are unchanged; writers
+# go through app.db, which maps names to ids. (fact column, dimension table,
+# view column)
+ACTIVITY_DIMENSIONS = [
+    ("location_id", "activity_locations", "location"),
+    ("academy_id", "activity_academies", "academy"),
+    ("type_id", "activity_types", "activity_type"),
+]
+ACTIVITY_FACT_SIGNATURE = "date, start_time, location_id, activity_name"
+# Same names as the activity_events indexes they replace.
+ACTIVITY_FACT_INDEXES = [
+    ("idx_activity_date_location", "date, location_id"),
+    ("idx_activity_location", "location_id"),
+    ("idx_activity_academy_date", "academy_id, date"),
+]
+_ACTIVITY_FACT_COPY = (
+    "id, date, weekday, start_time, end_time, duration_minutes, academy_id, location_id, "
+    "activity_name, type_id, audience_count, notes, create_time"
+)
+
+def _activity_view_sql():
+    joins = " ".join(f"LEFT JOIN {t} ON {t}.id = f.{fk}" for fk, t, _ in ACTIVITY_DIMENSIONS)
+    names = {col: f"{t}.name AS {col}" for _, t, col in ACTIVITY_DIMENSIONS}
+    return (
+        "SELECT f.id, f.date, f.weekday, f.start_time, f.end_time, f.duration_minutes, "
+        f"{names['academy']}, {names['location']}, f.activity_name, {names['activity_type']}, "
+        f"f.audience_count, f.notes, f.create_time FROM activity_facts f {joins}"
+    )
+
+def _activity_copy_sql(insert, binary=False):
+    # binary: compare bytes, so MySQL does not have to reconcile the old
+    # columns' collation with the dimension tables' utf8mb4_bin.
+    cast = (lambda c: f"CAST({c} AS BINARY)") if binary else (lambda c: c)
+    joins = " ".join(f"LEFT JOIN {t} ON {t}.name = {cast('e.' + col)}" for _, t, col in ACTIVITY_DIMENSIONS)
+    ids = {col: f"{t}.id" for _, t, col in ACTIVITY_DIMENSIONS}
+    return (
+        f"{insert} INTO activity_facts ({_ACTIVITY_FACT_COPY}) "
+        "SELECT e.id, e.date, e.weekday, e.start_time, e.end_time, e.duration_minutes, "
+        f"{ids['academy']}, {ids['location']}, e.activity_name, {ids['activity_type']}, "
+        f"e.audience_count, e.notes, e.create_time FROM activity_events e {joins}"
+    )
+
+async def _sqlite_activity_dimensions(conn):
+    for _, table, _ in ACTIVITY_DIMENSIONS:
+        await conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS activity_facts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT,
+            weekday TEXT,
+            start_time TEXT,
+            end_time TEXT,
+            duration_minutes INTEGER,
+            academy_id INTEGER REFERENCES activity_academies(id),
+            location_id INTEGER REFERENCES activity_locations(id),
+            activity_name TEXT,
+            type_id INTEGER REFERENCES activity_types(id),
+            audience_count INTEGER,
+            notes TEXT,
+            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    async with conn.execute("SELECT type FROM sqlite_master WHERE name = 'activity_events'") as cur:
+        row = await cur.fetchone()
+    if row and row[0] == "table":
+        for _, table, col in ACTIVITY_DIMENSIONS:
+            await conn.execute(
+                f"INSERT OR IGNORE INTO {table} (name) SELECT DISTINCT {col} FROM activity_events WHERE {col} IS NOT NULL"
+            )
+        await conn.execute(_activity_copy_sql("INSERT OR IGNORE"))
+        await conn.execute("DROP TABLE activity_events")
+    await conn.execute(f"CREATE VIEW IF NOT EXISTS activity_events AS {_activity_view_sql()}")
+    await conn.execute(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS uq_activity_signature ON activity_facts({ACTIVITY_FACT_SIGNATURE})"
+    )
+    for name, cols in ACTIVITY_FACT_INDEXES:
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON activity_facts({cols})")
+
+async def _sqlite_sync_state(conn):
+    # Small key/value store for background jobs (e.g. the walk-in sync watermark).
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+async def _sqlite_records_merged(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS records_merged (
+            uuid TEXT NOT NULL,
+            time DATETIME NOT NULL,
+            digest TEXT NOT NULL,
+            PRIMARY KEY (uuid, time, digest)
+        )
+    """)
+
+async def _sqlite_walkin_dirty(conn):
+    # (uuid, time) of device uploads merged into an existing row in place,
+    # which the walk-in sync's records.id watermark cannot see.
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS walkin_dirty (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            uuid TEXT NOT NULL,
+            time DATETIME NOT NULL
+        )
+    """)
+
+SQLITE_MIGRATIONS = [
+    (1, "baseline", _sqlite_baseline),
+    (2, "records_uuid_time_unique", _sqlite_records_unique),
+    (3, "activity_signature_unique", _sqlite_activity_unique),
+    (4, "activity_dimensions", _sqlite_activity_dimensions),
+    (5, "sync_state", _sqlite_sync_state),
+    (6, "records_merged", _sqlite_records_merged),
+    (7, "walkin_dirty", _sqlite_walkin_dirty),
+]
+
+async def sqlite_version(conn) -> int:
+    async with conn.execute("PRAGMA user_version") as cur:
+        row = await cur.fetchone()
+    return int(row[0]) if row else 0
+
+async def migrate_sqlite(conn) -> int:
+    """Applies pending migrations; returns the resulting schema version."""
+    current = await sqlite_version(conn)
+    pending = [m for m in SQLITE_MIGRATIONS if m[0] > current]
+    if not pending:
+        return current
+    if current == 0:
+        # Only takes effect on a new database file; lets retention hand pages back.
+        await conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    for version, name, fn in pending:
+        logging.info(f"Applying SQLite migration {version} ({name})")
+        try:
+            await fn(conn)
+            # user_version cannot take a bound parameter; version is an int from the list above.
+            await conn.execute(f"PRAGMA user_version = {int(version)}")
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
+        current = version
+    return current
+
+# --- MySQL ---
+
+async def _mysql_try(cur, sql, label=None):
+    try:
+        await cur.execute(sql)
+    except Exception as e:
+        if label:
+            logging.info(f"MySQL Migration failed ({label}): {e}")
+
+async def _mysql_ensure_indexes(cur):
+    tables = sorted({t for _, t, _ in SECONDARY_INDEXES})
+    await cur.execute(
+        f"SELECT DISTINCT TABLE_NAME, INDEX_NAME FROM information_schema.STATISTICS "
+        f"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({','.join(['%s'] * len(tables))})",
+        tables,
+    )
+    existing = {(r[0], r[1]) for r in await cur.fetchall()}
+    for name, table, cols in SECONDARY_INDEXES:
+        if (table, name) not in existing:
+            await cur.execute(f"ALTER TABLE {table} ADD INDEX {name} ({cols})")
+
+async def _mysql_baseline(cur):
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            username VARCHAR(64) UNIQUE,
+            password_hash VARCHAR(128),
+            role VARCHAR(32) DEFAULT 'user',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    try:
+        await cur.execute("SHOW COLUMNS FROM users LIKE 'created_at'")
+        if not await cur.fetchone():
+            await cur.execute("ALTER TABLE users ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP")
+    except Exception as e:
+        logging.info(f"MySQL Migration failed (users.created_at): {e}")
+
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS sessions (
+            token VARCHAR(64) PRIMARY KEY,
+            user_id BIGINT,
+            expires_at DATETIME
+        )
+    """)
+    await cur.execute("SELECT id FROM users WHERE username='admin'")
+    if not await cur.fetchone():
+        await cur.execute("INSERT INTO users (username, password_hash, role) VALUES ('admin', %s, 'admin')", (_default_admin_hash(),))
+
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS records (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            uuid VARCHAR(64),
+            time DATETIME,
+            in_count INT,
+            out_count INT,
+            battery INT,
+            btx INT,
+            rec_type INT,
+            signal_strength INT,
+            warn_status INT,
+            activity_type VARCHAR(64),
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_uuid_time (uuid, time),
+            INDEX idx_time (time)
+        )
+    """)
+    await _mysql_try(cur, "ALTER TABLE records ADD COLUMN activity_type VARCHAR(64)")
+    await _mysql_try(cur, "ALTER TABLE records ADD COLUMN warn_status INT")
+    try:
+        await cur.execute("SHOW INDEX FROM records WHERE Key_name = 'idx_time'")
+        if not await cur.fetchone():
+            await cur.execute("ALTER TABLE records ADD INDEX idx_time (time)")
+    except Exception as e:
+        logging.info(f"MySQL Migration failed (records.idx_time): {e}")
+
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS registry (
+            uuid VARCHAR(64) PRIMARY KEY,
+            name VARCHAR(128),
+            category VARCHAR(64),
+            description TEXT,
+            last_seen DATETIME,
+            ip VARCHAR(64),
+            bound_at DATETIME
+        )
+    """)
+    await _mysql_try(cur, "ALTER TABLE registry ADD COLUMN ip VARCHAR(64)")
+    await _mysql_try(cur, "ALTER TABLE registry ADD COLUMN bound_at DATETIME")
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            actor VARCHAR(128),
+            action VARCHAR(64),
+            target VARCHAR(64),
+            details TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS academies (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(128) UNIQUE,
+            sort_order INT DEFAULT 0
+        )
+    """)
+    await _mysql_try(cur, "ALTER TABLE academies ADD COLUMN sort_order INT DEFAULT 0")
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS activity_events (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            date VARCHAR(20),
+            weekday VARCHAR(20),
+            start_time VARCHAR(20),
+            end_time VARCHAR(20),
+            duration_minutes INT,
+            academy VARCHAR(128),
+            location VARCHAR(128),
+            activity_name VARCHAR(255),
+            activity_type VARCHAR(64),
+            audience_count INT,
+            notes TEXT,
+            create_time DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS alerts (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            uuid VARCHAR(64),
+            type VARCHAR(64),
+            level INT,
+            info TEXT,
+            time DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS location_academy (
+            location_name VARCHAR(128) PRIMARY KEY,
+            academy_name VARCHAR(64)
+        )
+    """)
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS records_hourly (
+            uuid VARCHAR(64) NOT NULL,
+            hour DATETIME NOT NULL,
+            in_count BIGINT DEFAULT 0,
+            out_count BIGINT DEFAULT 0,
+            samples INT DEFAULT 0,
+            PRIMARY KEY (uuid, hour),
+            INDEX idx_hour (hour)
+        )
+    """)
+    await _mysql_ensure_indexes(cur)
+    await _mysql_try(cur, """
+        UPDATE registry r
+        JOIN location_academy la ON r.name = la.location_name
+        SET r.bound_at = IFNULL(r.bound_at, NOW())
+        WHERE r.name IS NOT NULL AND r.name != ''
+    """)
+
+async def _mysql_records_unique(cur):
+    # Duplicates folded as in _record_dups_sql. A temporary table may appear
+    # only once per statement on MySQL, hence the separate UPDATE and DELETE.
+    await cur.execute("DROP TEMPORARY TABLE IF EXISTS records_dups")
+    await cur.execute(f"CREATE TEMPORARY TABLE records_dups AS {_record_dups_sql('records')}")
+    await cur.execute("SELECT uuid, time, keep, n, ids, in_sum, out_sum FROM records_dups ORDER BY keep")
+    _log_record_dups("records", list(await cur.fetchall()))
+    await cur.execute("""
+        UPDATE records r JOIN records_dups d ON r.id = d.keep
+        SET r.in_count = d.in_sum, r.out_count = d.out_sum
+    """)
+    await cur.execute("""
+        DELETE r FROM records r
+        JOIN records_dups d ON r.uuid = d.uuid AND r.time = d.time AND r.id <> d.keep
+    """)
+    await cur.execute("DROP TEMPORARY TABLE records_dups")
+    await cur.execute("SHOW INDEX FROM records WHERE Key_name = 'uq_records_uuid_time'")
+    if not await cur.fetchone():
+        await cur.execute("ALTER TABLE records ADD UNIQUE INDEX uq_records_uuid_time (uuid, time)")
+    await cur.execute("SHOW INDEX FROM records WHERE Key_name = 'idx_uuid_time'")
+    if await cur.fetchone():
+        await cur.execute("ALTER TABLE records DROP INDEX idx_uuid_time")
+
+async def _mysql_activity_unique(cur):
+    await cur.execute("""
+        DELETE a1 FROM activity_events a1
+        JOIN activity_events a2
+          ON a1.date = a2.date AND a1.start_time = a2.start_time
+         AND a1.location = a2.location AND a1.activity_name = a2.activity_name
+         AND a1.id < a2.id
+    """)
+    await cur.execute("SHOW INDEX FROM activity_events WHERE Key_name = 'uq_activity_signature'")
+    if not await cur.fetchone():
+        await cur.execute(f"ALTER TABLE activity_events ADD UNIQUE INDEX uq_activity_signature ({ACTIVITY_SIGNATURE})")
+
+# Dimension names are compared byte for byte, as on SQLite. Under the default
+# case-insensitive collation "room a" and "Room A" would share one row, and
+# INSERT IGNORE would silently drop one of them.
+_MYSQL_DIM_NAME = "name VARCHAR(128) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL"
+
+async def _mysql_activity_dimensions(cur):
+    for _, table, _ in ACTIVITY_DIMENSIONS:
+        await cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                {_MYSQL_DIM_NAME},
+                UNIQUE KEY uq_{table}_name (name)
+            )
+        """)
+    indexes = ",".join(f"INDEX {name} ({cols})" for name, cols in ACTIVITY_FACT_INDEXES)
+    await cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS activity_facts (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            date VARCHAR(20),
+            weekday VARCHAR(20),
+            start_time VARCHAR(20),
+            end_time VARCHAR(20),
+            duration_minutes INT,
+            academy_id INT,
+            location_id INT,
+            activity_name VARCHAR(255),
+            type_id INT,
+            audience_count INT,
+            notes TEXT,
+            create_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE KEY uq_activity_signature ({ACTIVITY_FACT_SIGNATURE}),
+            {indexes},
+            FOREIGN KEY (academy_id) REFERENCES activity_academies(id),
+            FOREIGN KEY (location_id) REFERENCES activity_locations(id),
+            FOREIGN KEY (type_id) REFERENCES activity_types(id)
+        )
+    """)
+    await cur.execute(
+        "SELECT TABLE_TYPE FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'activity_events'"
+    )
+    row = await cur.fetchone()
+    if row and row[0] == "BASE TABLE":
+        for _, table, col in ACTIVITY_DIMENSIONS:
+            # No DISTINCT: under the old column's collation it would fold case variants.
+            await cur.execute(
+                f"INSERT IGNORE INTO {table} (name) SELECT {col} FROM activity_events WHERE {col} IS NOT NULL"
+            )
+        await cur.execute(_activity_copy_sql("INSERT IGNORE", binary=True))
+        await cur.execute("DROP TABLE activity_events")
+    await cur.execute(f"CREATE OR REPLACE VIEW activity_events AS {_activity_view_sql()}")
+
+async def _mysql_activity_dimension_names_bin(cur):
+    # Databases that ran migration 4 before its names were declared binary.
+    for _, table, _ in ACTIVITY_DIMENSIONS:
+        await cur.execute(f"ALTER TABLE {table} MODIFY {_MYSQL_DIM_NAME}")
+
+async def _mysql_sync_state(cur):
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS sync_state (
+            name VARCHAR(64) PRIMARY KEY,
+            value VARCHAR(255),
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+async def _mysql_records_merged(cur):
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS records_merged (
+            uuid VARCHAR(64) NOT NULL,
+            time DATETIME NOT NULL,
+            digest CHAR(16) NOT NULL,
+            PRIMARY KEY (uuid, time, digest)
+        )
+    """)
+
+async def _mysql_walkin_dirty(cur):
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS walkin_dirty (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            uuid VARCHAR(64) NOT NULL,
+            time DATETIME NOT NULL
+        )
+    """)
+
+MYSQL_MIGRATIONS = [
+    (1, "baseline", _mysql_baseline),
+    (2, "records_uuid_time_unique", _mysql_records_unique),
+    (3, "activity_signature_unique", _mysql_activity_unique),
+    (4, "activity_dimensions", _mysql_activity_dimensions),
+    (5, "sync_state", _mysql_sync_state),
+    (6, "activity_dimension_names_bin", _mysql_activity_dimension_names_bin),
+    (7, "records_merged", _mysql_records_merged),
+    (8, "walkin_dirty", _mysql_walkin_dirty),
+]
+
+async def mysql_version(cur) -> int:
+    try:
+        await cur.execute("SELECT MAX(version) FROM schema_version")
+        row = await cur.fetchone()
+    except Exception:
+        return 0
+    return int(row[0]) if row and row[0] is not None else 0
+
+async def migrate_mysql(cur) -> int:
+    """
+    Applies pending migrations on an autocommit cursor; returns the resulting
+    schema version. MySQL DDL commits implicitly, so each migration must be
+    safe to re-run if the process dies before its version row is written.
+    """
+    current = await mysql_version(cur)
+    pending = [m for m in MYSQL_MIGRATIONS if m[0] > current]
+    if not pending:
+        return current
+    await cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT PRIMARY KEY,
+            name VARCHAR(64),
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    for version, name, fn in pending:
+        logging.info(f"Applying MySQL migration {version} ({name})")
+        await fn(cur)
+        await cur.execute("INSERT INTO schema_version (version, name) VALUES (%s, %s)", (version, name))
+        current = version
+    return current
@@ -0,0 +1,101 @@
+"""
+Walk-in visitor bucketing.
+
+A walk-in event is the positive in_count of one device summed over a fixed
+slot of the day, WALKIN_BUCKET_MINUTES wide (15, 30 or 60). Everything that
+turns records into walk-in events bins them the same way: slot =
+seconds_into_day // (minutes * 60). Rows still in the database are binned by
+SQL (sql_exprs) so only buckets cross the wire; archived columns, which are
+already NumPy arrays, go through bin_arrays.
+"""
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+try:
+    import pandas as pd
+except Exception:
+    pd = None
+
+from . import config
+
+BUCKET_CHOICES = (15, 30, 60)
+
+def bucket_minutes(value=None) -> int:
+    """Validated bucket width; None means the configured default."""
+    if value is None or value == "":
+        value = config.WALKIN_BUCKET_MINUTES
+    try:
+        minutes = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"bucket_minutes must be one of {BUCKET_CHOICES}")
+    if minutes not in BUCKET_CHOICES:
+        raise ValueError(f"bucket_minutes must be one of {BUCKET_CHOICES}")
+    return minutes
+
+def sql_exprs(sqlite: bool, minutes: int) -> Tuple[str, str]:
+    """(day, slot) SQL expressions over records.time."""
+    if sqlite:
+        # time is stored as 'YYYY-MM-DD HH:MM:SS' text (sometimes with a 'T');
+        # both operands are integers, so / truncates.
+        return ("substr(time, 1, 10)",
+                f"((CAST(substr(time, 12, 2) AS INTEGER) * 60 + CAST(substr(time, 15, 2) AS INTEGER)) / {int(minutes)})")
+    return "DATE(time)", f"((HOUR(time) * 60 + MINUTE(time)) DIV {int(minutes)})"
+
+def slot_times(slot: int, minutes: int) -> Tuple[str, str]:
+    """("HH:MM", "HH:MM") bounds of a slot; the last slot of the day ends at 23:59."""
+    start = slot * minutes
+    end = start + minutes
+    s_time = f"{start // 60:02d}:{start % 60:02d}"
+    e_time = "23:59" if end >= 24 * 60 else f"{end // 60:02d}:{end % 60:02d}"
+    return s_time, e_time
+
+def bin_arrays(uuids: np.ndarray, times: np.ndarray, counts: np.ndarray,
+               minutes: Optional[int] = None) -> Dict[tuple, int]:
+    """
+    {(uuid, "YYYY-MM-DD", slot): in_count} from parallel arrays. times is
+    datetime64 (any unit) or int64 epoch seconds; NaT times and non-positive
+    or NaN counts are dropped. Integer arithmetic on epoch seconds; groups are
+    found by hashing (pandas.factorize) when pandas is installed, else by
+    sorting (np.unique).
+    """
+    minutes = bucket_minutes(minutes)
+    if np.issubdtype(times.dtype, np.datetime64):
+        valid = ~np.isnat(times)
+        seconds = times.astype("datetime64[s]").astype(np.int64)
+    else:
+        valid = np.ones(len(times), dtype=bool)
+        seconds = times.astype(np.int64)
+    counts = np.nan_to_num(np.asarray(counts, dtype=np.float64))
+    keep = valid & (counts > 0)
+    if not keep.any():
+        return {}
+    seconds = seconds[keep]
+    counts = counts[keep]
+    dev, dev_names = _factorize(np.asarray(uuids)[keep].astype(str))
+
+    day = seconds // 86400
+    slot = (seconds - day * 86400) // (minutes * 60)
+    day0 = int(day.min())
+    days = int(day.max()) - day0 + 1
+    slots = (24 * 60) // minutes
+    key = (dev.astype(np.int64) * days + (day - day0)) * slots + slot
+    inv, uniq = _factorize(key)
+    sums = np.bincount(inv, weights=counts, minlength=len(uniq))
+
+    names = np.asarray(dev_names).tolist()
+    labels = np.datetime_as_string(np.arange(day0, day0 + days).astype("datetime64[D]"), unit="D").tolist()
+    u_slot = (uniq % slots).tolist()
+    u_day = ((uniq // slots) % days).tolist()
+    u_dev = (uniq // slots // days).tolist()
+    return {
+        (names[d], labels[dd], s): int(n)
+        for d, dd, s, n in zip(u_dev, u_day, u_slot, sums.tolist())
+    }
+
+def _factorize(values: np.ndarray):
+    """(codes, uniques) with values == uniques[codes]."""
+    if pd is not None:
+        codes, uniques = pd.factorize(values)
+        return codes, np.asarray(uniques)
+    uniques, codes = np.unique(values, return_inverse=True)
+    return codes, uniques
@@ -2,10 +2,28 @@ import asyncio
 import logging
 import os
 import xml.etree.ElementTree as ET
+from typing import Optional
 from app import config
+from app.journal import IngestJournal
 from app.protocol import HEAD, TAIL, parse_packet, parse_sensor_xml, build_ack_xml, build_time_sync_xml, build_frame
 from app.logging import setup as setup_logging
 
+_journal: Optional[IngestJournal] = None
+
+async def _save(rec: dict):
+    from app.db import save_device_data
+    await save_device_data(rec["data"], ip=rec.get("ip"))
+
+async def _ingest(d: dict, ip):
+    """ACK as soon as the record is journaled; the DB write happens in replay."""
+    if _journal is not None:
+        try:
+            await _journal.append({"data": d, "ip": ip})
+            return
+        except Exception as e:
+            logging.error("ingest journal append failed, writing directly: %s", e)
+    await _save({"data": d, "ip": ip})
+
 async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
     buffer = b""
     try:
@@ -50,10 +68,9 @@ async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
                         d = parse_sensor_xml(msg["xml"])
                         if d and d.get("uuid"):
                             ret = 0
+                            ip = peer[0] if peer else None
                             try:
-                                from app.db import save_device_data
-                                ip = peer[0] if peer else None
-                                await save_device_data(d, ip=ip)
+                                await _ingest(d, ip)
                             except Exception as e:
                                 logging.error("save_device_data error: %s", e)
                                 ret = 1
@@ -128,6 +145,18 @@ async def main():
         await init_pool()
     except Exception:
         pass
+
+    global _journal
+    if config.INGEST_JOURNAL_ENABLE:
+        _journal = IngestJournal(
+            config.INGEST_JOURNAL_DIR,
+            fsync_ms=config.INGEST_JOURNAL_FSYNC_MS,
+            segment_bytes=config.INGEST_JOURNAL_SEGMENT_BYTES,
+            replay_batch=config.INGEST_JOURNAL_REPLAY_BATCH,
+            max_attempts=config.INGEST_JOURNAL_MAX_ATTEMPTS,
+        )
+        from app.db import is_permanent_error
+        _journal.start(_save, is_permanent_error)
     
     # Retry loop for binding port
     server = None
@@ -153,6 +182,9 @@ async def main():
             await server.serve_forever()
         except (KeyboardInterrupt, asyncio.CancelledError):
             logging.info("TCP Server stopped by signal.")
+        finally:
+            if _journal is not None:
+                await _journal.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,120 @@
+"""
+Times the activity/alerts/sessions queries with and without the secondary
+indexes from app.migrations.SECONDARY_INDEXES on a throwaway SQLite database.
+
+    python tools/bench_indexes.py [--events 200000] [--alerts 50000] [--sessions 50000]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUERIES = [
+    ("activity_list (1 month, page 1)",
+     "SELECT * FROM activity_events WHERE date >= ? AND date <= ? ORDER BY date DESC, start_time DESC LIMIT 50",
+     ("2024-03-01", "2024-03-31")),
+    ("activity_stats kpis (academy, 1 month)",
+     "SELECT COUNT(*), SUM(audience_count) FROM activity_facts WHERE date >= ? AND date <= ? "
+     "AND academy_id IN (SELECT id FROM activity_academies WHERE name IN (?))",
+     ("2024-03-01", "2024-03-31", "Academy 3")),
+    ("bulk insert signature scan (1 week)",
+     "SELECT id, date, start_time, location, activity_name FROM activity_events WHERE date >= ? AND date <= ?",
+     ("2024-05-01", "2024-05-07")),
+    ("correct_location location IN",
+     "SELECT COUNT(*) FROM activity_facts WHERE location_id IN (SELECT id FROM activity_locations WHERE name IN (?, ?))",
+     ("Room 17", "Room 42")),
+    ("activity options location counts",
+     "SELECT d.name, c.n FROM (SELECT location_id, COUNT(*) AS n FROM activity_facts GROUP BY location_id) c "
+     "JOIN activity_locations d ON d.id = c.location_id",
+     ()),
+    ("list_alerts uuid",
+     "SELECT * FROM alerts WHERE uuid=? ORDER BY time DESC LIMIT 100",
+     ("DEV-007",)),
+    ("list_alerts all",
+     "SELECT * FROM alerts ORDER BY time DESC LIMIT 100",
+     ()),
+    ("purge expired sessions (select)",
+     "SELECT rowid FROM sessions WHERE expires_at <= ? LIMIT 1000",
+     ("2024-01-15 00:00:00",)),
+]
+
+def seed(path, events, alerts, sessions):
+    import asyncio
+    from app import config, db
+    config.DB_SQLITE_PATH = path
+    asyncio.run(_init(db))
+    rnd = random.Random(1)
+    con = sqlite3.connect(path)
+    # activity_events is a view; seed the dimension tables and the facts.
+    con.executemany("INSERT INTO activity_academies (id, name) VALUES (?, ?)", ((i, f"Academy {i}") for i in range(1, 21)))
+    con.executemany("INSERT INTO activity_locations (id, name) VALUES (?, ?)", ((i, f"Room {i}") for i in range(1, 301)))
+    con.execute("INSERT INTO activity_types (id, name) VALUES (1, '讲座')")
+    con.executemany(
+        "INSERT INTO activity_facts (date, weekday, start_time, end_time, academy_id, location_id, activity_name, type_id, audience_count) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (
+            (f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}", "周一", f"{rnd.randint(8, 21):02d}:00",
+             "23:00", rnd.randint(1, 20), rnd.randint(1, 300), f"Event {i}", 1,
+             rnd.randint(0, 200))
+            for i in range(events)
+        ),
+    )
+    con.executemany(
+        "INSERT INTO alerts (uuid, type, level, info, time) VALUES (?, ?, ?, ?, ?)",
+        ((f"DEV-{rnd.randint(1, 200):03d}", "battery", 1, "", f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 12:00:00")
+         for _ in range(alerts)),
+    )
+    con.executemany(
+        "INSERT INTO sessions (token, user_id, expires_at) VALUES (?, 1, ?)",
+        ((f"t{i}", f"2024-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 00:00:00") for i in range(sessions)),
+    )
+    con.commit()
+    con.execute("ANALYZE")
+    con.close()
+
+async def _init(db):
+    await db.init_sqlite()
+    await db.close_pool()
+
+def run(con, reps=5):
+    out = []
+    for label, sql, params in QUERIES:
+        times = []
+        for _ in range(reps):
+            t0 = time.perf_counter()
+            con.execute(sql, params).fetchall()
+            times.append((time.perf_counter() - t0) * 1000)
+        out.append((label, statistics.median(times)))
+    return out
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=200000)
+    ap.add_argument("--alerts", type=int, default=50000)
+    ap.add_argument("--sessions", type=int, default=50000)
+    args = ap.parse_args()
+
+    from app.migrations import ACTIVITY_FACT_INDEXES, SECONDARY_INDEXES
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "bench.db")
+        seed(path, args.events, args.alerts, args.sessions)
+        con = sqlite3.connect(path)
+        after = run(con)
+        for name in {n for n, _, _ in SECONDARY_INDEXES} | {n for n, _ in ACTIVITY_FACT_INDEXES}:
+            con.execute(f"DROP INDEX IF EXISTS {name}")
+        con.execute("ANALYZE")
+        before = run(con)
+        con.close()
+
+    print(f"{'query':42} {'before ms':>10} {'after ms':>10} {'speedup':>8}")
+    for (label, b), (_, a) in zip(before, after):
+        print(f"{label:42} {b:10.2f} {a:10.2f} {b / a if a else 0:7.1f}x")
+
+if __name__ == "__main__":
+    main()
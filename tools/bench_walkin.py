@@ -0,0 +1,98 @@
+"""
+Times walk-in bucketing of synthetic records: the old per-row Python loop
+(strptime + dict), app.walkin.bin_arrays on NumPy columns and, with --sqlite,
+the GROUP BY the previews run on a throwaway SQLite database.
+
+    python tools/bench_walkin.py [--rows 10000000] [--devices 50] [--minutes 30] [--legacy-rows 1000000] [--sqlite]
+
+The legacy loop is timed on --legacy-rows and scaled to --rows.
+"""
+import argparse
+import datetime
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def make_columns(rows, devices, seed=1):
+    rnd = np.random.default_rng(seed)
+    start = np.datetime64("2024-01-01T00:00:00", "s").astype(np.int64)
+    seconds = start + np.sort(rnd.integers(0, 365 * 86400, rows))
+    uuids = np.array([f"DEV{i:03d}" for i in range(devices)])[rnd.integers(0, devices, rows)]
+    counts = rnd.integers(-1, 6, rows).astype(np.float64)
+    return uuids, seconds, counts
+
+def legacy(uuids, seconds, counts, minutes):
+    # The loop walkin_preview used to run over fetched rows.
+    times = np.datetime_as_string(seconds.astype("datetime64[s]")).tolist()
+    acc = {}
+    for u, s, v in zip(uuids.tolist(), times, counts.tolist()):
+        dt = datetime.datetime.strptime(s.replace("T", " "), "%Y-%m-%d %H:%M:%S")
+        key = (u, dt.strftime("%Y-%m-%d"), (dt.hour * 60 + dt.minute) // minutes)
+        if v > 0:
+            acc[key] = acc.get(key, 0) + int(v)
+    return acc
+
+def sqlite_groupby(uuids, seconds, counts, minutes):
+    from app import walkin
+    with tempfile.TemporaryDirectory() as d:
+        con = sqlite3.connect(os.path.join(d, "bench.db"))
+        con.execute("CREATE TABLE records (id INTEGER PRIMARY KEY, uuid TEXT, time TEXT, in_count INTEGER)")
+        times = np.char.replace(np.datetime_as_string(seconds.astype("datetime64[s]")), "T", " ")
+        step = 500000
+        for i in range(0, len(seconds), step):
+            con.executemany(
+                "INSERT INTO records (uuid, time, in_count) VALUES (?, ?, ?)",
+                zip(uuids[i:i + step].tolist(), times[i:i + step].tolist(), counts[i:i + step].astype(np.int64).tolist()),
+            )
+        con.execute("CREATE INDEX idx_records_uuid_time ON records(uuid, time)")
+        con.commit()
+        day, slot = walkin.sql_exprs(True, minutes)
+        sql = (f"SELECT uuid, {day} AS d, {slot} AS b, SUM(CASE WHEN in_count > 0 THEN in_count ELSE 0 END) AS n "
+               f"FROM records WHERE time IS NOT NULL GROUP BY uuid, d, b HAVING n > 0")
+        t0 = time.perf_counter()
+        out = con.execute(sql).fetchall()
+        ms = (time.perf_counter() - t0) * 1000
+        con.close()
+    return ms, len(out)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=10_000_000)
+    ap.add_argument("--devices", type=int, default=50)
+    ap.add_argument("--minutes", type=int, default=30)
+    ap.add_argument("--legacy-rows", type=int, default=1_000_000)
+    ap.add_argument("--sqlite", action="store_true")
+    args = ap.parse_args()
+
+    from app import walkin
+    uuids, seconds, counts = make_columns(args.rows, args.devices)
+
+    n = min(args.legacy_rows, args.rows)
+    t0 = time.perf_counter()
+    ref = legacy(uuids[:n], seconds[:n], counts[:n], args.minutes)
+    legacy_ms = (time.perf_counter() - t0) * 1000 * args.rows / n
+
+    t0 = time.perf_counter()
+    binned = walkin.bin_arrays(uuids, seconds, counts, args.minutes)
+    numpy_ms = (time.perf_counter() - t0) * 1000
+    if n == args.rows:
+        assert binned == ref, "bin_arrays disagrees with the legacy loop"
+    else:
+        assert walkin.bin_arrays(uuids[:n], seconds[:n], counts[:n], args.minutes) == ref
+
+    print(f"{args.rows:,} rows, {args.devices} devices, {args.minutes}-minute buckets -> {len(binned):,} buckets")
+    print(f"{'engine':34} {'ms':>10}")
+    print(f"{'legacy Python loop (scaled)':34} {legacy_ms:10.0f}")
+    print(f"{'walkin.bin_arrays (NumPy)':34} {numpy_ms:10.0f}")
+    if args.sqlite:
+        ms, _ = sqlite_groupby(uuids, seconds, counts, args.minutes)
+        print(f"{'SQLite GROUP BY':34} {ms:10.0f}")
+
+if __name__ == "__main__":
+    main()